@@ -0,0 +1,73 @@
+"""
+Thread safe least recently used cache bounded by the total size of its values.
+"""
+
+import threading
+from collections import OrderedDict
+
+class LRUCache( object ):
+    """
+    Maps keys to values, evicting the least recently used entries once the
+    sizes of all values, as measured by `size_of`, add up to more than
+    `max_size`. Values larger than `max_size` are not stored at all.
+    """
+
+    def __init__( self, max_size, size_of=len ):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def __contains__( self, key ):
+        return key in self.entries
+
+    def get( self, key, default=None ):
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                return default
+            # Move the entry to the most recently used end.
+            value, size = self.entries.pop( key )
+            self.entries[ key ] = ( value, size )
+            return value
+        finally:
+            self.lock.release()
+
+    def put( self, key, value ):
+        size = self.size_of( value )
+        self.lock.acquire()
+        try:
+            self._remove( key )
+            if size > self.max_size:
+                return
+            self.entries[ key ] = ( value, size )
+            self.size += size
+            while self.size > self.max_size:
+                oldest, ( value, size ) = self.entries.popitem( last=False )
+                self.size -= size
+        finally:
+            self.lock.release()
+
+    def remove( self, key ):
+        self.lock.acquire()
+        try:
+            self._remove( key )
+        finally:
+            self.lock.release()
+
+    def clear( self ):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def _remove( self, key ):
+        if key in self.entries:
+            value, size = self.entries.pop( key )
+            self.size -= size
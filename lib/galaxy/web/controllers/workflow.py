@@ -2,12 +2,11 @@ from galaxy.web.base.controller import *
 
 import pkg_resources
 pkg_resources.require( "simplejson" )
-pkg_resources.require( "SVGFig" )
 import simplejson
-import base64, httplib, urllib2, sgmllib, svgfig
-import math
-import zipfile, time, os, tempfile, string
-from operator import itemgetter
+import base64, httplib, urllib2, sgmllib
+import zipfile, gzip, time, os, tempfile, string, atexit
+from cStringIO import StringIO
+from hashlib import sha1
 from galaxy.web.framework.helpers import time_ago, grids
 from galaxy.tools.parameters import *
 from galaxy.tools import DefaultToolState
@@ -15,14 +14,24 @@ from galaxy.tools.parameters.grouping import Repeat, Conditional
 from galaxy.datatypes.data import Data
 from galaxy.util.odict import odict
 from galaxy.util.sanitize_html import sanitize_html
-from galaxy.util.topsort import topsort, topsort_levels, CycleError
+from galaxy.util.lru import LRUCache
+from galaxy.workflow.graph import WorkflowGraph, CycleError, sort_by_position
 from galaxy.workflow.modules import *
+from galaxy.workflow import wspgrade, module_cache, render, scheduler, execution, loader
+from galaxy.workflow.input_index import index_for_tool
 from galaxy import model
 from galaxy.model.mapping import desc
 from galaxy.model.orm import *
 from galaxy.model.item_attrs import *
 from galaxy.web.framework.helpers import to_unicode
-from galaxy.jobs.actions.post import ActionBox
+
+import logging
+log = logging.getLogger( __name__ )
+
+# Seconds the browser may reuse step forms without revalidating them.
+STEP_FORM_MAX_AGE = 3600
+# Workflow images (with their spatial index) kept for tile requests.
+IMAGE_MODEL_CACHE_SIZE = 64
 
 class StoredWorkflowListGrid( grids.Grid ):    
     class StepsColumn( grids.GridColumn ):
@@ -54,6 +63,7 @@ class StoredWorkflowListGrid( grids.Grid ):
         grids.GridOperation( "Clone", condition=( lambda item: not item.deleted ), async_compatible=False  ),
         grids.GridOperation( "Rename", condition=( lambda item: not item.deleted ), async_compatible=False  ),
         grids.GridOperation( "Sharing", condition=( lambda item: not item.deleted ), async_compatible=False ),
+        grids.GridOperation( "Download as WS-PGRADE", allow_multiple=True, condition=( lambda item: not item.deleted ), async_compatible=False ),
         grids.GridOperation( "Delete", condition=( lambda item: item.deleted ), async_compatible=True ),
     ]
     def apply_query_filter( self, trans, query, **kwargs ):
@@ -111,6 +121,26 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
     
     __myexp_url = "sandbox.myexperiment.org:80"
     
+    def __init__( self, app ):
+        BaseController.__init__( self, app )
+        config = app.config
+        self.wspgrade_cache = wspgrade.ArchiveCache( max_size=int( getattr( config, 'wspgrade_cache_size', wspgrade.CACHE_SIZE ) ),
+                                                     cache_dir=getattr( config, 'wspgrade_cache_dir', None ),
+                                                     disk_max_size=int( getattr( config, 'wspgrade_cache_disk_size', wspgrade.DISK_CACHE_SIZE ) ) )
+        self.wspgrade_timings_registry = wspgrade.TimingRegistry()
+        # Bulk downloads convert in the request unless processes are
+        # configured; the pool is forked on the first bulk download.
+        self.wspgrade_pool = wspgrade.ConversionPool( int( getattr( config, 'wspgrade_bulk_processes', 0 ) ) )
+        atexit.register( self.wspgrade_pool.close )
+        self.datatypes_payload = None
+        self.image_cache = render.ImageCache( max_size=int( getattr( config, 'workflow_image_cache_size', render.CACHE_SIZE ) ) )
+        self.module_cache = module_cache.ModuleCache( int( getattr( config, 'workflow_module_cache_size', module_cache.CACHE_SIZE ) ) )
+        self.image_models = LRUCache( IMAGE_MODEL_CACHE_SIZE, size_of=lambda image: 1 )
+        # With workflow_scheduler_workers = 0, run() executes the steps within the request
+        self.scheduler = scheduler.InvocationScheduler( lambda request, progress: execution.execute_request( app, request, progress ),
+                                                        scheduler.InvocationStore( app.model.engine ),
+                                                        workers=int( getattr( config, 'workflow_scheduler_workers', scheduler.WORKERS ) ) )
+    
     @web.expose
     def index( self, trans ):
         return self.list( trans )
@@ -127,6 +157,8 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             history_ids = util.listify( kwargs.get( 'id', [] ) )
             if operation == "sharing":
                 return self.sharing( trans, id=history_ids )
+            if operation == "download as ws-pgrade":
+                return self.download_to_wspgrade_bulk( trans, id=history_ids )
         return self.stored_list_grid( trans, **kwargs )
                                    
     @web.expose
@@ -207,8 +239,9 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         self.get_stored_workflow_steps( trans, stored_workflow )
         # Get annotations.
         stored_workflow.annotation = self.get_item_annotation_str( trans.sa_session, stored_workflow.user, stored_workflow )
+        step_annotations = self._get_step_annotations( trans, stored_workflow.user, stored_workflow.latest_workflow )
         for step in stored_workflow.latest_workflow.steps:
-            step.annotation = self.get_item_annotation_str( trans.sa_session, stored_workflow.user, step )
+            step.annotation = step_annotations.get( step.id )
 
         # Get rating data.
         user_item_rating = 0
@@ -234,8 +267,9 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         self.get_stored_workflow_steps( trans, stored )
         # Get annotations.
         stored.annotation = self.get_item_annotation_str( trans.sa_session, stored.user, stored )
+        step_annotations = self._get_step_annotations( trans, stored.user, stored.latest_workflow )
         for step in stored.latest_workflow.steps:
-            step.annotation = self.get_item_annotation_str( trans.sa_session, stored.user, step )
+            step.annotation = step_annotations.get( step.id )
         return trans.stream_template_mako( "/workflow/item_content.mako", item = stored, item_data = stored.latest_workflow.steps )
                               
     @web.expose
@@ -346,9 +380,7 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             
             # Copy annotations.
             self.copy_item_annotation( session, stored.user, stored, imported_stored.user, imported_stored )
-            for order_index, step in enumerate( stored.latest_workflow.steps ):
-                self.copy_item_annotation( session, stored.user, step, \
-                                            imported_stored.user, imported_stored.latest_workflow.steps[order_index] )
+            self._copy_step_annotations( trans, stored.user, imported_stored.user, stored.latest_workflow )
             session.flush()
             
             # Redirect to load galaxy frames.
@@ -478,111 +510,89 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
     
     @web.expose
     @web.require_login( "use Galaxy workflows" )
-    def gen_image( self, trans, id ):
-        stored = self.get_stored_workflow( trans, id, check_ownership=True )
-        session = trans.sa_session
-                
-        workflow = stored.latest_workflow
-        data = []
-        
-        canvas = svgfig.canvas(style="stroke:black; fill:none; stroke-width:1px; stroke-linejoin:round; text-anchor:left")
-        text = svgfig.SVG("g")
-        connectors = svgfig.SVG("g")
-        boxes = svgfig.SVG("g")
-        svgfig.Text.defaults["font-size"] = "10px"
-        
-        in_pos = {}
-        out_pos = {}
-        margin = 5
-        line_px = 16 # how much spacing between input/outputs
-        widths = {} # store px width for boxes of each step
-        max_width, max_x, max_y = 0, 0, 0
-        
-        for step in workflow.steps:
-            # Load from database representation
-            module = module_factory.from_workflow_step( trans, step )
-            
-            # Pack attributes into plain dictionary
-            step_dict = {
-                'id': step.order_index,
-                'data_inputs': module.get_data_inputs(),
-                'data_outputs': module.get_data_outputs(),
-                'position': step.position
-            }
-            
-            input_conn_dict = {}
-            for conn in step.input_connections:
-                input_conn_dict[ conn.input_name ] = \
-                    dict( id=conn.output_step.order_index, output_name=conn.output_name )
-            step_dict['input_connections'] = input_conn_dict
-                    
-            data.append(step_dict)
-            
-            x, y = step.position['left'], step.position['top']
-            count = 0
-            
-            max_len = len(module.get_name()) * 1.5
-            text.append( svgfig.Text(x, y + 20, module.get_name(), **{"font-size": "14px"} ).SVG() )
-            
-            y += 45
-            for di in module.get_data_inputs():
-                cur_y = y+count*line_px
-                if step.order_index not in in_pos:
-                    in_pos[step.order_index] = {}
-                in_pos[step.order_index][di['name']] = (x, cur_y)
-                text.append( svgfig.Text(x, cur_y, di['label']).SVG() )
-                count += 1
-                max_len = max(max_len, len(di['label']))
-                
-            
-            if len(module.get_data_inputs()) > 0:
-                y += 15
-                
-            for do in module.get_data_outputs():
-                cur_y = y+count*line_px
-                if step.order_index not in out_pos:
-                    out_pos[step.order_index] = {}
-                out_pos[step.order_index][do['name']] = (x, cur_y)
-                text.append( svgfig.Text(x, cur_y, do['name']).SVG() )
-                count += 1
-                max_len = max(max_len, len(do['name']))
-            
-            widths[step.order_index] = max_len*5.5
-            max_x = max(max_x, step.position['left'])
-            max_y = max(max_y, step.position['top'])
-            max_width = max(max_width, widths[step.order_index])
-            
-        for step_dict in data:
-            width = widths[step_dict['id']]
-            x, y = step_dict['position']['left'], step_dict['position']['top']
-            boxes.append( svgfig.Rect(x-margin, y, x+width-margin, y+30, fill="#EBD9B2").SVG() )
-            box_height = (len(step_dict['data_inputs']) + len(step_dict['data_outputs'])) * line_px + margin
+    def gen_image( self, trans, id, detail=None, x=None, y=None, w=None, h=None, zoom=None ):
+        """
+        SVG preview of the latest revision of workflow `id`. The image is
+        streamed while it is rendered and cached per revision and tool
+        versions; the ETag lets the browser revalidate.
 
-            # Draw separator line
-            if len(step_dict['data_inputs']) > 0:
-                box_height += 15
-                sep_y = y + len(step_dict['data_inputs']) * line_px + 40
-                text.append( svgfig.Line(x-margin, sep_y, x+width-margin, sep_y).SVG() ) # 
-                
-            # input/output box
-            boxes.append( svgfig.Rect(x-margin, y+30, x+width-margin, y+30+box_height, fill="#ffffff").SVG() )
-                        
-            for conn, output_dict in step_dict['input_connections'].iteritems():
-                in_coords = in_pos[step_dict['id']][conn]
-                out_conn_pos = out_pos[output_dict['id']][output_dict['output_name']]
-                adjusted = (out_conn_pos[0] + widths[output_dict['id']], out_conn_pos[1])
-                text.append( svgfig.SVG("circle", cx=out_conn_pos[0]+widths[output_dict['id']]-margin, cy=out_conn_pos[1]-margin, r=5, fill="#ffffff" ) )
-                connectors.append( svgfig.Line(adjusted[0], adjusted[1]-margin, in_coords[0]-10, in_coords[1], arrow_end="true" ).SVG() )
-            
-        canvas.append(connectors)
-        canvas.append(boxes)
-        canvas.append(text)
-        width, height = (max_x + max_width + 50), max_y + 300
-        canvas['width'] = "%s px" % width
-        canvas['height'] = "%s px" % height
-        canvas['viewBox'] = "0 0 %s %s" % (width, height)
+        `detail=lod` draws linear chains of steps as one box and leaves the
+        port labels out once `zoom` makes them too small to read. `x`, `y`,
+        `w` and `h` request a tile: only the elements in that part of the
+        canvas, found through the spatial index of the revision's image.
+        """
+        try:
+            zoom = float( zoom or 1 )
+            if zoom <= 0:
+                raise ValueError( zoom )
+            viewport = None
+            if None not in ( x, y, w, h ):
+                viewport = tuple( [ float( value ) for value in ( x, y, w, h ) ] )
+                if viewport[2] <= 0 or viewport[3] <= 0:
+                    raise ValueError( viewport )
+        except ValueError:
+            error( "Invalid zoom or viewport" )
+        stored = self.get_stored_workflow( trans, id, check_ownership=True )
+        workflow_id = stored.latest_workflow_id
+        # The key only needs the tool ids of the steps; the revision itself
+        # is loaded if the image has to be built.
+        step_table = model.WorkflowStep.table
+        tool_ids = trans.sa_session.query( step_table.c.tool_id ) \
+                                   .filter( step_table.c.workflow_id == workflow_id ) \
+                                   .order_by( step_table.c.order_index )
+        toolbox = trans.app.toolbox
+        tool_versions = [ ( tool_id, getattr( toolbox.tools_by_id.get( tool_id ), 'version', None ) ) for ( tool_id, ) in tool_ids ]
+        key = sha1( repr( ( workflow_id, tool_versions ) ) ).hexdigest()
+        style = render.DEFAULT_STYLE
+        lod = detail == 'lod'
+        labels = not lod or render.labels_visible( style, zoom )
+        if lod or viewport is not None or zoom != 1:
+            key = sha1( repr( ( key, lod, labels, viewport, zoom ) ) ).hexdigest()
         trans.response.set_content_type("image/svg+xml")
-        return canvas.standalone_xml()
+        if self._not_modified( trans, key ):
+            return ""
+        if viewport is None:
+            svg = self.image_cache.get( key )
+            if svg is not None:
+                return svg
+        image = self._workflow_image( trans, workflow_id, tool_versions, lod, style )
+        if viewport is not None:
+            # Tiles are cheap to render from the index and too many to cache.
+            return image.svg( viewport=viewport, zoom=zoom, labels=labels )
+        return self.image_cache.stream( key, image.svg( zoom=zoom, labels=labels ) )
+
+    def _workflow_image( self, trans, workflow_id, tool_versions, lod, style ):
+        """
+        `render.WorkflowImage` of the revision `workflow_id`, chains
+        collapsed if `lod`. The images are kept per revision so that the
+        spatial index of a large workflow is built once for all the tiles
+        requested of it.
+        """
+        model_key = ( workflow_id, repr( tool_versions ), lod, style )
+        image = self.image_models.get( model_key )
+        if image is not None:
+            return image
+        # Only the connections are drawn.
+        workflow = loader.load_full_workflow( trans.sa_session, model, workflow_id, collections=( 'input_connections', ) )
+        steps = []
+        for step in workflow.steps:
+            module = self.module_cache.from_workflow_step( trans, step )
+            if module is None:
+                steps.append( render.StepImage( "Unrecognized Tool: %s" % step.tool_id, step.position['left'], step.position['top'], [], [], style=style ) )
+                continue
+            inputs = [ ( input['name'], input['label'] ) for input in module.get_data_inputs() ]
+            outputs = [ output['name'] for output in module.get_data_outputs() ]
+            steps.append( render.StepImage( module.get_name(), step.position['left'], step.position['top'], inputs, outputs, style=style ) )
+        graph = WorkflowGraph.from_steps( workflow.steps )
+        connections = []
+        for target in xrange( len( graph ) ):
+            for input_name, source, output_name in graph.inputs( target ):
+                connections.append( ( source, output_name, target, input_name ) )
+        if lod:
+            steps, connections = render.collapse_chains( steps, connections, style=style )
+        image = render.WorkflowImage( steps, connections, style=style )
+        self.image_models.put( model_key, image )
+        return image
         
         
     @web.expose
@@ -732,33 +742,36 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         }
 
     @web.json
-    def load_workflow( self, trans, id ):
+    def load_workflow( self, trans, id, lazy_forms=False ):
         """
         Get the latest Workflow for the StoredWorkflow identified by `id` and
         encode it as a json string that can be read by the workflow editor
         web interface.
+
+        With `lazy_forms` the form HTML of valid steps is left out and
+        fetched later through `load_step_forms`.
         """
+        lazy_forms = util.string_as_bool( lazy_forms )
         user = trans.get_user()
         id = trans.security.decode_id( id )
         trans.workflow_building_mode = True
         # Load encoded workflow from database
         stored = trans.sa_session.query( model.StoredWorkflow ).get( id )
         assert stored.user == user
-        workflow = stored.latest_workflow
+        workflow = self._load_full_workflow( trans, stored )
+        step_annotations = self._get_step_annotations( trans, trans.user, workflow )
         # Pack workflow data into a dictionary and return
         data = {}
         data['name'] = workflow.name
         data['steps'] = {}
         data['upgrade_messages'] = {}
+        data['lazy_forms'] = lazy_forms
         # For each step, rebuild the form and encode the state
         for step in workflow.steps:
             # Load from database representation
             module = module_factory.from_workflow_step( trans, step )
             if not module:
-                step_annotation = self.get_item_annotation_obj( trans.sa_session, trans.user, step )
-                annotation_str = ""
-                if step_annotation:
-                    annotation_str = step_annotation.annotation
+                annotation_str = step_annotations.get( step.id, "" )
                 invalid_tool_form_html = """<div class="toolForm tool-node-error"><div class="toolFormTitle form-row-error">Unrecognized Tool: %s</div><div class="toolFormBody"><div class="form-row">
                                             The tool id '%s' for this tool is unrecognized.<br/><br/>To save this workflow, you will need to delete this step or enable the tool.
                                             </div></div></div>""" % (step.tool_id, step.tool_id)
@@ -790,10 +803,7 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                 #        as a dictionary not just the values
                 data['upgrade_messages'][step.order_index] = upgrade_message.values()
             # Get user annotation.
-            step_annotation = self.get_item_annotation_obj( trans.sa_session, trans.user, step )
-            annotation_str = ""
-            if step_annotation:
-                annotation_str = step_annotation.annotation
+            annotation_str = step_annotations.get( step.id, "" )
             # Pack attributes into plain dictionary
             step_dict = {
                 'id': step.order_index,
@@ -805,20 +815,18 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                 'tool_errors': module.get_errors(),
                 'data_inputs': module.get_data_inputs(),
                 'data_outputs': module.get_data_outputs(),
-                'form_html': module.get_config_form(),
+                'form_html': None,
                 'annotation' : annotation_str,
                 'post_job_actions' : {},
                 'workflow_outputs' : []
             }
+            if not lazy_forms:
+                step_dict['form_html'] = module.get_config_form()
             # Connections
             input_connections = step.input_connections
             if step.type is None or step.type == 'tool':
                 # Determine full (prefixed) names of valid input datasets
-                data_input_names = {}
-                def callback( input, value, prefixed_name, prefixed_label ):
-                    if isinstance( input, DataToolParameter ):
-                        data_input_names[ prefixed_name ] = True
-                visit_input_values( module.tool.inputs, module.state.inputs, callback )
+                data_input_names = index_for_tool( module.tool ).data_input_names( module.state.inputs )
                 # Filter
                 # FIXME: this removes connection without displaying a message currently!
                 input_connections = [ conn for conn in input_connections if conn.input_name in data_input_names ]
@@ -846,6 +854,55 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             data['steps'][step.order_index] = step_dict
         return data
 
+    @web.expose
+    def load_step_forms( self, trans, id, steps="" ):
+        """
+        Form HTML of the steps of the latest Workflow of the StoredWorkflow
+        identified by `id`, for an editor opened with `load_workflow` and
+        `lazy_forms`. `steps` lists order indexes separated by commas, e.g.
+        the steps currently visible; the result maps each to its form.
+
+        Saved steps never change, so the response is cached by the browser
+        under an ETag of the step ids and the versions of their tools.
+        """
+        user = trans.get_user()
+        stored = trans.sa_session.query( model.StoredWorkflow ).get( trans.security.decode_id( id ) )
+        assert stored.user == user
+        trans.workflow_building_mode = True
+        try:
+            wanted = set( [ int( order_index ) for order_index in steps.split( ',' ) if order_index.strip() ] )
+        except ValueError:
+            error( "Invalid steps" )
+        selected = [ step for step in stored.latest_workflow.steps if step.order_index in wanted ]
+        toolbox = trans.app.toolbox
+        revision = [ ( step.id, step.tool_id, getattr( toolbox.tools_by_id.get( step.tool_id ), 'version', None ) ) for step in selected ]
+        trans.response.headers[ "Cache-Control" ] = "private, max-age=%d" % STEP_FORM_MAX_AGE
+        if self._not_modified( trans, sha1( repr( revision ) ).hexdigest() ):
+            return ""
+        forms = {}
+        for step in selected:
+            module = module_factory.from_workflow_step( trans, step )
+            if not module:
+                # Unrecognized tools come with their form in load_workflow.
+                continue
+            # The form shows the state as load_workflow upgraded it.
+            module.check_and_update_state()
+            forms[ step.order_index ] = module.get_config_form()
+        trans.response.set_content_type( "text/javascript" )
+        return simplejson.dumps( forms )
+
+    def _not_modified( self, trans, digest ):
+        """
+        Send `digest` as the ETag of the response. If the client already
+        holds that version, turn the response into a 304 and return True.
+        """
+        etag = '"%s"' % digest
+        trans.response.headers[ "ETag" ] = etag
+        if etag in [ tag.strip() for tag in trans.request.headers.get( "If-None-Match", "" ).split( ',' ) ]:
+            trans.response.status = 304
+            return True
+        return False
+
     @web.json
     def save_workflow( self, trans, id, workflow_data ):
         """
@@ -944,7 +1001,7 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         
     @web.expose
     @web.require_login( "use workflows" )
-    def download_to_wspgrade_file( self, trans, id=None ):
+    def download_to_wspgrade_file( self, trans, id=None, fast=False ):
         """
         Handles download as WS-PGRADE workflow
         """
@@ -956,323 +1013,184 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         stored = trans.sa_session.query( model.StoredWorkflow ).get( id )
         self.security_check( trans.get_user(), stored, False, True )
 
-        # Convert workflow to dict.
-        workflow_dict = self._workflow_to_dict( trans, stored )
-
-        valid_chars = '.0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        sname = stored.name
-        sname = ''.join(c in valid_chars and c or '_' for c in sname)[0:150]
-
-        #methods for the topological sort
-        def add_node(graph, node):
-           #Add a node to the graph if not already exists.
-           if not graph.has_key(node):
-              graph[node] = [0] # 0 = number of arcs coming into this node.
-           return graph
-
-        def add_arc(graph, fromnode, tonode):
-           """ Add an arc to a graph. Can create multiple arcs.
-               The end nodes must already exist.
-           """
-           graph[fromnode].append(tonode)
-           # Update the count of incoming arcs in tonode.
-           graph[tonode][0] = graph[tonode][0] + 1
-           return graph
-
-        def topological_sort(items, partial_order):
-           """ Perform topological sort.
-           """
-
-           # step 1 - create a directed graph with an arc a->b for each input
-           # pair (a,b).
-           graph = {}
-           for v in items:
-              graph = add_node(graph, v)
-           for a,b in partial_order:
-              graph = add_arc(graph, a, b)
-
-           # Step 2 - find all roots (nodes with zero incoming arcs).
-           roots = [node for (node,nodeinfo) in graph.items() if nodeinfo[0] == 0]
-
-           # step 3 - repeatedly emit a root and remove it from the graph. Removing
-           # a node may convert some of the node's direct children into roots.
-           sorted = []
-           while len(roots) != 0:
-              root = roots.pop()
-              sorted.append(root)
-              for child in graph[root][1:]:
-                 graph[child][0] = graph[child][0] - 1
-                 if graph[child][0] == 0:
-                    roots.append(child)
-              del graph[root]
-           if len(graph.items()) != 0:
-           # There is a loop in the input.
-              return None
-           return sorted
-
-        # Create nodes_order, input_nodes and partial_order 
-        nodes_order = []
-        input_nodes = []
-        partial_order = []
-        for step_num, step in workflow_dict['steps'].items():
-           if step['type'] == "tool" or step['type'] is None:
-              nodes_order.append(step['id'])
-           if step['type'] == "data_input":
-              input_nodes.append(step['id'])
-
-        for step_num, step in workflow_dict['steps'].items():
-           for input_name, input_connection in step['input_connections'].items():
-              if input_connection['id'] not in input_nodes:
-                 partial_order.append( (input_connection['id'], step['id']) )
-
-        #execute topological sort
-        nodes_order = topological_sort(nodes_order, partial_order)
-
-        graph = {}
-        for v in nodes_order:
-           graph = add_node(graph, v)
-        for a,b in partial_order:
-           graph = add_arc(graph, a, b)
-
-        #sort parents directly before children
-        i = 0
-        while i < len(nodes_order):
-           if graph[nodes_order[i]][0] == 0 and len(graph[nodes_order[i]]) > 1:
-              col = nodes_order.index(graph[nodes_order[i]][1])
-              for j in range(2, len(graph[nodes_order[i]])):
-                 if col > nodes_order.index(graph[nodes_order[i]][j]):
-                    col = nodes_order.index(graph[nodes_order[i]][j])
-              if col-i > 1:
-                 nodes_order.insert(col,nodes_order[i])
-                 nodes_order.pop(i)
-                 i = -1
-           i += 1
-
-        #create graph with nodes of parents
-        graph_parents = {}
-        for v in nodes_order:
-           graph_parents = add_node(graph_parents, v)
-        for a,b in partial_order:
-           graph_parents = add_arc(graph_parents, b, a)
-
-        #calculate coordinates for WSPGRADE workflow
-        x_max = -100
-		dist = 120
-		y_max = 20
-        x = []
-        y = []
-        id = []
-
-        for i in range(len(nodes_order)):
-           parents_list = graph_parents[nodes_order[i]]
-           parents_list.pop(0)
-           if len(parents_list) == 0:
-              x_max += dist
-              id.append(nodes_order[i])
-              x.append(x_max)
-              y.append(y_max)
-           else:
-              x_new = x[id.index(parents_list[0])]
-              y_new = y[id.index(parents_list[0])]
-              if len(parents_list) == 1:
-                 y_new += dist
-              for j in range(1, len(parents_list)):
-                 if x_new == x[id.index(parents_list[j])]:
-                    x_new += dist
-                 elif x_new < x[id.index(parents_list[j])]:
-                    x_new = x[id.index(parents_list[j])]
-                 if y_new == y[id.index(parents_list[j])]:
-                    y_new += dist
-                 elif y_new < y[id.index(parents_list[j])]:
-                    y_new = y[id.index(parents_list[j])]
-              for j in range(len(id)):
-                 if x[j] == x_new and y[j] == y_new:
-                    x_new += dist
-              if x_max < x_new:
-                 x_max = x_new
-              id.append(nodes_order[i])
-              x.append(x_new)
-              y.append(y_new)
-
-        #insert coordinates and port ids
-        for step_num, step in workflow_dict['steps'].items():
-           if step['type'] == "tool" or step['type'] is None:
-              step['position']['left'] = x[nodes_order.index(step['id'])]
-              step['position']['top'] = y[nodes_order.index(step['id'])]
-              step['param'] = ''
-              version = step['tool_version'].rstrip(' abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ()')
-              step['tool_version'] = version
-              for input in step['inputs']:
-                 step['param'] += '-' + input['name'] + ' '
-              i = 0
-              for input_name, input_connection in step['input_connections'].items():
-                 input_connection['idinput'] = i
-                 i += 1
-              for output in step['outputs']:
-                 output['visited'] = 0
-                 output['id'] = i
-                 i += 1
-
-        #insert prejob and preoutput 
-        for step_num, step in workflow_dict['steps'].items():
-           if step['type'] == "tool" or step['type'] is None:
-              for input_name, input_connection in step['input_connections'].items():
-                 if input_connection['id'] in input_nodes:
-                    input_connection['prejob'] = ""
-                    input_connection['preoutput'] = ""
-                 else:
-                    parent_step = workflow_dict['steps'][input_connection['id']]
-                    input_connection['prejob'] = parent_step['name'] + parent_step['tool_version']
-                    for output in parent_step['outputs']:
-                       if output['name'] == input_connection['output_name']:
-                          input_connection['preoutput'] = output['id']
+        sname = self._wspgrade_name( stored )
+        compression = self._wspgrade_compression( fast )
+        trans.response.set_content_type( "application/x-zip-compressed" )
+        trans.response.headers[ "Content-Disposition" ] = "attachment; filename=gUSE%s.zip" % sname
+        config = trans.app.config
+        timer = wspgrade.PhaseTimer()
 
-        # calculate port coordinates
-        def ccw(portA, portB, portC):
-           return (portC[1]-portA[1])*(portB[0]-portA[0]) > (portB[1]-portA[1])*(portC[0]-portA[0])
+        # The archive only changes with the latest revision and the annotations.
+        cache = self.wspgrade_cache
+        with timer.phase( 'cache' ):
+            key = self._wspgrade_cache_key( trans, stored, sname, compression )
+            data = cache.get( key )
+        if data is not None:
+            timer.count( cached=1, bytes=len( data ) )
+            self._wspgrade_report_timing( trans, stored, timer )
+            trans.response.headers[ "Content-Length" ] = str( len( data ) )
+            return data
 
-        def intersect(portA, portB, portC, portD):
-           return ccw(portA,portC,portD) != ccw(portB,portC,portD) and ccw(portA,portB,portC) != ccw(portA,portB,portD)
+        # Convert workflow to dict.
+        with timer.phase( 'to_dict' ):
+            workflow_dict = self._workflow_to_dict( trans, stored )
+        timer.count( cached=0, steps=len( workflow_dict['steps'] ),
+                     edges=sum( [ len( step['input_connections'] ) for step in workflow_dict['steps'].values() ] ) )
 
-        x_port = [-15, -15, -15, -15, 0, 15, 30, 45, 60, 60, 60, 60, 0, 15, 30, 45]
-        y_port = [45, 30, 15, 0, -15, -15, -15, -15, 0, 15, 30, 45, 60, 60, 60, 60]
-        coord = {}
-        for j in range(len(nodes_order)):
-           coord[j] = []
-        j = len(nodes_order) - 1
-        while j >= 0:
-           step = workflow_dict['steps'][nodes_order[j]]
-           for output in step['outputs']:
-              if output['visited'] == 0:
-                 port = (step['position']['left']+45, step['position']['top']+60)
-                 i = 14 
-                 while port in coord[j] and i >= 0:
-                    port = (step['position']['left'] + x_port[i], step['position']['top'] + y_port[i])
-                    i -= 1
-                 output['x'] = port[0]
-                 output['y'] = port[1]
-                 output['visited'] = 1
-                 coord[j].append(port)
-             
-           ports_order_index = []
-           for input_name, input_connection in step['input_connections'].items():
-              if input_connection['id'] not in input_nodes:
-                 parent_step = workflow_dict['steps'][input_connection['id']]
-                 ports_order_index.append( (int(input_connection['id']), parent_step['position']['left'], parent_step['position']['top']) )
-           ports_order = []
-           if len(ports_order_index) > 0:
-              ports_order_y = sorted(ports_order_index, key=itemgetter(2), reverse=True)
-              ports_order = sorted(ports_order_y, key=itemgetter(1))
-           for i in range(len(ports_order)):
-              if ports_order[i][2] == step['position']['top']:
-                 ports_order.insert(0, ports_order[i])
-                 ports_order.pop(i+1)
+        # Lay the workflow out on the WS-PGRADE canvas; crossing minimisation
+        # is bounded so that large workflows cannot hang the request.
+        try:
+            engine = wspgrade.layout_workflow( workflow_dict, timer=timer, **self._wspgrade_layout_options( config ) )
+        except wspgrade.CycleError:
+            error( "Workflow cannot be downloaded as WS-PGRADE workflow because it contains cycles" )
+        if engine.crossings.measured:
+            log.debug( "WS-PGRADE layout of workflow %s removed %d of %d edge crossings in %d sweeps%s" % \
+                       ( stored.id, engine.crossings.removed, engine.crossings.before, engine.crossings.sweeps,
+                         engine.crossings.exhausted and " (budget exhausted)" or "" ) )
+        else:
+            log.debug( "WS-PGRADE layout of workflow %s: edge crossings not counted within the time budget" % stored.id )
 
-           for input_name, input_connection in step['input_connections'].items():
-              if input_connection['id'] in input_nodes:
-                 port = (step['position']['left']-15, step['position']['top']+45)
-                 i = 1 
-                 while port in coord[j] and i < len(x_port):
-                    port = (step['position']['left'] + x_port[i], step['position']['top'] + y_port[i])
-                    i += 1
-                 input_connection['x'] = port[0]
-                 input_connection['y'] = port[1]
-                 coord[j].append(port)
+        # Stream workflow.xml into an archive kept in memory up to the
+        # configured size; `fast` trades archive size for CPU time.
+        spool, size = wspgrade.spool_archive( sname, workflow_dict['annotation'], workflow_dict['steps'],
+                                              compression=compression,
+                                              max_size=self._wspgrade_spool_size( config ),
+                                              timer=timer )
+        timer.count( bytes=size )
+        trans.response.headers[ "Content-Length" ] = str( size )
+        if cache.cacheable( size ):
+            try:
+                data = spool.read()
+            finally:
+                spool.close()
+            cache.put( key, data )
+            self._wspgrade_report_timing( trans, stored, timer )
+            return data
+        self._wspgrade_report_timing( trans, stored, timer )
+        return wspgrade.iterate_spool( spool )
 
-           while len(ports_order) > 0:       
-              for input_name, input_connection in step['input_connections'].items():
-                 if len(ports_order) > 0 and input_connection['id'] not in input_nodes:
-                    parent_step = workflow_dict['steps'][input_connection['id']]
-                    if ports_order[0][0] == parent_step['id']:
-                       if step['position']['left'] == parent_step['position']['left']:
-                          port = (step['position']['left']+45, step['position']['top']-15)
-                          i = 5
-                          outport = (parent_step['position']['left']+45, parent_step['position']['top']+60)
-                          k = 14
-                       else: 
-                          port = (step['position']['left']-15, step['position']['top']+45)
-                          i = 1
-                          outport = (parent_step['position']['left']+60, parent_step['position']['top']+45)
-                          k = 10
-                       for output in parent_step['outputs']:
-                          if output['name'] == input_connection['output_name'] and output['visited'] == 0:
-                             while outport in coord[parent_step['id']] and k >= 0:
-                                outport = (parent_step['position']['left'] + x_port[k], parent_step['position']['top'] + y_port[k])
-                                k -= 1
-                             output['x'] = outport[0]
-                             output['y'] = outport[1]
-                             output['visited'] = 1
-                             coord[parent_step['id']].append(outport)
- 
-                       while port in coord[j] and i < len(x_port):
-                          port = (step['position']['left'] + x_port[i], step['position']['top'] + y_port[i])
-                          i += 1
-                       input_connection['x'] = port[0]
-                       input_connection['y'] = port[1]
-                       coord[j].append(port)
-                       ports_order.pop(0)
-                       
-           j -= 1
+    @web.json
+    @web.require_admin
+    def wspgrade_timings( self, trans ):
+        """
+        Count, mean, p50, p95 and maximum duration in ms of every phase of
+        the recent WS-PGRADE downloads; 'total' covers the conversions and
+        'cached_total' the downloads served from the cache.
+        """
+        return self.wspgrade_timings_registry.summary()
 
-        # remove intersections on input_connections ports 
-        for step_num, step in workflow_dict['steps'].items():
-           input_ports = []
-           output_ports = []    
-           if len(step['input_connections']) > 1:
-              for input_name, input_connection in step['input_connections'].items():
-                 parent_step = workflow_dict['steps'][input_connection['id']]
-                 for output in parent_step['outputs']:
-                    if output['name'] == input_connection['output_name']:
-                       input_ports.append( (input_connection['x'], input_connection['y']) )
-                       output_ports.append( (output['x'], output['y']) )
-              for i in range(len(input_ports)-1):
-                 for j in range(i+1, len(input_ports)):
-                    if intersect(input_ports[i], output_ports[i], input_ports[j], output_ports[j]):
-                       buffer_port = input_ports[i]
-                       input_ports[i] = input_ports[j]
-                       input_ports[j] = buffer_port
-              i = 0
-              for input_name, input_connection in step['input_connections'].items():
-                 parent_step = workflow_dict['steps'][input_connection['id']]
-                 for output in parent_step['outputs']:
-                    if output['name'] == input_connection['output_name']:
-                       input_connection['x'] = input_ports[i][0]
-                       input_connection['y'] = input_ports[i][1]
-                       i += 1
+    @web.expose
+    @web.require_login( "use workflows" )
+    def download_to_wspgrade_bulk( self, trans, id=None, fast=False ):
+        """
+        Download several workflows as one zip holding a WS-PGRADE archive per
+        workflow. Workflows that cannot be converted are listed in an error
+        report inside the zip instead of failing the whole download.
+        """
+        ids = util.listify( id )
+        if not ids:
+            error( "No workflows selected for download" )
+        trans.workflow_building_mode = True
+        config = trans.app.config
+        compression = self._wspgrade_compression( fast )
+        layout_options = self._wspgrade_layout_options( config )
+        cache = self.wspgrade_cache
+        archives = []
+        # Errors are reported by encoded id, followed by the name of the
+        # workflow once it is known to be accessible.
+        errors = []
+        jobs = []
+        # (file name, cache key) of each job.
+        pending = []
+        file_names = set()
+        for encoded_id in ids:
+            try:
+                stored = trans.sa_session.query( model.StoredWorkflow ).get( trans.security.decode_id( encoded_id ) )
+                self.security_check( trans.get_user(), stored, False, True )
+            except Exception:
+                errors.append( ( encoded_id, "workflow cannot be accessed" ) )
+                continue
+            label = '%s "%s"' % ( encoded_id, stored.name )
+            sname = self._wspgrade_name( stored )
+            # One archive per workflow, even if several share a name.
+            file_name = "gUSE%s.zip" % sname
+            count = 1
+            while file_name in file_names:
+                count += 1
+                file_name = "gUSE%s_%d.zip" % ( sname, count )
+            file_names.add( file_name )
+            key = self._wspgrade_cache_key( trans, stored, sname, compression )
+            data = cache.get( key )
+            if data is not None:
+                archives.append( ( file_name, data ) )
+                continue
+            try:
+                workflow_dict = self._workflow_to_dict( trans, stored )
+            except Exception:
+                log.exception( "Could not load workflow %s for WS-PGRADE download" % stored.id )
+                errors.append( ( label, "workflow cannot be loaded" ) )
+                continue
+            pending.append( ( file_name, key ) )
+            jobs.append( ( label, sname, workflow_dict, compression, layout_options ) )
+        # Only the conversion runs in the pool; it needs no database access.
+        for ( file_name, key ), ( label, data, message ) in zip( pending, self.wspgrade_pool.convert_all( jobs ) ):
+            if message is None:
+                cache.put( key, data )
+                archives.append( ( file_name, data ) )
+            else:
+                errors.append( ( label, message ) )
+        spool = tempfile.SpooledTemporaryFile( max_size=self._wspgrade_spool_size( config ) )
+        try:
+            wspgrade.write_bulk_archive( spool, archives, errors )
+            size = spool.tell()
+            spool.seek( 0 )
+        except:
+            spool.close()
+            raise
+        trans.response.set_content_type( "application/x-zip-compressed" )
+        trans.response.headers[ "Content-Disposition" ] = "attachment; filename=gUSE_workflows.zip"
+        trans.response.headers[ "Content-Length" ] = str( size )
+        return wspgrade.iterate_spool( spool )
 
-        # Create workflow content XML.
-        workflow_content = trans.fill_template( "workflow/wspgrade_download_content.mako", \
-                                                 workflow_name=sname, \
-                                                 workflow_description=workflow_dict['annotation'], \
-                                                 workflow_steps=workflow_dict['steps'] ) 
-        
-        workflow_xml = trans.fill_template( "workflow/wspgrade_download.mako", \
-                                            workflow_name=sname, \
-                                            workflow_description=workflow_dict['annotation'], \
-                                            workflow_content=workflow_content )
+    def _wspgrade_name( self, stored ):
+        """
+        Name of the WS-PGRADE workflow and archive for `stored`.
+        """
+        return wspgrade.archive_name( stored.name )
 
-        workflow_wspgrade = workflow_xml.strip()
+    def _wspgrade_compression( self, fast ):
+        if util.string_as_bool( fast ):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
 
-        # create zip file
-        tmpd = tempfile.mkdtemp()
-        tmpf = os.path.join( tmpd, 'workflow.zip' )
-        file = zipfile.ZipFile(tmpf, 'w', zipfile.ZIP_DEFLATED)
+    def _wspgrade_layout_options( self, config ):
+        return dict( max_sweeps=int( getattr( config, 'wspgrade_crossing_sweeps', wspgrade.MAX_SWEEPS ) ),
+                     time_limit=float( getattr( config, 'wspgrade_crossing_time_limit', wspgrade.TIME_LIMIT ) ) )
 
-        info = zipfile.ZipInfo('workflow.xml')
-        info.compress_type = zipfile.ZIP_DEFLATED
-        info.external_attr = 0644 << 16L
-        file.writestr(info, workflow_wspgrade)
+    def _wspgrade_spool_size( self, config ):
+        return int( getattr( config, 'wspgrade_spool_max_size', wspgrade.SPOOL_MAX_SIZE ) )
 
-        info = zipfile.ZipInfo(sname+'/')
-        info.compress_type = zipfile.ZIP_DEFLATED
-        info.external_attr = 040755 << 16L
-        file.writestr(info, '')
-        file.close()
+    def _wspgrade_report_timing( self, trans, stored, timer ):
+        """
+        Log the phase durations of a download, add them to the aggregate
+        timings and, if configured, send them as a Server-Timing header.
+        """
+        log.debug( "WS-PGRADE download of workflow %s: %s" % ( stored.id, timer.format() ) )
+        self.wspgrade_timings_registry.record( timer )
+        if util.string_as_bool( getattr( trans.app.config, 'wspgrade_server_timing', False ) ):
+            trans.response.headers[ "Server-Timing" ] = timer.server_timing()
 
-        tmpfh = open( tmpf )
-        trans.response.set_content_type( "application/x-zip-compressed" )
-        trans.response.headers[ "Content-Disposition" ] = "attachment; filename=gUSE%s.zip" % sname 
-        return tmpfh
+    def _wspgrade_cache_key( self, trans, stored, sname, compression ):
+        """
+        Cache key of the archive of `stored` as seen by the current user.
+        """
+        annotations = [ self.get_item_annotation_str( trans.sa_session, trans.user, stored ) ]
+        step_annotations = self._get_step_annotations( trans, trans.user, stored.latest_workflow )
+        for step in stored.latest_workflow.steps:
+            annotations.append( step_annotations.get( step.id ) )
+        user = trans.get_user()
+        return wspgrade.archive_key( stored.id, stored.latest_workflow.id, user and user.id, sname,
+                                     wspgrade.fingerprint( annotations ), compression )
         
 
     @web.expose
@@ -1451,26 +1369,72 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             trans.set_message( "Workflow '%s' imported" % workflow.name )
         return self.list( trans )
         
-    @web.json
+    @web.expose
+    @web.require_login( "use workflows" )
+    def import_from_wspgrade( self, trans, archive=None, **kwargs ):
+        """
+        Imports a workflow from a WS-PGRADE (gUSE) workflow archive.
+        """
+        if archive is None or not hasattr( archive, 'file' ):
+            return trans.fill_template( "workflow/import_wspgrade.mako", message=None, status=None )
+        trans.workflow_building_mode = True
+        tool_ids = wspgrade.tool_index( trans.app.toolbox.tools_by_id.values() )
+        try:
+            data = wspgrade.workflow_dict_from_archive( archive.file, tool_ids )
+        except wspgrade.ArchiveError, e:
+            return trans.fill_template( "workflow/import_wspgrade.mako",
+                                        message="The file cannot be imported as a WS-PGRADE workflow: %s" % e,
+                                        status="error" )
+        # Jobs carry no tool parameters; every tool starts from its defaults.
+        default_states = {}
+        for step_dict in data['steps'].itervalues():
+            tool_id = step_dict['tool_id']
+            if step_dict['type'] == 'tool':
+                if tool_id not in default_states:
+                    module = module_factory.new( trans, 'tool', tool_id=tool_id )
+                    default_states[ tool_id ] = module.get_state( secure=False )
+                step_dict['tool_state'] = default_states[ tool_id ]
+        # Create workflow; all steps are persisted with a single flush.
+        workflow = self._workflow_from_dict( trans, data, source="WS-PGRADE archive" ).latest_workflow
+        if workflow.has_cycles:
+            trans.set_message( "Imported, but this workflow contains cycles", type="warning" )
+        else:
+            trans.set_message( "Workflow '%s' imported" % workflow.name )
+        return self.list( trans )
+
+    @web.expose
     def get_datatypes( self, trans ):
-        ext_to_class_name = dict()
-        classes = []
-        for k, v in trans.app.datatypes_registry.datatypes_by_extension.iteritems():
-            c = v.__class__
-            ext_to_class_name[k] = c.__module__ + "." + c.__name__
-            classes.append( c )
-        class_to_classes = dict()
-        def visit_bases( types, cls ):
-            for base in cls.__bases__:
-                if issubclass( base, Data ):
-                    types.add( base.__module__ + "." + base.__name__ )
-                visit_bases( types, base )
-        for c in classes:      
-            n =  c.__module__ + "." + c.__name__
-            types = set( [ n ] )
-            visit_bases( types, c )
-            class_to_classes[ n ] = dict( ( t, True ) for t in types )
-        return dict( ext_to_class_name=ext_to_class_name, class_to_classes=class_to_classes )
+        """
+        Datatype classes by extension and the datatype base classes of each
+        class, as JSON. The response is built once per state of the datatypes
+        registry and sent gzip compressed if the client accepts it, with an
+        ETag the client can revalidate.
+        """
+        payload = self._datatypes_payload( trans )
+        trans.response.set_content_type( "text/javascript" )
+        trans.response.headers[ "Vary" ] = "Accept-Encoding"
+        gzip_accepted = 'gzip' in trans.request.headers.get( "Accept-Encoding", "" )
+        if gzip_accepted:
+            digest = payload.digest + "-gzip"
+        else:
+            digest = payload.digest
+        if self._not_modified( trans, digest ):
+            return ""
+        if gzip_accepted:
+            trans.response.headers[ "Content-Encoding" ] = "gzip"
+            return payload.compressed
+        return payload.json
+
+    def _datatypes_payload( self, trans ):
+        """
+        The `DatatypesPayload` of the current datatypes registry, rebuilt
+        when datatypes have been added, removed or replaced.
+        """
+        registry = trans.app.datatypes_registry
+        payload = self.datatypes_payload
+        if payload is None or payload.registry is not registry or payload.datatypes != registry.datatypes_by_extension:
+            payload = self.datatypes_payload = DatatypesPayload( registry )
+        return payload
     
     @web.expose
     def build_from_current_history( self, trans, job_ids=None, dataset_ids=None, workflow_name=None ):
@@ -1549,10 +1513,10 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             workflow = model.Workflow()
             workflow.name = workflow_name
             # Order the steps if possible
-            attach_ordered_steps( workflow, steps )
+            graph = attach_ordered_steps( workflow, steps )
             # And let's try to set up some reasonable locations on the canvas
             # (these are pretty arbitrary values)
-            levorder = order_workflow_steps_with_levels( steps )
+            levorder = order_workflow_steps_with_levels( steps, graph )
             base_pos = 10
             for i, steps_at_level in enumerate( levorder ):
                 for j, index in enumerate( steps_at_level ):
@@ -1581,7 +1545,7 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                     .filter_by( user=user, stored_workflow=stored ).count() == 0:
                 error( "Workflow is not owned by or shared with current user" )
         # Get the latest revision
-        workflow = stored.latest_workflow
+        workflow = self._load_full_workflow( trans, stored )
         # It is possible for a workflow to have 0 steps
         if len( workflow.steps ) == 0:
             error( "Workflow cannot be run because it does not have any steps" )
@@ -1597,58 +1561,65 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         if kwargs:
             # If kwargs were provided, the states for each step should have
             # been POSTed
-            # Get the kwarg keys for data inputs
-            input_keys = filter(lambda a: a.endswith('|input'), kwargs)
+            # Partition the kwargs by step id (and the workflow parameters
+            # under 'wf_parm') in one pass
+            step_kwargs = {}
+            for key, value in kwargs.iteritems():
+                prefix, sep, name = key.partition( '|' )
+                if sep:
+                    step_kwargs.setdefault( prefix, {} )[ name ] = value
+            # Check if one of the data inputs is a list
             # Example: prefixed='2|input'
-            # Check if one of them is a list
             multiple_input_key = None
             multiple_inputs = [None]
-            for input_key in input_keys:
-                if isinstance(kwargs[input_key], list):
+            for input_key in kwargs:
+                if input_key.endswith( '|input' ) and isinstance( kwargs[input_key], list ):
                     multiple_input_key = input_key
                     multiple_inputs = kwargs[input_key]
+            # PJA Parameter Replacement (only applies to immediate actions-- rename specifically, for now)
+            replacement_dict = step_kwargs.get( 'wf_parm', {} )
+            # Validate the state of every step once, except for the step
+            # taking the list, which is done for each of its inputs
+            batch_step = None
+            if multiple_input_key:
+                batch_prefix, sep, batch_name = multiple_input_key.partition( '|' )
+            for step in workflow.steps:
+                step.upgrade_messages = {}
+                # Connections by input name
+                step.input_connections_by_name = \
+                    dict( ( conn.input_name, conn ) for conn in step.input_connections )
+                if multiple_input_key and str( step.id ) == batch_prefix:
+                    batch_step = step
+                    continue
+                step_errors = self._update_run_state( trans, step, step_kwargs.get( str( step.id ), {} ) )
+                if step.upgrade_messages:
+                    has_upgrade_messages = True
+                if step_errors:
+                    errors[step.id] = step.state.inputs["__errors__"] = step_errors
+            # Running a tool step fills its state with the actual datasets,
+            # so every run gets a copy of the validated state
+            templates = dict( ( step.id, step.state ) for step in workflow.steps
+                              if ( step.type == 'tool' or step.type is None ) and step is not batch_step )
             # List to gather values for the template
             invocations=[]
+            # Invocations to submit to the scheduler once recorded, with the
+            # encoded step states, which are the same for every input but
+            # that of the batch step
+            queued = []
+            encoded_states = None
             for input_number, single_input in enumerate(multiple_inputs):
                 # Example: single_input='1', single_input='2', etc...
                 # 'Fix' the kwargs, to have only the input for this iteration
                 if multiple_input_key:
                     kwargs[multiple_input_key] = single_input
-                for step in workflow.steps:
-                    step.upgrade_messages = {}
-                    # Connections by input name
-                    step.input_connections_by_name = \
-                        dict( ( conn.input_name, conn ) for conn in step.input_connections ) 
-                    # Extract just the arguments for this step by prefix
-                    p = "%s|" % step.id
-                    l = len(p)
-                    step_args = dict( ( k[l:], v ) for ( k, v ) in kwargs.iteritems() if k.startswith( p ) )
-                    step_errors = None
-                    if step.type == 'tool' or step.type is None:
-                        module = module_factory.from_workflow_step( trans, step )
-                        # Fix any missing parameters
-                        step.upgrade_messages = module.check_and_update_state()
-                        if step.upgrade_messages:
-                            has_upgrade_messages = True
-                        # Any connected input needs to have value DummyDataset (these
-                        # are not persisted so we need to do it every time)
-                        module.add_dummy_datasets( connections=step.input_connections )    
-                        # Get the tool
-                        tool = module.tool
-                        # Get the state
-                        step.state = state = module.state
-                        # Get old errors
-                        old_errors = state.inputs.pop( "__errors__", {} )
-                        # Update the state
-                        step_errors = tool.update_state( trans, tool.inputs, step.state.inputs, step_args,
-                                                         update_only=True, old_errors=old_errors )
-                    else:
-                        # Fix this for multiple inputs
-                        module = step.module = module_factory.from_workflow_step( trans, step )
-                        state = step.state = module.decode_runtime_state( trans, step_args.pop( "tool_state" ) )
-                        step_errors = module.update_runtime_state( trans, state, step_args )
+                if batch_step is not None:
+                    step_args = dict( step_kwargs[ batch_prefix ] )
+                    step_args[ batch_name ] = single_input
+                    step_errors = self._update_run_state( trans, batch_step, step_args )
+                    if batch_step.upgrade_messages:
+                        has_upgrade_messages = True
                     if step_errors:
-                        errors[step.id] = state.inputs["__errors__"] = step_errors   
+                        errors[batch_step.id] = batch_step.state.inputs["__errors__"] = step_errors
                 if 'run_workflow' in kwargs and not errors:
                     new_history = None
                     if 'new_history' in kwargs:
@@ -1660,51 +1631,40 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                             nh_name = '%s %d' % (nh_name, input_number + 1)
                         new_history = trans.app.model.History( user=trans.user, name=nh_name )
                         trans.sa_session.add( new_history )
-                    # Run each step, connecting outputs to inputs
                     workflow_invocation = model.WorkflowInvocation()
                     workflow_invocation.workflow = workflow
-                    outputs = odict()
-                    for i, step in enumerate( workflow.steps ):
-                        # Execute module
-                        job = None
-                        if step.type == 'tool' or step.type is None:
-                            tool = trans.app.toolbox.tools_by_id[ step.tool_id ]
-                            input_values = step.state.inputs
-                            # Connect up
-                            def callback( input, value, prefixed_name, prefixed_label ):
-                                if isinstance( input, DataToolParameter ):
-                                    if prefixed_name in step.input_connections_by_name:
-                                        conn = step.input_connections_by_name[ prefixed_name ]
-                                        return outputs[ conn.output_step.id ][ conn.output_name ]
-                            visit_input_values( tool.inputs, step.state.inputs, callback )
-                            # Execute it
-                            job, out_data = tool.execute( trans, step.state.inputs, history=new_history)
-                            outputs[ step.id ] = out_data
-                            # Create new PJA associations with the created job, to be run on completion.
-                            # PJA Parameter Replacement (only applies to immediate actions-- rename specifically, for now)
-                            # Pass along replacement dict with the execution of the PJA so we don't have to modify the object.
-                            replacement_dict = {}
-                            for k, v in kwargs.iteritems():
-                                if k.startswith('wf_parm|'):
-                                    replacement_dict[k[8:]] = v
-                            for pja in step.post_job_actions:
-                                if pja.action_type in ActionBox.immediate_actions:
-                                    ActionBox.execute(trans.app, trans.sa_session, pja, job, replacement_dict)
-                                else:
-                                    job.add_post_job_action(pja)
-                        else:
-                            job, out_data = step.module.execute( trans, step.state )
-                            outputs[ step.id ] = out_data
-                        # Record invocation
-                        workflow_invocation_step = model.WorkflowInvocationStep()
-                        workflow_invocation_step.workflow_invocation = workflow_invocation
-                        workflow_invocation_step.workflow_step = step
-                        workflow_invocation_step.job = job
-                    # All jobs ran sucessfully, so we can save now
                     trans.sa_session.add( workflow_invocation )
+                    if self.scheduler.workers:
+                        # The steps are executed in the background once the
+                        # invocation is recorded
+                        if encoded_states is None:
+                            encoded_states = dict( ( step.id, execution.encode_step_state( trans, step ) )
+                                                   for step in workflow.steps if step is not batch_step )
+                        states = dict( encoded_states )
+                        if batch_step is not None:
+                            states[ batch_step.id ] = execution.encode_step_state( trans, batch_step )
+                        queued.append( ( workflow_invocation, new_history or trans.get_history(), states ) )
+                        continue
+                    # Run each step, connecting outputs to inputs
+                    for step in workflow.steps:
+                        if step.id in templates:
+                            step.state = copy_tool_state( templates[ step.id ] )
+                    outputs = execution.execute_steps( trans, workflow_invocation, workflow.steps, new_history, replacement_dict )
+                    # All jobs ran sucessfully, so we can save now
                     invocations.append({'outputs': outputs,
                                         'new_history': new_history})
             trans.sa_session.flush()
+            if queued:
+                galaxy_session = trans.get_galaxy_session()
+                for workflow_invocation, history, states in queued:
+                    request = scheduler.InvocationRequest( workflow_invocation.id, trans.user.id, history.id,
+                                                           galaxy_session and galaxy_session.id, states, replacement_dict,
+                                                           execution.request_origin( trans ) )
+                    self.scheduler.submit( request )
+                    invocations.append( { 'id': workflow_invocation.id, 'history': history } )
+                return trans.fill_template( "workflow/run_queued.mako",
+                                            workflow=stored,
+                                            invocations=invocations )
             return trans.fill_template( "workflow/run_complete.mako",
                                         workflow=stored,
                                         invocations=invocations )
@@ -1752,6 +1712,66 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                     errors=errors,
                     incoming=kwargs )
     
+    @web.json
+    @web.require_login( "use Galaxy workflows" )
+    def invocation_status( self, trans, id ):
+        """
+        Progress of the workflow invocation `id` submitted by `run`: its
+        state (queued, running, ok or error) and the number of steps
+        executed, as recorded by the scheduler. Invocations executed within
+        the request are 'ok' if all their steps were recorded.
+        """
+        try:
+            invocation_id = trans.security.decode_id( id )
+        except Exception:
+            error( "Invalid invocation id" )
+        workflow_invocation = trans.sa_session.query( model.WorkflowInvocation ).get( invocation_id )
+        if workflow_invocation is None:
+            error( "Invalid invocation id" )
+        stored = workflow_invocation.workflow.stored_workflow
+        user = trans.get_user()
+        if stored.user != user:
+            if trans.sa_session.query( model.StoredWorkflowUserShareAssociation ) \
+                    .filter_by( user=user, stored_workflow=stored ).count() == 0:
+                error( "Workflow is not owned by or shared with current user" )
+        status = self.scheduler.status( invocation_id )
+        if status is not None:
+            del status[ 'user_id' ]
+            rval = status
+        else:
+            steps_total = len( workflow_invocation.workflow.steps )
+            steps_done = len( workflow_invocation.steps )
+            rval = dict( state=( steps_done == steps_total and scheduler.OK or 'unknown' ), steps_done=steps_done, steps_total=steps_total )
+        rval[ 'id' ] = id
+        return rval
+
+    def _update_run_state( self, trans, step, step_args ):
+        """
+        Build the module and state of `step` for running it from its
+        persisted state updated with `step_args`, the posted arguments of
+        the step without their prefix. Returns the errors in the state.
+        """
+        step_args = dict( step_args )
+        if step.type == 'tool' or step.type is None:
+            module = module_factory.from_workflow_step( trans, step )
+            # Fix any missing parameters
+            step.upgrade_messages = module.check_and_update_state()
+            # Any connected input needs to have value DummyDataset (these
+            # are not persisted so we need to do it every time)
+            module.add_dummy_datasets( connections=step.input_connections )
+            # Get the tool
+            tool = module.tool
+            # Get the state
+            step.state = state = module.state
+            # Get old errors
+            old_errors = state.inputs.pop( "__errors__", {} )
+            # Update the state
+            return tool.update_state( trans, tool.inputs, state.inputs, step_args,
+                                      update_only=True, old_errors=old_errors )
+        module = step.module = module_factory.from_workflow_step( trans, step )
+        state = step.state = module.decode_runtime_state( trans, step_args.pop( "tool_state" ) )
+        return module.update_runtime_state( trans, state, step_args )
+
     @web.expose
     def tag_outputs( self, trans, id, **kwargs ):
         stored = self.get_stored_workflow( trans, id, check_ownership=False )
@@ -1761,7 +1781,7 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                     .filter_by( user=user, stored_workflow=stored ).count() == 0:
                 error( "Workflow is not owned by or shared with current user" )
         # Get the latest revision
-        workflow = stored.latest_workflow
+        workflow = self._load_full_workflow( trans, stored )
         # It is possible for a workflow to have 0 steps
         if len( workflow.steps ) == 0:
             error( "Workflow cannot be tagged for outputs because it does not have any steps" )
@@ -1871,15 +1891,73 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                                         shared_by_others=shared_by_others,
                                         ids_in_menu=ids_in_menu )
         
+    def _load_full_workflow( self, trans, stored ):
+        """
+        Load the latest revision of `stored` with its steps, their input
+        connections, post job actions and workflow outputs in a number of
+        queries that does not depend on the number of steps (see
+        `galaxy.workflow.loader`).
+        """
+        return loader.load_full_workflow( trans.sa_session, model, stored.latest_workflow_id )
+
+    def _get_step_annotations( self, trans, user, workflow ):
+        """
+        Annotations of `user` on the steps of `workflow` as a dictionary of
+        step id -> annotation. They are fetched with one query and kept for
+        the rest of the request.
+        """
+        if user is None:
+            return {}
+        key = ( user.id, workflow.id )
+        if getattr( trans, 'workflow_step_annotations', None ) is None:
+            trans.workflow_step_annotations = {}
+        if key not in trans.workflow_step_annotations:
+            assoc_table = model.WorkflowStepAnnotationAssociation.table
+            step_table = model.WorkflowStep.table
+            rows = trans.sa_session.query( assoc_table.c.workflow_step_id, assoc_table.c.annotation ) \
+                                   .filter( and_( assoc_table.c.user_id == user.id,
+                                                  assoc_table.c.workflow_step_id == step_table.c.id,
+                                                  step_table.c.workflow_id == workflow.id ) )
+            annotations = {}
+            for step_id, annotation in rows:
+                # Like get_item_annotation_obj, the first annotation wins.
+                annotations.setdefault( step_id, annotation )
+            trans.workflow_step_annotations[ key ] = annotations
+        return trans.workflow_step_annotations[ key ]
+
+    def _copy_step_annotations( self, trans, source_user, target_user, workflow ):
+        """
+        Copy the annotations of `source_user` on the steps of `workflow` to
+        `target_user`, like copy_item_annotation does for a single item. New
+        annotations are added with one bulk insert.
+        """
+        source = self._get_step_annotations( trans, source_user, workflow )
+        target = self._get_step_annotations( trans, target_user, workflow )
+        rows = []
+        for step in workflow.steps:
+            annotation = source.get( step.id )
+            if not annotation:
+                continue
+            annotation = annotation.strip()
+            if step.id in target:
+                if target[ step.id ] != annotation:
+                    self.add_item_annotation( trans.sa_session, target_user, step, annotation )
+            else:
+                rows.append( dict( workflow_step_id=step.id, user_id=target_user.id, annotation=annotation ) )
+            target[ step.id ] = annotation
+        if rows:
+            trans.sa_session.execute( model.WorkflowStepAnnotationAssociation.table.insert(), rows )
+
     def _workflow_to_dict( self, trans, stored ):
         """
         Converts a workflow to a dict of attributes suitable for exporting.
         """
-        workflow = stored.latest_workflow
+        workflow = self._load_full_workflow( trans, stored )
         workflow_annotation = self.get_item_annotation_obj( trans.sa_session, trans.user, stored )
         annotation_str = ""
         if workflow_annotation:
             annotation_str = workflow_annotation.annotation
+        step_annotations = self._get_step_annotations( trans, trans.user, workflow )
         # Pack workflow data into a dictionary and return
         data = {}
         data['a_galaxy_workflow'] = 'true' # Placeholder for identifying galaxy workflow
@@ -1890,12 +1968,9 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
         # For each step, rebuild the form and encode the state
         for step in workflow.steps:
             # Load from database representation
-            module = module_factory.from_workflow_step( trans, step )
+            module = self.module_cache.from_workflow_step( trans, step )
             # Get user annotation.
-            step_annotation = self.get_item_annotation_obj(trans.sa_session, trans.user, step )
-            annotation_str = ""
-            if step_annotation:
-                annotation_str = step_annotation.annotation
+            annotation_str = step_annotations.get( step.id, "" )
                         
             # Step info
             step_dict = {
@@ -1919,15 +1994,8 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
                 step_dict['inputs'].append( { "name" : name, "description" : annotation_str } )
             else:
                 # Step is a tool and may have runtime inputs.
-                for name, val in module.state.inputs.items():
-                    input_type = type( val )
-                    if input_type == RuntimeValue:
-                        step_dict['inputs'].append( { "name" : name, "description" : "runtime parameter for tool %s" % module.get_name() } )
-                    elif input_type == dict:
-                        # Input type is described by a dict, e.g. indexed parameters.
-                        for partname, partval in val.items():
-                            if type( partval ) == RuntimeValue:
-                                step_dict['inputs'].append( { "name" : name, "description" : "runtime parameter for tool %s" % module.get_name() } )
+                for name in index_for_tool( module.tool ).runtime_inputs( module.state.inputs ):
+                    step_dict['inputs'].append( { "name" : name, "description" : "runtime parameter for tool %s" % module.get_name() } )
 
             # User outputs
             step_dict['user_outputs'] = []
@@ -1947,18 +2015,16 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
             # All step outputs
             step_dict['outputs'] = []
             if type( module ) is ToolModule:
-                for output in module.get_data_outputs():
-                    step_dict['outputs'].append( { 'name' : output['name'], 'type' : output['extensions'][0] } )
+                outputs = index_for_tool( module.tool ).outputs
+                if outputs is None:
+                    outputs = [ { 'name' : output['name'], 'type' : output['extensions'][0] } for output in module.get_data_outputs() ]
+                step_dict['outputs'].extend( [ dict( output ) for output in outputs ] )
         
             # Connections
             input_connections = step.input_connections
             if step.type is None or step.type == 'tool':
                 # Determine full (prefixed) names of valid input datasets
-                data_input_names = {}
-                def callback( input, value, prefixed_name, prefixed_label ):
-                    if isinstance( input, DataToolParameter ):
-                        data_input_names[ prefixed_name ] = True
-                visit_input_values( module.tool.inputs, module.state.inputs, callback )
+                data_input_names = index_for_tool( module.tool ).data_input_names( module.state.inputs )
                 # Filter
                 # FIXME: this removes connection without displaying a message currently!
                 input_connections = [ conn for conn in input_connections if conn.input_name in data_input_names ]
@@ -2041,7 +2107,12 @@ class WorkflowController( BaseController, Sharable, UsesStoredWorkflow, UsesAnno
 ## ---- Utility methods -------------------------------------------------------
 
 def attach_ordered_steps( workflow, steps ):
-    ordered_steps = order_workflow_steps( steps )
+    """
+    Attach `steps` to `workflow` in topological order and return the
+    `WorkflowGraph` of `steps` as sorted by `workflow_graph`.
+    """
+    graph = workflow_graph( steps )
+    ordered_steps = order_workflow_steps( steps, graph )
     if ordered_steps:
         workflow.has_cycles = False
         for i, step in enumerate( ordered_steps ):
@@ -2050,43 +2121,69 @@ def attach_ordered_steps( workflow, steps ):
     else:
         workflow.has_cycles = True
         workflow.steps = steps
+    return graph
 
-def edgelist_for_workflow_steps( steps ):
+def workflow_graph( steps ):
     """
-    Create a list of tuples representing edges between `WorkflowSteps` based
-    on associated `WorkflowStepConnection`s
+    Sort `steps` by their distance from the canvas origin, if all of them
+    have a position, and build their `WorkflowGraph`.
     """
-    edges = []
-    steps_to_index = dict( ( step, i ) for i, step in enumerate( steps ) )
-    for step in steps:
-        edges.append( ( steps_to_index[step], steps_to_index[step] ) )
-        for conn in step.input_connections:
-            edges.append( ( steps_to_index[conn.output_step], steps_to_index[conn.input_step] ) )
-    return edges
+    sort_by_position( steps )
+    return WorkflowGraph.from_steps( steps )
 
-def order_workflow_steps( steps ):
+def order_workflow_steps( steps, graph=None ):
     """
     Perform topological sort of the steps, return ordered or None
     """
-    position_data_available = True
-    for step in steps:
-        if not step.position or not 'left' in step.position or not 'top' in step.position:
-            position_data_available = False
-    if position_data_available:
-        steps.sort(cmp=lambda s1,s2: cmp( math.sqrt(s1.position['left']**2 + s1.position['top']**2), math.sqrt(s2.position['left']**2 + s2.position['top']**2)))
+    if graph is None:
+        graph = workflow_graph( steps )
     try:
-        edges = edgelist_for_workflow_steps( steps )
-        node_order = topsort( edges )
-        return [ steps[i] for i in node_order ]
+        return [ steps[i] for i in graph.topological_order() ]
     except CycleError:
         return None
     
-def order_workflow_steps_with_levels( steps ):
+def order_workflow_steps_with_levels( steps, graph=None ):
+    if graph is None:
+        graph = WorkflowGraph.from_steps( steps )
     try:
-        return topsort_levels( edgelist_for_workflow_steps( steps ) )
+        return graph.levels()
     except CycleError:
         return None
     
+class DatatypesPayload( object ):
+    """
+    The `get_datatypes` response for the datatypes of `registry`: the JSON,
+    its gzip compressed form and the digest of the JSON.
+    """
+
+    def __init__( self, registry ):
+        self.registry = registry
+        self.datatypes = dict( registry.datatypes_by_extension )
+        ext_to_class_name = dict()
+        classes = []
+        for k, v in self.datatypes.iteritems():
+            c = v.__class__
+            ext_to_class_name[k] = c.__module__ + "." + c.__name__
+            classes.append( c )
+        class_to_classes = dict()
+        def visit_bases( types, cls ):
+            for base in cls.__bases__:
+                if issubclass( base, Data ):
+                    types.add( base.__module__ + "." + base.__name__ )
+                visit_bases( types, base )
+        for c in classes:      
+            n =  c.__module__ + "." + c.__name__
+            types = set( [ n ] )
+            visit_bases( types, c )
+            class_to_classes[ n ] = dict( ( t, True ) for t in types )
+        self.json = simplejson.dumps( dict( ext_to_class_name=ext_to_class_name, class_to_classes=class_to_classes ), sort_keys=True )
+        self.digest = sha1( self.json ).hexdigest()
+        out = StringIO()
+        compressor = gzip.GzipFile( fileobj=out, mode='wb', mtime=0 )
+        compressor.write( self.json )
+        compressor.close()
+        self.compressed = out.getvalue()
+
 class FakeJob( object ):
     """
     Fake job object for datasets that have no creating_job_associations,
@@ -2173,3 +2270,20 @@ def cleanup_param_values( inputs, values ):
     cleanup( "", inputs, values )
     return associations
     
+
+def copy_tool_state( state ):
+    """
+    Copy of the tool state `state` for one run of a batch: the dicts and
+    lists of its inputs are copied, the parameter values are shared.
+    """
+    copy = DefaultToolState()
+    copy.page = state.page
+    copy.inputs = copy_state_values( state.inputs )
+    return copy
+
+def copy_state_values( values ):
+    if type( values ) == dict:
+        return dict( [ ( key, copy_state_values( value ) ) for key, value in values.iteritems() ] )
+    if type( values ) == list:
+        return [ copy_state_values( value ) for value in values ]
+    return values
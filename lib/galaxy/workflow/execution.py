@@ -0,0 +1,194 @@
+"""
+Execution of the steps of a workflow invocation.
+
+`run()` executes the steps within the request when the scheduler has no
+workers, and a worker of `galaxy.workflow.scheduler` executes them
+otherwise. Workers do not have the web transaction: a request carries the
+ids of the records it needs and the encoded state of every step, and a
+worker loads them in its own database session into a `WorkRequestContext`,
+which provides what executing tools (`DefaultToolAction.execute`) and
+workflow modules use of a transaction.
+"""
+
+from galaxy import model
+from galaxy.tools import DefaultToolState
+from galaxy.tools.parameters import visit_input_values
+from galaxy.tools.parameters.basic import DataToolParameter
+from galaxy.util.odict import odict
+from galaxy.workflow.modules import module_factory
+from galaxy.jobs.actions.post import ActionBox
+
+class WorkRequest( object ):
+    """
+    The parts of the web request tool execution reads: the base URL, host
+    and remote address of the request that submitted the invocation.
+    """
+
+    def __init__( self, base=None, host=None, remote_addr=None ):
+        self.base = base
+        self.host = host
+        self.remote_addr = remote_addr
+        self.headers = {}
+        self.environ = {}
+
+class WorkResponse( object ):
+    """
+    A response nobody reads, for code that sets headers or a status.
+    """
+
+    def __init__( self ):
+        self.headers = {}
+        self.status = 200
+
+    def set_content_type( self, type ):
+        self.headers[ 'content-type' ] = type
+
+class WorkRequestContext( object ):
+    """
+    Transaction of a worker thread for the user, history and galaxy session
+    given by id, loaded in the database session of the current thread.
+    `origin` holds the base URL, host and remote address of the submitting
+    request.
+    """
+
+    def __init__( self, app, user_id, history_id, galaxy_session_id=None, origin=None ):
+        self.app = app
+        self.model = app.model
+        self.sa_session = app.model.context
+        self.security = app.security
+        self.request = WorkRequest( **( origin or {} ) )
+        self.response = WorkResponse()
+        self.user = None
+        if user_id is not None:
+            self.user = self.sa_session.query( model.User ).get( user_id )
+        self.history = self.sa_session.query( model.History ).get( history_id )
+        self.galaxy_session = None
+        if galaxy_session_id is not None:
+            self.galaxy_session = self.sa_session.query( model.GalaxySession ).get( galaxy_session_id )
+
+    def get_user( self ):
+        return self.user
+
+    def get_history( self, create=False ):
+        return self.history
+
+    def get_galaxy_session( self ):
+        return self.galaxy_session
+
+    def get_current_user_roles( self ):
+        if self.user:
+            return self.user.all_roles()
+        return []
+
+    def user_is_admin( self ):
+        admin_users = getattr( self.app.config, 'admin_users', '' ).split( ',' )
+        return self.user is not None and self.user.email in admin_users
+
+    def log_event( self, message, tool_id=None, **kwargs ):
+        """
+        Record an event like the web transaction does, if events are logged.
+        """
+        if not getattr( self.app.config, 'log_events', False ):
+            return
+        event = model.Event()
+        event.tool_id = tool_id
+        try:
+            event.message = message % kwargs
+        except:
+            event.message = message
+        event.history = self.history
+        event.user = self.user
+        if self.galaxy_session is not None:
+            event.session_id = self.galaxy_session.id
+        self.sa_session.add( event )
+        self.sa_session.flush()
+
+def request_origin( trans ):
+    """
+    The base URL, host and remote address of the request of `trans`, for
+    the `WorkRequestContext` of a worker.
+    """
+    request = trans.request
+    return dict( base=getattr( request, 'base', None ), host=getattr( request, 'host', None ),
+                 remote_addr=getattr( request, 'remote_addr', None ) )
+
+def encode_step_state( trans, step ):
+    """
+    The `step.state` of a validated step as a string `decode_step_state`
+    turns back into the state.
+    """
+    if step.type == 'tool' or step.type is None:
+        return step.state.encode( trans.app.toolbox.tools_by_id[ step.tool_id ], trans.app )
+    return step.module.encode_runtime_state( trans, step.state )
+
+def decode_step_state( trans, step, value ):
+    """
+    Set the `state` (and `module` for steps other than tools) of `step` from
+    `value`, as encoded by `encode_step_state`.
+    """
+    if step.type == 'tool' or step.type is None:
+        step.state = DefaultToolState()
+        step.state.decode( value, trans.app.toolbox.tools_by_id[ step.tool_id ], trans.app )
+    else:
+        step.module = module_factory.from_workflow_step( trans, step )
+        step.state = step.module.decode_runtime_state( trans, value )
+
+def execute_steps( trans, workflow_invocation, steps, history, replacement_dict, progress=None ):
+    """
+    Execute `steps` in order from their `state`, connecting outputs to
+    inputs, and record them as steps of `workflow_invocation`. Jobs go to
+    `history`, or the current history if None. `progress` is called with
+    every step executed. Returns the outputs by step id.
+    """
+    outputs = odict()
+    for step in steps:
+        # Execute module
+        job = None
+        if step.type == 'tool' or step.type is None:
+            tool = trans.app.toolbox.tools_by_id[ step.tool_id ]
+            input_connections_by_name = dict( ( conn.input_name, conn ) for conn in step.input_connections )
+            # Connect up
+            def callback( input, value, prefixed_name, prefixed_label ):
+                if isinstance( input, DataToolParameter ):
+                    if prefixed_name in input_connections_by_name:
+                        conn = input_connections_by_name[ prefixed_name ]
+                        return outputs[ conn.output_step.id ][ conn.output_name ]
+            visit_input_values( tool.inputs, step.state.inputs, callback )
+            # Execute it
+            job, out_data = tool.execute( trans, step.state.inputs, history=history )
+            outputs[ step.id ] = out_data
+            # Create new PJA associations with the created job, to be run on completion.
+            # Pass along replacement dict with the execution of the PJA so we don't have to modify the object.
+            for pja in step.post_job_actions:
+                if pja.action_type in ActionBox.immediate_actions:
+                    ActionBox.execute( trans.app, trans.sa_session, pja, job, replacement_dict )
+                else:
+                    job.add_post_job_action( pja )
+        else:
+            job, out_data = step.module.execute( trans, step.state )
+            outputs[ step.id ] = out_data
+        # Record invocation
+        workflow_invocation_step = model.WorkflowInvocationStep()
+        workflow_invocation_step.workflow_invocation = workflow_invocation
+        workflow_invocation_step.workflow_step = step
+        workflow_invocation_step.job = job
+        if progress is not None:
+            progress( step )
+    return outputs
+
+def execute_request( app, request, progress ):
+    """
+    Execute the invocation of the `InvocationRequest` `request` in a worker
+    thread, calling `progress` with every step executed.
+    """
+    try:
+        trans = WorkRequestContext( app, request.user_id, request.history_id, request.galaxy_session_id, request.origin )
+        workflow_invocation = trans.sa_session.query( model.WorkflowInvocation ).get( request.invocation_id )
+        steps = workflow_invocation.workflow.steps
+        for step in steps:
+            decode_step_state( trans, step, request.states[ step.id ] )
+        execute_steps( trans, workflow_invocation, steps, trans.history, request.replacement_dict, progress=progress )
+        trans.sa_session.flush()
+    finally:
+        # Start the next request from a clean session.
+        app.model.context.remove()
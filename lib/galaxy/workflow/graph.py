@@ -0,0 +1,224 @@
+"""
+Compact step graph of a workflow.
+
+Steps are numbered 0..n-1 and connections are kept in compressed sparse
+row form in both directions: the connections into node i are
+`in_edges[ in_start[i]:in_start[i+1] ]` and the connections out of it
+`out_edges[ out_start[i]:out_start[i+1] ]`, both listing edge numbers.
+Each edge stores its source and target node and, when built from steps,
+the names of the input and output it connects. Edges keep the order in
+which they were given, so walking a node's edges is deterministic.
+
+The graph is built once and then answers all structural questions of a
+request: topological order (the order `galaxy.util.topsort.topsort` gives
+for the steps with a self edge each), levels (as `topsort_levels`),
+parents, children and the connection of every named input.
+"""
+
+import math
+from array import array
+
+class CycleError( Exception ):
+    """
+    The graph is not acyclic; `order` holds the nodes that could be ordered.
+    """
+
+    def __init__( self, order ):
+        Exception.__init__( self, "Workflow contains cycles" )
+        self.order = order
+
+def _compress( num_nodes, keys ):
+    """
+    Bucket the edges by `keys` (the node each edge belongs to). Returns the
+    start offsets and the edge numbers, stable within each node.
+    """
+    start = array( 'l', [ 0 ] * ( num_nodes + 1 ) )
+    for key in keys:
+        start[ key + 1 ] += 1
+    for i in xrange( num_nodes ):
+        start[ i + 1 ] += start[ i ]
+    fill = array( 'l', start )
+    edges = array( 'l', [ 0 ] * len( keys ) )
+    for edge, key in enumerate( keys ):
+        edges[ fill[ key ] ] = edge
+        fill[ key ] += 1
+    return start, edges
+
+def distance_from_origin( step ):
+    """
+    Distance of the canvas position of `step` from the top left corner.
+    """
+    return math.sqrt( step.position['left'] ** 2 + step.position['top'] ** 2 )
+
+def sort_by_position( steps ):
+    """
+    Sort `steps` in place by `distance_from_origin`, keeping the order of
+    equally distant steps, if every step has a position. The distance is
+    computed once per step.
+    """
+    for step in steps:
+        if not step.position or 'left' not in step.position or 'top' not in step.position:
+            return False
+    steps.sort( key=distance_from_origin )
+    return True
+
+class WorkflowGraph( object ):
+    """
+    Directed graph of `num_nodes` nodes with the connections `sources[e]`
+    -> `targets[e]`. Parallel connections are kept, self loops are not
+    allowed (they can not be expressed by step connections).
+    """
+
+    def __init__( self, num_nodes, sources, targets, input_names=None, output_names=None ):
+        self.num_nodes = num_nodes
+        self.sources = array( 'l', sources )
+        self.targets = array( 'l', targets )
+        self.input_names = input_names
+        self.output_names = output_names
+        self.in_start, self.in_edges = _compress( num_nodes, self.targets )
+        self.out_start, self.out_edges = _compress( num_nodes, self.sources )
+        # Filled in by the constructors: node -> step and step id -> node.
+        self.steps = None
+        self.index = None
+
+    @classmethod
+    def from_steps( cls, steps ):
+        """
+        Graph of the `WorkflowStep`s in `steps`; node i is steps[i].
+        """
+        index = dict( ( step, i ) for i, step in enumerate( steps ) )
+        sources, targets, input_names, output_names = [], [], [], []
+        for i, step in enumerate( steps ):
+            for conn in step.input_connections:
+                sources.append( index[ conn.output_step ] )
+                targets.append( i )
+                input_names.append( conn.input_name )
+                output_names.append( conn.output_name )
+        graph = cls( len( steps ), sources, targets, input_names, output_names )
+        graph.steps = steps
+        graph.index = index
+        return graph
+
+    @classmethod
+    def from_step_dicts( cls, steps, include=None ):
+        """
+        Graph of the step dictionaries of a workflow dictionary (see
+        `_workflow_to_dict`), in the iteration order of `steps`. If
+        `include` is given, only the steps it accepts become nodes and
+        connections from other steps are left out.
+        """
+        nodes = [ step for step_id, step in steps.items() if include is None or include( step ) ]
+        index = dict( ( step['id'], i ) for i, step in enumerate( nodes ) )
+        sources, targets, input_names, output_names = [], [], [], []
+        for i, step in enumerate( nodes ):
+            for input_name, input_connection in step['input_connections'].items():
+                source = index.get( input_connection['id'] )
+                if source is None:
+                    continue
+                sources.append( source )
+                targets.append( i )
+                input_names.append( input_name )
+                output_names.append( input_connection['output_name'] )
+        graph = cls( len( nodes ), sources, targets, input_names, output_names )
+        graph.steps = nodes
+        graph.index = index
+        return graph
+
+    def __len__( self ):
+        return self.num_nodes
+
+    def num_parents( self, node ):
+        return self.in_start[ node + 1 ] - self.in_start[ node ]
+
+    def num_children( self, node ):
+        return self.out_start[ node + 1 ] - self.out_start[ node ]
+
+    def parents( self, node ):
+        """
+        Source of every connection into `node`, in connection order.
+        """
+        sources = self.sources
+        return [ sources[ edge ] for edge in self.in_edges[ self.in_start[ node ]:self.in_start[ node + 1 ] ] ]
+
+    def children( self, node ):
+        """
+        Target of every connection out of `node`, in connection order.
+        """
+        targets = self.targets
+        return [ targets[ edge ] for edge in self.out_edges[ self.out_start[ node ]:self.out_start[ node + 1 ] ] ]
+
+    def inputs( self, node ):
+        """
+        (input name, source node, output name) of every connection into `node`.
+        """
+        return [ ( self.input_names[ edge ], self.sources[ edge ], self.output_names[ edge ] )
+                 for edge in self.in_edges[ self.in_start[ node ]:self.in_start[ node + 1 ] ] ]
+
+    def topological_order( self, nodes=None ):
+        """
+        Kahn's algorithm with a FIFO queue. Nodes without parents are taken
+        in the order of `nodes` (all nodes ascending by default) and the
+        children of a node in connection order. Raises `CycleError`.
+        """
+        if nodes is None:
+            nodes = xrange( self.num_nodes )
+        remaining = array( 'l', [ self.num_parents( node ) for node in xrange( self.num_nodes ) ] )
+        order = [ node for node in nodes if not remaining[ node ] ]
+        out_start, out_edges, targets = self.out_start, self.out_edges, self.targets
+        for node in order:
+            for edge in out_edges[ out_start[ node ]:out_start[ node + 1 ] ]:
+                child = targets[ edge ]
+                remaining[ child ] -= 1
+                if not remaining[ child ]:
+                    order.append( child )
+        if len( order ) != self.num_nodes:
+            raise CycleError( order )
+        return order
+
+    def depth_first_order( self ):
+        """
+        Kahn's algorithm with a LIFO stack: the most recently released node
+        comes next. Raises `CycleError`.
+        """
+        remaining = array( 'l', [ self.num_parents( node ) for node in xrange( self.num_nodes ) ] )
+        stack = [ node for node in xrange( self.num_nodes ) if not remaining[ node ] ]
+        order = []
+        out_start, out_edges, targets = self.out_start, self.out_edges, self.targets
+        while stack:
+            node = stack.pop()
+            order.append( node )
+            for edge in out_edges[ out_start[ node ]:out_start[ node + 1 ] ]:
+                child = targets[ edge ]
+                remaining[ child ] -= 1
+                if not remaining[ child ]:
+                    stack.append( child )
+        if len( order ) != self.num_nodes:
+            raise CycleError( order )
+        return order
+
+    def levels( self ):
+        """
+        Nodes grouped by rank: the nodes without parents first, then those
+        whose parents are all in earlier levels; each level is ascending.
+        Raises `CycleError`.
+        """
+        remaining = array( 'l', [ self.num_parents( node ) for node in xrange( self.num_nodes ) ] )
+        level = [ node for node in xrange( self.num_nodes ) if not remaining[ node ] ]
+        levels = []
+        placed = 0
+        out_start, out_edges, targets = self.out_start, self.out_edges, self.targets
+        while level:
+            levels.append( level )
+            placed += len( level )
+            next_level = []
+            for node in level:
+                for edge in out_edges[ out_start[ node ]:out_start[ node + 1 ] ]:
+                    child = targets[ edge ]
+                    remaining[ child ] -= 1
+                    if not remaining[ child ]:
+                        next_level.append( child )
+            next_level.sort()
+            level = next_level
+        if placed != self.num_nodes:
+            raise CycleError( [ node for level in levels for node in level ] )
+        return levels
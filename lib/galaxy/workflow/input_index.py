@@ -0,0 +1,122 @@
+"""
+Per-tool index of the input structure that workflow steps need.
+
+Serialising a workflow step asks the same questions of the same tool
+definition again and again: the prefixed names of its data inputs, which
+inputs can hold a runtime value and the first extension of every output.
+The answers only depend on the tool, except for the repeat instances and
+the selected conditional cases stored in a step's state. The index
+records the static part once per loaded tool; per step only the repeats
+and conditionals that contain data inputs are walked.
+
+Indexes are kept per tool object, so a tool reloaded by the toolbox gets
+a new index and the old one goes away with the old tool.
+"""
+
+import weakref
+
+from galaxy.tools.parameters.basic import DataToolParameter, RuntimeValue
+from galaxy.tools.parameters.grouping import Repeat, Conditional
+
+_indexes = weakref.WeakKeyDictionary()
+
+class InputIndex( object ):
+    """
+    Data inputs of one level of a tool's inputs: the names of the data
+    parameters and the repeats and conditionals containing data inputs,
+    with the index of their nested inputs.
+    """
+
+    def __init__( self, inputs ):
+        self.data_names = []
+        # (name, InputIndex) of repeats with data inputs.
+        self.repeats = []
+        # (name, { case number: InputIndex }) of conditionals with data inputs.
+        self.conditionals = []
+        for input in inputs.itervalues():
+            if isinstance( input, Repeat ):
+                nested = InputIndex( input.inputs )
+                if not nested.empty:
+                    self.repeats.append( ( input.name, nested ) )
+            elif isinstance( input, Conditional ):
+                cases = {}
+                for number, case in enumerate( input.cases ):
+                    nested = InputIndex( case.inputs )
+                    if not nested.empty:
+                        cases[ number ] = nested
+                if cases:
+                    self.conditionals.append( ( input.name, cases ) )
+            elif isinstance( input, DataToolParameter ):
+                self.data_names.append( input.name )
+        self.empty = not ( self.data_names or self.repeats or self.conditionals )
+        self.static = not ( self.repeats or self.conditionals )
+
+    def collect( self, values, prefix, names ):
+        """
+        Add the prefixed names of the data inputs in `values` to `names`,
+        the names `visit_input_values` passes to its callback.
+        """
+        for name in self.data_names:
+            names.add( prefix + name )
+        for name, nested in self.repeats:
+            for instance in values[ name ]:
+                nested.collect( instance, "%s%s_%d|" % ( prefix, name, instance['__index__'] ), names )
+        for name, cases in self.conditionals:
+            value = values[ name ]
+            nested = cases.get( value['__current_case__'] )
+            if nested is not None:
+                nested.collect( value, prefix + name + "|", names )
+
+class ToolIndex( object ):
+    """
+    Input structure of `tool`: its data inputs, the names of its top level
+    repeats and, unless an output takes its format from an input (`outputs`
+    is None then), the name and first extension of every output.
+    """
+
+    def __init__( self, tool ):
+        self.inputs = InputIndex( tool.inputs )
+        self.static_data_names = frozenset( self.inputs.data_names )
+        self.repeat_names = frozenset( [ input.name for input in tool.inputs.itervalues() if isinstance( input, Repeat ) ] )
+        self.outputs = []
+        for name, output in tool.outputs.iteritems():
+            if getattr( output, 'format_source', None ) is not None or output.format in ( None, 'input' ):
+                self.outputs = None
+                break
+            self.outputs.append( dict( name=name, type=output.format ) )
+
+    def data_input_names( self, values ):
+        """
+        Prefixed names of the data inputs of a step whose state is `values`.
+        """
+        if self.inputs.static:
+            return self.static_data_names
+        names = set()
+        self.inputs.collect( values, "", names )
+        return names
+
+    def runtime_inputs( self, values ):
+        """
+        Names of the top level inputs in `values` that hold a runtime value
+        themselves or in one of their parts, in the order of `values`.
+        """
+        names = []
+        for name, value in values.items():
+            if name in self.repeat_names:
+                continue
+            if type( value ) == RuntimeValue:
+                names.append( name )
+            elif type( value ) == dict:
+                for part in value.values():
+                    if type( part ) == RuntimeValue:
+                        names.append( name )
+        return names
+
+def index_for_tool( tool ):
+    """
+    The `ToolIndex` of `tool`, built on first use.
+    """
+    index = _indexes.get( tool )
+    if index is None:
+        index = _indexes[ tool ] = ToolIndex( tool )
+    return index
@@ -0,0 +1,36 @@
+"""
+Loading a workflow revision with the step collections the controllers walk.
+
+Walking `workflow.steps` and the input connections, post job actions and
+workflow outputs of every step loads each collection lazily, one query per
+step. Instead the steps are loaded by one query and every collection by one
+more query over the steps of the workflow, eagerly loading it. Steps that
+are already in the session, say because the workflow was loaded before,
+are returned from the identity map by those queries, which fills in their
+collections that are still unloaded; a query rooted at the workflow would
+skip an already loaded `steps` collection and leave its steps alone.
+Separate queries also keep the joins from multiplying the rows. The output
+step of every connection is a step of the workflow, found in the session.
+
+`scripts/workflow_query_count_check.py` checks that the number of queries
+does not grow with the number of steps.
+"""
+
+from sqlalchemy.orm import eagerload
+
+# Collections of the steps loaded by default.
+STEP_COLLECTIONS = ( 'input_connections', 'post_job_actions', 'workflow_outputs' )
+
+def load_full_workflow( sa_session, model, workflow_id, collections=STEP_COLLECTIONS ):
+    """
+    Load the `model.Workflow` `workflow_id` with its steps and their
+    `collections` in 1 + len( collections ) queries.
+    """
+    workflow = sa_session.query( model.Workflow ) \
+                         .options( eagerload( 'steps' ) ) \
+                         .filter_by( id=workflow_id ).one()
+    for collection in collections:
+        sa_session.query( model.WorkflowStep ) \
+                  .options( eagerload( collection ) ) \
+                  .filter_by( workflow_id=workflow_id ).all()
+    return workflow
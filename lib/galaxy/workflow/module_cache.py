@@ -0,0 +1,75 @@
+"""
+Cache of workflow modules for read-only use.
+
+Building the module of a step parses the persisted tool state against the
+tool's inputs. Steps of the same tool with the same persisted state and
+errors yield equal states, so the state is parsed once and shared. The
+cache keeps a module without a transaction; every lookup returns a shallow
+copy of it bound to the caller's transaction, so nothing of one request is
+ever seen by another. A cached module is only valid for the tool object it
+was built from: once the toolbox has reloaded the tool, the next lookup
+builds the module again.
+
+The state of the modules returned is shared and must not be modified.
+Paths that change the state of a module (the editor, running) build their
+own with `module_factory`.
+"""
+
+import copy
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from hashlib import sha1
+
+from galaxy.util.lru import LRUCache
+from galaxy.workflow.modules import module_factory
+
+# Number of modules kept.
+CACHE_SIZE = 2000
+
+def state_digest( step ):
+    """
+    Digest of the persisted tool state and errors of `step`.
+    """
+    return sha1( json.dumps( [ step.tool_inputs, step.tool_errors ], sort_keys=True ) ).hexdigest()
+
+class ModuleCache( object ):
+    """
+    Least recently used modules keyed on (type, tool id, tool version,
+    state digest) of the step they were built from.
+    """
+
+    def __init__( self, max_size=CACHE_SIZE ):
+        self.modules = LRUCache( max_size, size_of=lambda module: 1 )
+
+    def key( self, step ):
+        return ( step.type, step.tool_id, step.tool_version, state_digest( step ) )
+
+    def from_workflow_step( self, trans, step ):
+        """
+        A module of `step` for `trans`, as `module_factory.from_workflow_step`
+        builds it, whose state is shared with every other step of the same
+        key. Returns None if the step's tool is not in the toolbox.
+        """
+        key = self.key( step )
+        cached = self.modules.get( key )
+        if cached is not None and getattr( cached, 'tool', None ) is not trans.app.toolbox.tools_by_id.get( step.tool_id ):
+            # The tool has been reloaded since.
+            self.modules.remove( key )
+            cached = None
+        if cached is None:
+            module = module_factory.from_workflow_step( trans, step )
+            if module is None:
+                return None
+            cached = copy.copy( module )
+            cached.trans = None
+            self.modules.put( key, cached )
+            return module
+        module = copy.copy( cached )
+        module.trans = trans
+        return module
+
+    def clear( self ):
+        self.modules.clear()
@@ -0,0 +1,463 @@
+"""
+SVG previews of workflows.
+
+The image is written as a stream of markup chunks: first the connectors,
+then the boxes, then the labels, so later layers are drawn on top as
+before. Only the geometry of the steps is held in memory (one `StepImage`
+per step); no element tree is built, however large the workflow.
+
+All styling is passed to each render as an immutable `ImageStyle`, so
+concurrent renders share no mutable state.
+
+For very large workflows there is a level of detail mode:
+`collapse_chains` merges linear chains of steps into single boxes and
+port labels can be left out once they would be too small to read. A
+rendered image can also be restricted to a viewport; the elements in it
+are found through a `SpatialIndex` built once per `WorkflowImage`.
+"""
+
+import math
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+from galaxy.util.lru import LRUCache
+
+# Rendered images kept, in bytes, and the largest image cached.
+CACHE_SIZE = 32 * 1024 * 1024
+MAX_ENTRY_SIZE = 4 * 1024 * 1024
+# Side of the cells of the spatial index, in canvas pixels.
+CELL_SIZE = 512
+# Smallest rendered font size, in pixels, at which port labels are drawn in
+# the level of detail mode.
+MIN_LABEL_PX = 6
+
+HEADER = '''<?xml version="1.0" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+'''
+ARROW = '''<defs><marker id="arrow_end" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="6" markerHeight="6" orient="auto"><path d="M 0 0 L 10 5 L 0 10 z" style="stroke:none; fill:black"/></marker></defs>
+'''
+
+def encode( value ):
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    return str( value )
+
+class ImageStyle( namedtuple( 'ImageStyle', 'canvas font_size title_font_size margin line_px title_fill body_fill port_fill' ) ):
+    """
+    Look of a workflow image: the style of the canvas, the font sizes of
+    port labels and step titles, the margin of the boxes, the distance
+    between two port labels and the colours of box titles, box bodies and
+    output ports.
+    """
+
+DEFAULT_STYLE = ImageStyle( canvas="stroke:black; fill:none; stroke-width:1px; stroke-linejoin:round; text-anchor:left",
+                            font_size="10px", title_font_size="14px", margin=5, line_px=16,
+                            title_fill="#EBD9B2", body_fill="#ffffff", port_fill="#ffffff" )
+
+def labels_visible( style, zoom ):
+    """
+    Whether port labels in `style` are still readable at `zoom`.
+    """
+    return float( style.font_size.rstrip( 'px' ) ) * zoom >= MIN_LABEL_PX
+
+def text( x, y, value, font_size ):
+    return '<text x="%s" y="%s" font-size="%s" style="stroke:none; fill:black">%s</text>\n' % ( x, y, font_size, escape( encode( value ) ) )
+
+def line( x1, y1, x2, y2, arrow=False ):
+    if arrow:
+        return '<path d="M %s %s L %s %s" marker-end="url(#arrow_end)"/>\n' % ( x1, y1, x2, y2 )
+    return '<path d="M %s %s L %s %s"/>\n' % ( x1, y1, x2, y2 )
+
+def rect( x1, y1, x2, y2, fill ):
+    return '<path d="M %s %s L %s %s L %s %s L %s %s Z" fill=%s/>\n' % ( x1, y1, x2, y1, x2, y2, x1, y2, quoteattr( fill ) )
+
+def circle( cx, cy, r, fill ):
+    return '<circle cx="%s" cy="%s" r="%s" fill=%s/>\n' % ( cx, cy, r, quoteattr( fill ) )
+
+class StepImage( object ):
+    """
+    Box of a step at (`left`, `top`) titled `name`, with the labels of its
+    `inputs` ((name, label) pairs) above those of its `outputs` (names),
+    drawn in `style`.
+    """
+
+    def __init__( self, name, left, top, inputs, outputs, style=DEFAULT_STYLE ):
+        self.style = style
+        self.name = name
+        self.left = left
+        self.top = top
+        self.inputs = inputs
+        self.outputs = outputs
+        # Anchor of every port label by port name.
+        self.input_positions = {}
+        self.output_positions = {}
+        max_len = len( name ) * 1.5
+        y = top + 45
+        count = 0
+        for input_name, label in inputs:
+            self.input_positions[ input_name ] = ( left, y + count * style.line_px )
+            count += 1
+            max_len = max( max_len, len( label ) )
+        if inputs:
+            y += 15
+        for output_name in outputs:
+            self.output_positions[ output_name ] = ( left, y + count * style.line_px )
+            count += 1
+            max_len = max( max_len, len( output_name ) )
+        self.width = max_len * 5.5
+
+    def bounds( self ):
+        """
+        (x1, y1, x2, y2) of the box.
+        """
+        style = self.style
+        box_height = ( len( self.inputs ) + len( self.outputs ) ) * style.line_px + style.margin
+        if self.inputs:
+            box_height += 15
+        return ( self.left - style.margin, self.top, self.left + self.width - style.margin, self.top + 30 + box_height )
+
+    def box( self ):
+        style = self.style
+        x, y, width, margin = self.left, self.top, self.width, style.margin
+        box_height = ( len( self.inputs ) + len( self.outputs ) ) * style.line_px + margin
+        if self.inputs:
+            box_height += 15
+        return rect( x - margin, y, x + width - margin, y + 30, style.title_fill ) + \
+               rect( x - margin, y + 30, x + width - margin, y + 30 + box_height, style.body_fill )
+
+    def labels( self, ports=True ):
+        """
+        The title and, if `ports`, the port labels.
+        """
+        style = self.style
+        chunks = [ text( self.left, self.top + 20, self.name, style.title_font_size ) ]
+        if not ports:
+            return chunks[0]
+        for input_name, label in self.inputs:
+            x, y = self.input_positions[ input_name ]
+            chunks.append( text( x, y, label, style.font_size ) )
+        for output_name in self.outputs:
+            x, y = self.output_positions[ output_name ]
+            chunks.append( text( x, y, output_name, style.font_size ) )
+        return ''.join( chunks )
+
+    def separator( self ):
+        if not self.inputs:
+            return ''
+        margin = self.style.margin
+        sep_y = self.top + len( self.inputs ) * self.style.line_px + 40
+        return line( self.left - margin, sep_y, self.left + self.width - margin, sep_y )
+
+class WorkflowImage( object ):
+    """
+    Image of the `StepImage`s in `steps`. `connections` are (source step,
+    output name, target step, input name) with steps given by their index;
+    connections naming a port the step does not have are not drawn. The
+    canvas and connectors are drawn in `style`, the steps in their own.
+    """
+
+    def __init__( self, steps, connections, style=DEFAULT_STYLE ):
+        self.style = style
+        self.steps = steps
+        self._index = None
+        self.connections = []
+        for source, output_name, target, input_name in connections:
+            if output_name in steps[ source ].output_positions and input_name in steps[ target ].input_positions:
+                self.connections.append( ( source, output_name, target, input_name ) )
+        max_width = max_x = max_y = 0
+        for step in steps:
+            max_x = max( max_x, step.left )
+            max_y = max( max_y, step.top )
+            max_width = max( max_width, step.width )
+        self.width = max_x + max_width + 50
+        self.height = max_y + 300
+
+    def connector( self, source, output_name, target, input_name ):
+        """
+        Line from the output port to the input port.
+        """
+        out_x, out_y = self.steps[ source ].output_positions[ output_name ]
+        in_x, in_y = self.steps[ target ].input_positions[ input_name ]
+        return line( out_x + self.steps[ source ].width, out_y - self.style.margin, in_x - 10, in_y, arrow=True )
+
+    def port( self, source, output_name, target, input_name ):
+        """
+        Circle marking the output port of a connection.
+        """
+        out_x, out_y = self.steps[ source ].output_positions[ output_name ]
+        width, margin = self.steps[ source ].width, self.style.margin
+        return circle( out_x + width - margin, out_y - margin, 5, self.style.port_fill )
+
+    def connector_bounds( self, source, output_name, target, input_name ):
+        """
+        (x1, y1, x2, y2) of the connector and its port circle.
+        """
+        out_x, out_y = self.steps[ source ].output_positions[ output_name ]
+        in_x, in_y = self.steps[ target ].input_positions[ input_name ]
+        start_x, start_y = out_x + self.steps[ source ].width, out_y - self.style.margin
+        return ( min( start_x - self.style.margin - 5, in_x - 10 ), min( start_y - 5, in_y ),
+                 max( start_x, in_x - 10 ), max( start_y + 5, in_y ) )
+
+    @property
+    def index( self ):
+        """
+        `SpatialIndex` of the steps and connectors, built on first use.
+        """
+        if self._index is None:
+            index = SpatialIndex()
+            for number, step in enumerate( self.steps ):
+                index.add_box( ( 'step', number ), *step.bounds() )
+            for number, ( source, output_name, target, input_name ) in enumerate( self.connections ):
+                out_x, out_y = self.steps[ source ].output_positions[ output_name ]
+                in_x, in_y = self.steps[ target ].input_positions[ input_name ]
+                start_x, start_y = out_x + self.steps[ source ].width, out_y - self.style.margin
+                index.add_segment( ( 'connector', number ), start_x, start_y, in_x - 10, in_y )
+                # The port circle.
+                index.add_box( ( 'connector', number ), start_x - self.style.margin - 5, start_y - 5, start_x, start_y + 5 )
+            self._index = index
+        return self._index
+
+    def visible( self, x1, y1, x2, y2 ):
+        """
+        Numbers of the steps and of the connections with an element inside
+        the rectangle (x1, y1, x2, y2), each in ascending order.
+        """
+        steps, connectors = [], []
+        for kind, number in self.index.query( x1, y1, x2, y2 ):
+            if kind == 'step':
+                if overlaps( self.steps[ number ].bounds(), ( x1, y1, x2, y2 ) ):
+                    steps.append( number )
+            else:
+                source, output_name, target, input_name = self.connections[ number ]
+                out_x, out_y = self.steps[ source ].output_positions[ output_name ]
+                in_x, in_y = self.steps[ target ].input_positions[ input_name ]
+                start_x, start_y = out_x + self.steps[ source ].width, out_y - self.style.margin
+                port = ( start_x - self.style.margin - 5, start_y - 5, start_x, start_y + 5 )
+                if overlaps( port, ( x1, y1, x2, y2 ) ) or crosses( ( start_x, start_y, in_x - 10, in_y ), ( x1, y1, x2, y2 ) ):
+                    connectors.append( number )
+        steps.sort()
+        connectors.sort()
+        return steps, connectors
+
+    def svg( self, viewport=None, zoom=1, labels=True ):
+        """
+        Generate the SVG document in chunks. `viewport` (x, y, width,
+        height) restricts the image to the elements in that part of the
+        canvas; the image is `zoom` times the size of the region shown.
+        Port labels are left out unless `labels`.
+        """
+        if viewport is None:
+            x, y, width, height = 0, 0, self.width, self.height
+            steps = range( len( self.steps ) )
+            connectors = range( len( self.connections ) )
+        else:
+            x, y, width, height = viewport
+            steps, connectors = self.visible( x, y, x + width, y + height )
+        if zoom == 1:
+            image_width, image_height = width, height
+        else:
+            image_width, image_height = width * zoom, height * zoom
+        yield HEADER
+        yield '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="%s px" height="%s px" viewBox="%s %s %s %s" style=%s>\n' % \
+              ( image_width, image_height, x, y, width, height, quoteattr( self.style.canvas ) )
+        yield ARROW
+        yield '<g>\n'
+        for number in connectors:
+            yield self.connector( *self.connections[ number ] )
+        yield '</g>\n<g>\n'
+        for number in steps:
+            yield self.steps[ number ].box()
+        yield '</g>\n<g>\n'
+        for number in steps:
+            yield self.steps[ number ].labels( ports=labels )
+        # Separators and the ports of the connections into each step.
+        separators = set( steps )
+        ports = {}
+        for number in connectors:
+            ports.setdefault( self.connections[ number ][2], [] ).append( self.connections[ number ] )
+        for number in sorted( separators.union( ports ) ):
+            chunk = ''
+            if number in separators:
+                chunk = self.steps[ number ].separator()
+            yield chunk + ''.join( [ self.port( *connection ) for connection in ports.get( number, () ) ] )
+        yield '</g>\n</svg>\n'
+
+def overlaps( a, b ):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def crosses( segment, box ):
+    """
+    Whether the line `segment` (x1, y1, x2, y2) passes through `box`
+    (x1, y1, x2, y2), by Liang-Barsky clipping.
+    """
+    x1, y1, x2, y2 = segment
+    dx, dy = x2 - x1, y2 - y1
+    low, high = 0.0, 1.0
+    for p, q in ( ( -dx, x1 - box[0] ), ( dx, box[2] - x1 ), ( -dy, y1 - box[1] ), ( dy, box[3] - y1 ) ):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = float( q ) / p
+            if p < 0:
+                low = max( low, t )
+            else:
+                high = min( high, t )
+            if low > high:
+                return False
+    return True
+
+class SpatialIndex( object ):
+    """
+    Uniform grid of `cell_size` pixel cells listing the items that may
+    reach into each cell. Queries return candidates; the caller tests
+    them exactly.
+    """
+
+    def __init__( self, cell_size=CELL_SIZE ):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell( self, x, y ):
+        return ( int( math.floor( float( x ) / self.cell_size ) ), int( math.floor( float( y ) / self.cell_size ) ) )
+
+    def add_box( self, item, x1, y1, x2, y2 ):
+        first_x, first_y = self.cell( x1, y1 )
+        last_x, last_y = self.cell( x2, y2 )
+        for cell_x in xrange( first_x, last_x + 1 ):
+            for cell_y in xrange( first_y, last_y + 1 ):
+                self.cells.setdefault( ( cell_x, cell_y ), [] ).append( item )
+
+    def add_segment( self, item, x1, y1, x2, y2 ):
+        """
+        Add a line to every cell it passes through, walking the grid from
+        one end to the other.
+        """
+        cell_x, cell_y = self.cell( x1, y1 )
+        end_x, end_y = self.cell( x2, y2 )
+        size = float( self.cell_size )
+        dx, dy = x2 - x1, y2 - y1
+        step_x = dx > 0 and 1 or -1
+        step_y = dy > 0 and 1 or -1
+        # Line parameter of the next cell border crossed in each direction
+        # and its increase per cell.
+        if dx:
+            next_x = ( ( cell_x + ( step_x > 0 ) ) * size - x1 ) / dx
+            delta_x = size / abs( dx )
+        else:
+            next_x = delta_x = float( 'inf' )
+        if dy:
+            next_y = ( ( cell_y + ( step_y > 0 ) ) * size - y1 ) / dy
+            delta_y = size / abs( dy )
+        else:
+            next_y = delta_y = float( 'inf' )
+        cells = self.cells
+        cells.setdefault( ( cell_x, cell_y ), [] ).append( item )
+        for i in xrange( abs( end_x - cell_x ) + abs( end_y - cell_y ) ):
+            if ( cell_x, cell_y ) == ( end_x, end_y ):
+                break
+            if next_x < next_y:
+                cell_x += step_x
+                next_x += delta_x
+            elif next_y < next_x:
+                cell_y += step_y
+                next_y += delta_y
+            else:
+                # Through a corner: the line touches both side cells.
+                cells.setdefault( ( cell_x + step_x, cell_y ), [] ).append( item )
+                cells.setdefault( ( cell_x, cell_y + step_y ), [] ).append( item )
+                cell_x += step_x
+                cell_y += step_y
+                next_x += delta_x
+                next_y += delta_y
+            cells.setdefault( ( cell_x, cell_y ), [] ).append( item )
+        if ( cell_x, cell_y ) != ( end_x, end_y ):
+            # Rounding took the walk off by a cell; the end is still covered.
+            cells.setdefault( ( end_x, end_y ), [] ).append( item )
+
+    def query( self, x1, y1, x2, y2 ):
+        first_x, first_y = self.cell( x1, y1 )
+        last_x, last_y = self.cell( x2, y2 )
+        items = set()
+        for cell_x in xrange( first_x, last_x + 1 ):
+            for cell_y in xrange( first_y, last_y + 1 ):
+                items.update( self.cells.get( ( cell_x, cell_y ), () ) )
+        return items
+
+def collapse_chains( steps, connections, style=DEFAULT_STYLE ):
+    """
+    Merge every linear chain of `steps` into one box: a step continues the
+    chain of its parent if the connection between them is the only one
+    into the step and the only one out of the parent. A chain box shows
+    the inputs of its first step and the outputs of its last one. Returns
+    the new steps and connections, in the form `WorkflowImage` takes.
+    """
+    num_in = [ 0 ] * len( steps )
+    num_out = [ 0 ] * len( steps )
+    parent = [ None ] * len( steps )
+    child = [ None ] * len( steps )
+    for source, output_name, target, input_name in connections:
+        num_out[ source ] += 1
+        num_in[ target ] += 1
+        parent[ target ] = source
+        child[ source ] = target
+    continues = [ num_in[ i ] == 1 and num_out[ parent[ i ] ] == 1 for i in xrange( len( steps ) ) ]
+    chain_of = [ None ] * len( steps )
+    chains = []
+    for head in xrange( len( steps ) ):
+        if continues[ head ]:
+            continue
+        members = [ head ]
+        while num_out[ members[-1] ] == 1 and continues[ child[ members[-1] ] ]:
+            members.append( child[ members[-1] ] )
+        for member in members:
+            chain_of[ member ] = len( chains )
+        chains.append( members )
+    # Steps on a cycle of continuing steps have no head; keep them apart.
+    for i in xrange( len( steps ) ):
+        if chain_of[ i ] is None:
+            chain_of[ i ] = len( chains )
+            chains.append( [ i ] )
+    collapsed = []
+    for members in chains:
+        first, last = steps[ members[0] ], steps[ members[-1] ]
+        if len( members ) == 1:
+            collapsed.append( first )
+        else:
+            collapsed.append( StepImage( "%s .. %s (%d steps)" % ( first.name, last.name, len( members ) ),
+                                         first.left, first.top, first.inputs, last.outputs, style=style ) )
+    collapsed_connections = []
+    for source, output_name, target, input_name in connections:
+        if chain_of[ source ] != chain_of[ target ]:
+            collapsed_connections.append( ( chain_of[ source ], output_name, chain_of[ target ], input_name ) )
+    return collapsed, collapsed_connections
+
+class ImageCache( object ):
+    """
+    Rendered images by key, up to `max_size` bytes in all; images larger
+    than `max_entry_size` are streamed but not kept.
+    """
+
+    def __init__( self, max_size=CACHE_SIZE, max_entry_size=MAX_ENTRY_SIZE ):
+        self.images = LRUCache( max_size )
+        self.max_entry_size = max_entry_size
+
+    def get( self, key ):
+        return self.images.get( key )
+
+    def stream( self, key, chunks ):
+        """
+        Pass `chunks` through and keep the image under `key` once it is
+        complete, unless it is too large.
+        """
+        kept = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if kept is not None:
+                kept.append( chunk )
+                size += len( chunk )
+                if size > self.max_entry_size:
+                    kept = None
+        if kept is not None:
+            self.images.put( key, ''.join( kept ) )
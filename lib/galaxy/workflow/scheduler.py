@@ -0,0 +1,202 @@
+"""
+Background scheduling of workflow invocations.
+
+Running a workflow creates a job for every step, which for a large
+workflow or a batch over many inputs takes longer than a request may.
+Unless the workers are configured off, `run()` validates the step states,
+records a `WorkflowInvocation` and submits an `InvocationRequest` for it;
+a pool of worker threads on a local queue executes the steps (see
+`galaxy.workflow.execution`) while the request returns the invocation id.
+
+The state of every submitted invocation is kept in the database, one row
+of the `workflow_invocation_state` table per invocation, so that any
+process can report it and none is lost on restart: a scheduler starting
+up queues the invocations still waiting. A worker claims an invocation by
+moving it from queued to running in one update, so an invocation queued
+by several processes is still executed once. An invocation interrupted
+while running is not resumed, its steps may have created jobs already.
+
+This module needs nothing of Galaxy but the database engine, so it can be
+run on a local SQLite database; see `scripts/workflow_scheduler_check.py`.
+"""
+
+import logging, threading, Queue
+from datetime import datetime
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, TEXT, DateTime, and_
+
+log = logging.getLogger( __name__ )
+
+# Worker threads executing invocations, per process. With 0, configured as
+# workflow_scheduler_workers, run() executes the steps within the request.
+WORKERS = 2
+
+QUEUED, RUNNING, OK, ERROR = 'queued', 'running', 'ok', 'error'
+
+class InvocationRequest( object ):
+    """
+    What a worker needs to execute a recorded invocation: the ids of the
+    invocation, user, history and galaxy session, the encoded state of
+    each step by step id, the workflow parameters for post job actions and
+    the base URL, host and remote address of the request that submitted it.
+    """
+
+    def __init__( self, invocation_id, user_id, history_id, galaxy_session_id, states, replacement_dict, origin=None ):
+        self.invocation_id = invocation_id
+        self.user_id = user_id
+        self.history_id = history_id
+        self.galaxy_session_id = galaxy_session_id
+        self.states = states
+        self.replacement_dict = replacement_dict
+        self.origin = origin or {}
+
+    def to_json( self ):
+        return json.dumps( dict( invocation_id=self.invocation_id, user_id=self.user_id, history_id=self.history_id,
+                                 galaxy_session_id=self.galaxy_session_id, replacement_dict=self.replacement_dict,
+                                 origin=self.origin, states=self.states.items() ) )
+
+    @classmethod
+    def from_json( cls, value ):
+        data = json.loads( value )
+        return cls( data['invocation_id'], data['user_id'], data['history_id'], data['galaxy_session_id'],
+                    dict( data['states'] ), data['replacement_dict'], data['origin'] )
+
+class InvocationStore( object ):
+    """
+    The state of submitted invocations in the database of `engine`. The
+    table is created if it does not exist yet.
+    """
+
+    def __init__( self, engine ):
+        self.engine = engine
+        metadata = MetaData()
+        self.table = Table( "workflow_invocation_state", metadata,
+            Column( "workflow_invocation_id", Integer, primary_key=True, autoincrement=False ),
+            Column( "user_id", Integer, index=True ),
+            Column( "state", String( 16 ), index=True ),
+            Column( "steps_done", Integer ),
+            Column( "steps_total", Integer ),
+            Column( "message", TEXT ),
+            Column( "request", TEXT ),
+            Column( "create_time", DateTime ),
+            Column( "update_time", DateTime ) )
+        self.table.create( bind=engine, checkfirst=True )
+
+    def add( self, request ):
+        now = datetime.utcnow()
+        self.engine.execute( self.table.insert(), workflow_invocation_id=request.invocation_id, user_id=request.user_id,
+                             state=QUEUED, steps_done=0, steps_total=len( request.states ), message=None,
+                             request=request.to_json(), create_time=now, update_time=now )
+
+    def claim( self, invocation_id ):
+        """
+        Move invocation `invocation_id` from queued to running. Returns
+        False if it is not queued, say because another process claimed it.
+        """
+        table = self.table
+        result = self.engine.execute( table.update( and_( table.c.workflow_invocation_id == invocation_id, table.c.state == QUEUED ) ),
+                                      state=RUNNING, update_time=datetime.utcnow() )
+        return result.rowcount == 1
+
+    def step_done( self, invocation_id ):
+        table = self.table
+        self.engine.execute( table.update( table.c.workflow_invocation_id == invocation_id,
+                                           values={ table.c.steps_done: table.c.steps_done + 1 } ),
+                             update_time=datetime.utcnow() )
+
+    def finish( self, invocation_id, state, message=None ):
+        table = self.table
+        # The request is not needed any more.
+        self.engine.execute( table.update( table.c.workflow_invocation_id == invocation_id ),
+                             state=state, message=message, request=None, update_time=datetime.utcnow() )
+
+    def get( self, invocation_id ):
+        """
+        The state of invocation `invocation_id` as a dictionary, None if it
+        was never submitted.
+        """
+        table = self.table
+        row = self.engine.execute( table.select( table.c.workflow_invocation_id == invocation_id ) ).fetchone()
+        if row is None:
+            return None
+        return dict( user_id=row.user_id, state=row.state, steps_done=row.steps_done, steps_total=row.steps_total,
+                     message=row.message, submitted=str( row.create_time ), updated=str( row.update_time ) )
+
+    def queued( self ):
+        """
+        The requests of the invocations waiting for a worker, oldest first.
+        """
+        table = self.table
+        rows = self.engine.execute( table.select( table.c.state == QUEUED ).order_by( table.c.create_time ) )
+        return [ InvocationRequest.from_json( row.request ) for row in rows ]
+
+class InvocationScheduler( object ):
+    """
+    Queue of `InvocationRequest`s executed by `workers` threads, each
+    calling `execute( request, progress )` for one request at a time;
+    `progress` is to be called with every step executed. The state of the
+    invocations is kept in `store`.
+    """
+
+    def __init__( self, execute, store, workers=WORKERS ):
+        self.execute = execute
+        self.store = store
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        if not workers:
+            return
+        # Invocations submitted before a restart, or by other processes
+        # and not claimed yet.
+        for request in store.queued():
+            self.queue.put( request )
+        for number in range( workers ):
+            thread = threading.Thread( target=self.work, name="WorkflowScheduler.worker.%d" % number )
+            thread.setDaemon( True )
+            thread.start()
+            self.threads.append( thread )
+
+    def submit( self, request ):
+        """
+        Record `request` as queued and queue it for the workers.
+        """
+        self.store.add( request )
+        self.queue.put( request )
+
+    def status( self, invocation_id ):
+        """
+        The state of invocation `invocation_id` (see `InvocationStore.get`).
+        """
+        return self.store.get( invocation_id )
+
+    def work( self ):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            invocation_id = request.invocation_id
+            try:
+                if not self.store.claim( invocation_id ):
+                    continue
+                self.execute( request, lambda step: self.store.step_done( invocation_id ) )
+                self.store.finish( invocation_id, OK )
+            except Exception, e:
+                log.exception( "Executing workflow invocation %s failed" % invocation_id )
+                try:
+                    self.store.finish( invocation_id, ERROR, "%s: %s" % ( e.__class__.__name__, e ) )
+                except Exception:
+                    log.exception( "Could not record the failure of workflow invocation %s" % invocation_id )
+
+    def shutdown( self ):
+        """
+        Stop the workers once the requests queued so far are executed.
+        """
+        for thread in self.threads:
+            self.queue.put( None )
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,12 @@
+"""
+Conversion of Galaxy workflows to WS-PGRADE (gUSE) workflows.
+"""
+
+from galaxy.workflow.wspgrade.layout import CycleError, LayoutEngine, layout_workflow
+from galaxy.workflow.wspgrade.crossings import CrossingStats, count_crossings, MAX_SWEEPS, TIME_LIMIT
+from galaxy.workflow.wspgrade.writer import WorkflowXMLWriter
+from galaxy.workflow.wspgrade.archive import ZipEntryWriter, archive_name, write_archive, spool_archive, iterate_spool, SPOOL_MAX_SIZE
+from galaxy.workflow.wspgrade.cache import ArchiveCache, archive_key, fingerprint, CACHE_SIZE, DISK_CACHE_SIZE
+from galaxy.workflow.wspgrade.bulk import ConversionPool, write_bulk_archive
+from galaxy.workflow.wspgrade.timing import PhaseTimer, TimingRegistry
+from galaxy.workflow.wspgrade.reader import ArchiveError, tool_index, workflow_dict_from_archive
@@ -0,0 +1,138 @@
+"""
+The workflow.zip archive imported by WS-PGRADE.
+
+`ZipFile.writestr` needs the whole member in memory, so the workflow.xml
+entry is written through `ZipEntryWriter` instead, which compresses the
+document as it is produced and fixes up the local file header afterwards,
+the same way `ZipFile.write` does for files on disk.
+
+Downloads build the archive in a spooled buffer (see `spool_archive`) that
+only moves to an anonymous temporary file once it outgrows
+`SPOOL_MAX_SIZE`, and `iterate_spool` streams the buffer and releases it.
+Nothing is left behind in the temporary directory.
+"""
+
+import zipfile, zlib, binascii, tempfile, time
+
+from galaxy.workflow.wspgrade.writer import WorkflowXMLWriter
+
+# Characters kept in workflow names, anything else becomes an underscore.
+NAME_CHARACTERS = '.0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# Archives up to this size are built in memory.
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+def archive_name( workflow_name ):
+    """
+    Name of the WS-PGRADE workflow (and its archive) for a Galaxy workflow.
+    """
+    return ''.join( c in NAME_CHARACTERS and c or '_' for c in workflow_name )[0:150]
+
+class ZipEntryWriter( object ):
+    """
+    File-like object writing one member `zinfo` to the open `zip_file`.
+    The member is complete once `close` has been called; no other member
+    may be written in the meantime. Time spent compressing is added to
+    the 'zip' phase of `timer`, if given.
+    """
+
+    def __init__( self, zip_file, zinfo, timer=None ):
+        self.zip_file = zip_file
+        self.zinfo = zinfo
+        self.timer = timer
+        self.fp = zip_file.fp
+        zinfo.header_offset = self.fp.tell()
+        zinfo.CRC = 0
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        self.fp.write( zinfo.FileHeader() )
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj( zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15 )
+        else:
+            self.compressor = None
+
+    def write( self, data ):
+        if not data:
+            return
+        zinfo = self.zinfo
+        zinfo.file_size += len( data )
+        zinfo.CRC = binascii.crc32( data, zinfo.CRC ) & 0xffffffff
+        if self.compressor is not None:
+            if self.timer is None:
+                data = self.compressor.compress( data )
+            else:
+                start = time.time()
+                data = self.compressor.compress( data )
+                self.timer.add( 'zip', time.time() - start )
+        zinfo.compress_size += len( data )
+        self.fp.write( data )
+
+    def close( self ):
+        zinfo = self.zinfo
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            zinfo.compress_size += len( data )
+            self.fp.write( data )
+            self.compressor = None
+        # Rewrite the local header now that the CRC and sizes are known.
+        position = self.fp.tell()
+        self.fp.seek( zinfo.header_offset, 0 )
+        self.fp.write( zinfo.FileHeader() )
+        self.fp.seek( position, 0 )
+        self.zip_file.filelist.append( zinfo )
+        self.zip_file.NameToInfo[ zinfo.filename ] = zinfo
+        self.zip_file._didModify = True
+
+def write_archive( out, workflow_name, workflow_description, steps, compression=zipfile.ZIP_DEFLATED, timer=None ):
+    """
+    Write the WS-PGRADE archive of a laid out workflow to the seekable
+    file-like object `out`: the streamed workflow.xml and an empty directory
+    named after the workflow. XML emission and compression are interleaved;
+    `timer` gets them as the 'xml' and 'zip' phases.
+    """
+    start = time.time()
+    if timer is not None:
+        zip_before = timer.seconds.get( 'zip', 0.0 )
+    archive = zipfile.ZipFile( out, 'w', compression )
+    info = zipfile.ZipInfo( 'workflow.xml' )
+    info.compress_type = compression
+    info.external_attr = 0644 << 16L
+    entry = ZipEntryWriter( archive, info, timer=timer )
+    WorkflowXMLWriter( entry ).write( workflow_name, workflow_description, steps )
+    entry.close()
+    info = zipfile.ZipInfo( workflow_name + '/' )
+    info.compress_type = compression
+    info.external_attr = 040755 << 16L
+    archive.writestr( info, '' )
+    archive.close()
+    if timer is not None:
+        timer.add( 'xml', time.time() - start - ( timer.seconds.get( 'zip', 0.0 ) - zip_before ) )
+
+def spool_archive( workflow_name, workflow_description, steps, compression=zipfile.ZIP_DEFLATED, max_size=SPOOL_MAX_SIZE, timer=None ):
+    """
+    Build the archive in a `SpooledTemporaryFile` kept in memory up to
+    `max_size` bytes. Returns the buffer, rewound, and the archive size.
+    """
+    spool = tempfile.SpooledTemporaryFile( max_size=max_size )
+    try:
+        write_archive( spool, workflow_name, workflow_description, steps, compression=compression, timer=timer )
+        size = spool.tell()
+        spool.seek( 0 )
+    except:
+        spool.close()
+        raise
+    return spool, size
+
+def iterate_spool( spool, chunk_size=CHUNK_SIZE ):
+    """
+    Yield the contents of `spool` in chunks and close it once the response
+    is finished or abandoned.
+    """
+    try:
+        while True:
+            chunk = spool.read( chunk_size )
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
@@ -0,0 +1,116 @@
+"""
+Conversion of many workflows at once.
+
+The conversion of a workflow dictionary into an archive needs neither the
+database nor the toolbox, so a batch is spread over a process pool. Each
+workflow is converted on its own and failures are reported per workflow
+instead of aborting the batch.
+
+The pool is optional: without processes configured the conversions run in
+the requesting thread and nothing is forked. Otherwise one pool is created
+on the first batch and shared by all later ones until it is closed. The
+web process is threaded, and a process forked while another thread holds
+a lock (logging, the database connection pool, the caches) keeps that lock
+held forever, so the workers only convert: they never log, but hand the
+traceback of a failure back to be logged by the parent, and never touch
+the database connections they inherit.
+"""
+
+import zipfile, logging, traceback, threading
+from cStringIO import StringIO
+from multiprocessing import Pool, cpu_count
+
+from galaxy.workflow.wspgrade.layout import CycleError, layout_workflow
+from galaxy.workflow.wspgrade.archive import write_archive
+
+log = logging.getLogger( __name__ )
+
+ERRORS_NAME = 'errors.txt'
+
+def convert( job ):
+    """
+    Convert one workflow; `job` is a tuple of (label, archive name,
+    workflow dictionary, compression, layout keyword arguments). Returns
+    (label, archive data, None, None) or (label, None, error message,
+    traceback or None). Safe to call in a forked worker: nothing is logged.
+    """
+    label, name, workflow_dict, compression, layout_options = job
+    try:
+        layout_workflow( workflow_dict, **layout_options )
+        out = StringIO()
+        write_archive( out, name, workflow_dict['annotation'], workflow_dict['steps'], compression=compression )
+        return label, out.getvalue(), None, None
+    except CycleError:
+        return label, None, "workflow contains cycles", None
+    except Exception, e:
+        return label, None, "%s: %s" % ( e.__class__.__name__, e ), traceback.format_exc()
+
+class ConversionPool( object ):
+    """
+    Pool of `processes` worker processes converting workflows, never more
+    than there are CPUs, forked when the first batch of several workflows
+    is converted. With fewer than two processes the conversions run in the
+    calling thread.
+    """
+
+    def __init__( self, processes=0 ):
+        self.processes = min( processes, cpu_count() )
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _get_pool( self ):
+        self.lock.acquire()
+        try:
+            if self.pool is None:
+                self.pool = Pool( self.processes )
+            return self.pool
+        finally:
+            self.lock.release()
+
+    def convert_all( self, jobs ):
+        """
+        Convert `jobs` (see `convert`) and return (label, archive data,
+        error message) in the order of the jobs.
+        """
+        if self.processes <= 1 or len( jobs ) <= 1:
+            results = map( convert, jobs )
+        else:
+            results = self._get_pool().map( convert, jobs, chunksize=1 )
+        converted = []
+        for label, data, message, details in results:
+            if details is not None:
+                log.error( "WS-PGRADE conversion of %s failed\n%s" % ( label, details ) )
+            converted.append( ( label, data, message ) )
+        return converted
+
+    def close( self ):
+        """
+        Stop the worker processes, if any were started.
+        """
+        self.lock.acquire()
+        try:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+        finally:
+            self.lock.release()
+
+def write_bulk_archive( out, archives, errors ):
+    """
+    Write one zip holding each archive of `archives`, a list of (file name,
+    data) pairs, and a report of the (label, message) pairs in `errors`.
+    The archives are compressed already, so they are stored as they are.
+    """
+    bulk = zipfile.ZipFile( out, 'w', zipfile.ZIP_STORED )
+    for file_name, data in archives:
+        info = zipfile.ZipInfo( file_name )
+        info.external_attr = 0644 << 16L
+        bulk.writestr( info, data )
+    if errors:
+        lines = [ u"%s: %s\n" % ( label, message ) for label, message in errors ]
+        info = zipfile.ZipInfo( ERRORS_NAME )
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16L
+        bulk.writestr( info, u''.join( lines ).encode( 'utf-8' ) )
+    bulk.close()
@@ -0,0 +1,157 @@
+"""
+Cache of finished WS-PGRADE archives.
+
+An archive only depends on the latest revision of a stored workflow, on the
+annotations the requesting user sees and on the compression used, so it
+can be served again until one of those changes. All of these are part of
+the key (see `archive_key`): an edit makes a new key rather than changing
+what an old one stands for, and the archives of old keys are evicted as
+they age.
+
+Archives are kept in an in-process LRU tier bounded by their total size
+and, if a cache directory is configured, in files shared by all Galaxy
+processes. Files are written under a temporary name and renamed into place,
+so readers never see a partial archive. The directory is bounded too:
+after every write the least recently used files, by modification time,
+are removed until the rest fit (a disk hit touches its file).
+"""
+
+import os, time, tempfile, logging
+from hashlib import sha1
+
+from galaxy.util.lru import LRUCache
+
+log = logging.getLogger( __name__ )
+
+# Total size of the archives kept in memory.
+CACHE_SIZE = 64 * 1024 * 1024
+# Larger archives are streamed and never cached.
+MAX_ENTRY_SIZE = 8 * 1024 * 1024
+# Total size of the archives kept in the cache directory.
+DISK_CACHE_SIZE = 1024 * 1024 * 1024
+# Age after which a temporary file is taken to be left by a failed write.
+STALE_TEMP_AGE = 3600
+
+def fingerprint( annotations ):
+    """
+    Digest of the workflow and step annotations, in step order.
+    """
+    digest = sha1()
+    for annotation in annotations:
+        if isinstance( annotation, unicode ):
+            annotation = annotation.encode( 'utf-8' )
+        digest.update( '%d:%s' % ( len( annotation or '' ), annotation or '' ) )
+    return digest.hexdigest()
+
+def archive_key( stored_id, workflow_id, user_id, name, annotations_fingerprint, compression ):
+    return ( stored_id, workflow_id, user_id, name, annotations_fingerprint, compression )
+
+class ArchiveCache( object ):
+    """
+    Two tier cache of archives: `max_size` bytes in memory and, if
+    `cache_dir` is given, `disk_max_size` bytes on disk. Archives larger
+    than `max_entry_size` bytes are not cached.
+    """
+
+    def __init__( self, max_size=CACHE_SIZE, max_entry_size=MAX_ENTRY_SIZE, cache_dir=None, disk_max_size=DISK_CACHE_SIZE ):
+        self.memory = LRUCache( max_size )
+        self.max_entry_size = max_entry_size
+        self.cache_dir = cache_dir
+        self.disk_max_size = disk_max_size
+        if cache_dir and not os.path.isdir( cache_dir ):
+            os.makedirs( cache_dir )
+
+    def cacheable( self, size ):
+        """
+        Whether an archive of `size` bytes would be kept by `put`.
+        """
+        return size <= self.max_entry_size and ( size <= self.memory.max_size or ( bool( self.cache_dir ) and size <= self.disk_max_size ) )
+
+    def _path( self, key ):
+        return os.path.join( self.cache_dir, '%s-%s.zip' % ( key[0], sha1( repr( key ) ).hexdigest() ) )
+
+    def get( self, key ):
+        """
+        The archive stored under `key`, or None.
+        """
+        data = self.memory.get( key )
+        if data is not None or not self.cache_dir:
+            return data
+        path = self._path( key )
+        try:
+            cached = open( path, 'rb' )
+        except IOError:
+            return None
+        try:
+            data = cached.read()
+        finally:
+            cached.close()
+        try:
+            os.utime( path, None )
+        except OSError:
+            # Evicted by another process meanwhile.
+            pass
+        self.memory.put( key, data )
+        return data
+
+    def put( self, key, data ):
+        if not self.cacheable( len( data ) ):
+            return
+        self.memory.put( key, data )
+        if not self.cache_dir:
+            return
+        fd, temp_path = tempfile.mkstemp( prefix='.%s-' % key[0], dir=self.cache_dir )
+        try:
+            out = os.fdopen( fd, 'wb' )
+            try:
+                out.write( data )
+            finally:
+                out.close()
+            os.rename( temp_path, self._path( key ) )
+        except ( IOError, OSError ), e:
+            log.warning( "Could not cache WS-PGRADE archive in %s: %s" % ( self.cache_dir, e ) )
+            if os.path.exists( temp_path ):
+                os.remove( temp_path )
+            return
+        try:
+            self.evict()
+        except OSError, e:
+            log.warning( "Could not evict WS-PGRADE archives from %s: %s" % ( self.cache_dir, e ) )
+
+    def evict( self ):
+        """
+        Remove the least recently used files of the cache directory until
+        the others take at most `disk_max_size` bytes, and temporary files
+        left by failed writes.
+        """
+        files = []
+        total = 0
+        now = time.time()
+        for name in os.listdir( self.cache_dir ):
+            path = os.path.join( self.cache_dir, name )
+            try:
+                stat = os.stat( path )
+            except OSError:
+                continue
+            if name.startswith( '.' ):
+                # Being written, unless left by a process that died.
+                if stat.st_mtime < now - STALE_TEMP_AGE:
+                    self._remove( path )
+                continue
+            files.append( ( stat.st_mtime, stat.st_size, path ) )
+            total += stat.st_size
+        if total <= self.disk_max_size:
+            return
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.disk_max_size:
+                break
+            self._remove( path )
+            total -= size
+
+    def _remove( self, path ):
+        try:
+            os.remove( path )
+        except OSError:
+            # Already removed by another process.
+            pass
@@ -0,0 +1,324 @@
+"""
+Edge crossing minimisation for WS-PGRADE layouts.
+
+WS-PGRADE draws every connection between two jobs as a straight line from
+the output port of the parent to the input port of the child, so crossings
+are counted on those segments (`count_crossings`), after the ports are
+placed.
+
+Two kinds of moves are tried, each kept only if it lowers that count:
+
+- Jobs on the same row of the canvas form a layer. Arcs spanning several
+  rows are split into chains of dummy nodes, one per row they pass, and
+  alternating downward and upward sweeps sort each layer by the barycenter
+  (or median) position of each node's neighbours in the previous layer
+  (`LayeredGraph`). The jobs of a layer only move among the cells of that
+  row, and an ordering that would put a parent right of one of its
+  children is rejected: port placement relies on every parent being left
+  of its child or directly above it.
+- The input ports a job already has are handed to its connections in the
+  order of the output ports they come from, and the ports of two of its
+  connections that cross are swapped until none do
+  (`LayoutEngine.untangle_ports`).
+
+Sweeps stop when there are no crossings left, when a down/up round brings
+no improvement, or when the sweep or time budget is used up; the deadline
+is checked between layers and while counting, and the best layout seen is
+kept either way.
+"""
+
+import time
+
+MAX_SWEEPS = 24
+TIME_LIMIT = 1.0
+
+BARYCENTER = 'barycenter'
+MEDIAN = 'median'
+
+# Height of the bands `count_crossings` files segments under, two rows of
+# jobs, and the segments it compares between two deadline checks.
+BAND_HEIGHT = 240
+CHECK_INTERVAL = 4096
+
+def orientation( a, b, c ):
+    """
+    1 if a, b, c turn one way, -1 if the other way, 0 if collinear.
+    """
+    turn = ( b[0] - a[0] ) * ( c[1] - a[1] ) - ( b[1] - a[1] ) * ( c[0] - a[0] )
+    return ( turn > 0 ) - ( turn < 0 )
+
+def segments_cross( a, b, c, d ):
+    """
+    True if segment a-b properly crosses segment c-d.
+    """
+    return orientation( a, b, c ) * orientation( a, b, d ) < 0 and orientation( c, d, a ) * orientation( c, d, b ) < 0
+
+def count_crossings( segments, deadline=None ):
+    """
+    Count the pairs of `segments`, ((x, y), (x, y)) pairs, that properly
+    cross; segments that only touch, e.g. two connections from one output
+    port, do not count. Returns None if `deadline` (a `time.time()` value)
+    passes before the count is complete.
+
+    The segments are swept by their left end. Each one is filed under every
+    band of `BAND_HEIGHT` pixels its vertical extent covers, and compared
+    with the segments of those bands whose horizontal extent reaches it; a
+    pair is only compared in the band where the overlap of their vertical
+    extents starts, so it is counted once. The test is `segments_cross`,
+    inlined.
+    """
+    boxes = []
+    for a, b in segments:
+        if b < a:
+            a, b = b, a
+        top, bottom = min( a[1], b[1] ), max( a[1], b[1] )
+        # Left, right, first and last band, one end and the direction.
+        boxes.append( ( a[0], b[0], top, bottom, int( top // BAND_HEIGHT ), int( bottom // BAND_HEIGHT ),
+                        a[0], a[1], b[0] - a[0], b[1] - a[1] ) )
+    boxes.sort()
+    crossings = 0
+    bands = {}
+    work = 0
+    next_check = CHECK_INTERVAL
+    for box in boxes:
+        left, right, top, bottom, first, last, ax, ay, ex, ey = box
+        for band in xrange( first, last + 1 ):
+            filed = bands.get( band )
+            if filed is None:
+                bands[ band ] = [ box ]
+                continue
+            work += len( filed )
+            if deadline is not None and work >= next_check:
+                if time.time() > deadline:
+                    return None
+                next_check = work + CHECK_INTERVAL
+            ended = 0
+            for other in filed:
+                # Segments ending left of this one can not cross it or any
+                # later one.
+                if other[1] < left:
+                    ended += 1
+                    continue
+                if other[3] < top or other[2] > bottom or max( first, other[4] ) != band:
+                    continue
+                cx, cy, fx, fy = other[6:]
+                turn_c = ex * ( cy - ay ) - ey * ( cx - ax )
+                turn_d = ex * ( cy + fy - ay ) - ey * ( cx + fx - ax )
+                if turn_c * turn_d >= 0:
+                    continue
+                turn_a = fx * ( ay - cy ) - fy * ( ax - cx )
+                turn_b = fx * ( ay + ey - cy ) - fy * ( ax + ex - cx )
+                if turn_a * turn_b < 0:
+                    crossings += 1
+            if ended * 2 > len( filed ):
+                filed = [ other for other in filed if other[1] >= left ]
+                bands[ band ] = filed
+            filed.append( box )
+    return crossings
+
+class CrossingStats( object ):
+    """
+    Outcome of a crossing minimisation run. `before` and `after` are None
+    if the time budget ran out before the crossings could be counted, in
+    which case the layout is left as it was.
+    """
+
+    def __init__( self, before, after, sweeps, exhausted ):
+        self.before = before
+        self.after = after
+        self.sweeps = sweeps
+        # True if the sweep or time budget ran out before convergence.
+        self.exhausted = exhausted
+
+    @property
+    def measured( self ):
+        return self.before is not None
+
+    @property
+    def removed( self ):
+        if not self.measured:
+            return 0
+        return self.before - self.after
+
+    def __repr__( self ):
+        return "CrossingStats(before=%s, after=%s, sweeps=%d, exhausted=%s)" % ( self.before, self.after, self.sweeps, self.exhausted )
+
+class LayeredGraph( object ):
+    """
+    Layered view of a laid out graph.
+
+    `positions` maps each node to its (x, y) cell and `arcs` lists
+    (parent, child) pairs with the parent left of the child or directly
+    above it. `layers` holds the current order of every layer; a layer's
+    nodes other than dummies take the cells of their row from left to
+    right in that order (see `cells`).
+
+    Arcs spanning many rows make many dummies, so building the layers stops
+    if `deadline` passes; `complete` is False then and `minimise` does
+    nothing.
+    """
+
+    def __init__( self, positions, arcs, deadline=None ):
+        rows = sorted( set( [ y for x, y in positions.values() ] ) )
+        rank = dict( ( y, i ) for i, y in enumerate( rows ) )
+        # Node -> sort key for the initial ordering of its layer.
+        keys = {}
+        layers = [ [] for y in rows ]
+        for node, ( x, y ) in positions.items():
+            layers[ rank[ y ] ].append( node )
+            keys[ node ] = ( x, 0 )
+        self.up = dict( ( node, [] ) for node in positions )
+        self.down = dict( ( node, [] ) for node in positions )
+        self.parents = dict( ( node, [] ) for node in positions )
+        self.children = dict( ( node, [] ) for node in positions )
+        self.dummies = set()
+        self.complete = False
+        made = 0
+        next_check = 0
+        for number, ( parent, child ) in enumerate( arcs ):
+            self.parents[ child ].append( parent )
+            self.children[ parent ].append( child )
+            parent_x, parent_y = positions[ parent ]
+            child_x, child_y = positions[ child ]
+            span = rank[ child_y ] - rank[ parent_y ]
+            if span == 0:
+                continue
+            upper = parent
+            for k in range( 1, span ):
+                made += 1
+                if deadline is not None and made >= next_check:
+                    if time.time() > deadline:
+                        return
+                    next_check = made + CHECK_INTERVAL
+                dummy = ( 'dummy', number, k )
+                layers[ rank[ parent_y ] + k ].append( dummy )
+                keys[ dummy ] = ( parent_x + ( child_x - parent_x ) * float( k ) / span, 1 )
+                self.dummies.add( dummy )
+                self.up[ dummy ] = []
+                self.down[ dummy ] = []
+                self._link( upper, dummy )
+                upper = dummy
+            self._link( upper, child )
+        for layer in layers:
+            layer.sort( key=keys.get )
+        self.layers = layers
+        # Cells of every row, left to right, and the column of every node.
+        self.row_cells = [ sorted( [ positions[ node ] for node in layer if node not in self.dummies ] ) for layer in layers ]
+        self.x = dict( ( node, x ) for node, ( x, y ) in positions.items() )
+        self.position = {}
+        for layer in layers:
+            self._number( layer )
+        self.complete = True
+
+    def _link( self, upper, lower ):
+        self.down[ upper ].append( lower )
+        self.up[ lower ].append( upper )
+
+    def _number( self, layer ):
+        for i, node in enumerate( layer ):
+            self.position[ node ] = i
+
+    def _key( self, node, neighbours, heuristic ):
+        if not neighbours:
+            return self.position[ node ]
+        places = [ self.position[ neighbour ] for neighbour in neighbours ]
+        if heuristic == MEDIAN:
+            places.sort()
+            middle = len( places ) // 2
+            if len( places ) % 2:
+                return places[ middle ]
+            return ( places[ middle - 1 ] + places[ middle ] ) / 2.0
+        return float( sum( places ) ) / len( places )
+
+    def _keeps_parents_left( self, nodes, columns ):
+        """
+        True if giving `nodes` the x coordinates `columns` keeps all their
+        parents at or left of them and all their children at or right.
+        """
+        x = self.x
+        moved = dict( zip( nodes, columns ) )
+        for node, column in moved.items():
+            for parent in self.parents[ node ]:
+                if moved.get( parent, x[ parent ] ) > column:
+                    return False
+            for child in self.children[ node ]:
+                if column > moved.get( child, x[ child ] ):
+                    return False
+        return True
+
+    def _sweep( self, layer_numbers, neighbours, heuristic, deadline ):
+        """
+        Reorder the layers `layer_numbers` in turn. Returns False if
+        `deadline` passed before all of them were done.
+        """
+        for i in layer_numbers:
+            if deadline is not None and time.time() > deadline:
+                return False
+            layer = self.layers[ i ]
+            keyed = [ ( self._key( node, neighbours[ node ], heuristic ), self.position[ node ], node ) for node in layer ]
+            keyed.sort()
+            ordered = [ node for key, position, node in keyed ]
+            if ordered == layer:
+                continue
+            nodes = [ node for node in ordered if node not in self.dummies ]
+            columns = [ x for x, y in self.row_cells[ i ] ]
+            if not self._keeps_parents_left( nodes, columns ):
+                continue
+            for node, column in zip( nodes, columns ):
+                self.x[ node ] = column
+            self._number( ordered )
+            self.layers[ i ] = ordered
+        return True
+
+    def cells( self ):
+        """
+        Node -> cell for the current order of the layers.
+        """
+        cells = {}
+        for layer, row_cells in zip( self.layers, self.row_cells ):
+            nodes = [ node for node in layer if node not in self.dummies ]
+            cells.update( zip( nodes, row_cells ) )
+        return cells
+
+    def minimise( self, evaluate, before, max_sweeps=MAX_SWEEPS, deadline=None, heuristic=BARYCENTER ):
+        """
+        Reorder the layers to reduce crossings within the given budget.
+        `evaluate` is called with the cells after every complete sweep and
+        returns the number of crossings of the layout, or None if `deadline`
+        passed; `before` is the number for the current order.
+        Leaves the best order seen in `layers` and returns a `CrossingStats`.
+        """
+        if not self.complete:
+            return CrossingStats( before, before, 0, True )
+        best = before
+        best_layers = [ list( layer ) for layer in self.layers ]
+        sweeps = 0
+        exhausted = False
+        stale = 0
+        while best > 0 and stale < 2:
+            if sweeps >= max_sweeps:
+                exhausted = True
+                break
+            if sweeps % 2 == 0:
+                finished = self._sweep( range( 1, len( self.layers ) ), self.up, heuristic, deadline )
+            else:
+                finished = self._sweep( range( len( self.layers ) - 2, -1, -1 ), self.down, heuristic, deadline )
+            sweeps += 1
+            if not finished:
+                # A partial sweep is not counted; the time is up anyway.
+                exhausted = True
+                break
+            crossings = evaluate( self.cells() )
+            if crossings is None:
+                exhausted = True
+                break
+            if crossings < best:
+                best = crossings
+                best_layers = [ list( layer ) for layer in self.layers ]
+                stale = 0
+            else:
+                stale += 1
+        self.layers = best_layers
+        for layer in self.layers:
+            self._number( layer )
+        return CrossingStats( before, best, sweeps, exhausted )
@@ -0,0 +1,483 @@
+"""
+Layout of Galaxy workflows on the WS-PGRADE (gUSE) canvas.
+
+The engine works on the dictionary produced by
+`WorkflowController._workflow_to_dict` and fills in everything the
+WS-PGRADE workflow.xml needs: job coordinates, port ids, port coordinates
+and the `prejob`/`preoutput` references of every input port. All lookups
+are served from dictionaries (node -> position, node -> parents and
+(step, output name) -> output) or from the `WorkflowGraph` of the jobs,
+so apart from the budgeted crossing minimisation (see
+`galaxy.workflow.wspgrade.crossings`) a layout is linear in the number of
+steps and connections.
+
+Port placement relies on every parent being left of its child or directly
+above it; the coordinates phase places jobs that way and the crossing
+minimisation keeps it so.
+"""
+
+import time
+from bisect import bisect_left
+from operator import itemgetter
+
+from galaxy.workflow.graph import WorkflowGraph, CycleError
+from galaxy.workflow.wspgrade.ports import PortAllocator, slot_offset, UP, DOWN
+from galaxy.workflow.wspgrade.crossings import LayeredGraph, CrossingStats, count_crossings, segments_cross, MAX_SWEEPS, TIME_LIMIT, BARYCENTER
+
+# Distance between two neighbouring jobs on the canvas.
+JOB_DISTANCE = 120
+# Coordinates of the first row of jobs; roots are placed left to right.
+FIRST_COLUMN = -100
+FIRST_ROW = 20
+# Characters stripped from the end of a tool version, e.g. '1.0.1 (beta)'.
+VERSION_SUFFIX = ' abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ()'
+
+def is_job( step ):
+    """
+    Tool steps become WS-PGRADE jobs, data inputs become free input ports.
+    """
+    return step['type'] == 'tool' or step['type'] is None
+
+class LayoutEngine( object ):
+    """
+    Computes the WS-PGRADE layout of a workflow dictionary in place.
+
+    The phases are run in the order returned by `phases`; `layout` runs all
+    of them. `max_sweeps`, `time_limit` (in seconds, None for no limit) and
+    `heuristic` bound and tune the crossing minimisation, whose outcome is
+    left in `crossings` as a `CrossingStats`.
+    """
+
+    def __init__( self, workflow_dict, max_sweeps=MAX_SWEEPS, time_limit=TIME_LIMIT, heuristic=BARYCENTER ):
+        self.steps = workflow_dict['steps']
+        self.max_sweeps = max_sweeps
+        self.time_limit = time_limit
+        self.heuristic = heuristic
+        # The tool steps in dictionary order are the nodes of the graph;
+        # connections from data inputs are not arcs.
+        self.graph = WorkflowGraph.from_step_dicts( self.steps, include=is_job )
+        self.jobs = [ step['id'] for step in self.graph.steps ]
+        self.input_nodes = set( [ step['id'] for step_num, step in self.steps.items() if step['type'] == 'data_input' ] )
+        # Job order and positions by graph node.
+        self.order = None
+        self.positions = [ None ] * len( self.graph )
+        self.outputs = {}
+        self.ports = {}
+        self.visited = set()
+        # (step, parent output, input connection) of every connection
+        # between two jobs, filled in by `assign_prejobs`, and the outputs
+        # and input connections of all jobs, whose ports are placed.
+        self.connections = []
+        self.port_holders = []
+        # Seconds the last placement of the ports took.
+        self.port_seconds = 0.0
+        self.crossings = None
+
+    def phases( self ):
+        return [ ( 'sort', self.sort ),
+                 ( 'reorder', self.order_parents_first ),
+                 ( 'coordinates', self.assign_coordinates ),
+                 ( 'port_ids', self.assign_port_ids ),
+                 ( 'prejobs', self.assign_prejobs ),
+                 ( 'ports', self.assign_port_coordinates ),
+                 ( 'crossings', self.minimise_crossings ) ]
+
+    def layout( self, timer=None ):
+        """
+        Run all phases, timing each one with `timer` (a `PhaseTimer`) if
+        one is given.
+        """
+        for name, phase in self.phases():
+            if timer is None:
+                phase()
+            else:
+                with timer.phase( name ):
+                    phase()
+        return self
+
+    def sort( self ):
+        """
+        Topologically sort the jobs. Roots are kept on a stack, so the most
+        recently released job is emitted first.
+        """
+        self.order = self.graph.depth_first_order()
+
+    def order_parents_first( self ):
+        """
+        Move every root job directly in front of its first child, in one pass.
+
+        Children are never roots, so the jobs that stay put keep their
+        relative order and a root's first child can be read off the sorted
+        order up front. Roots sharing a first child are placed in front of it
+        in their sorted order.
+        """
+        graph = self.graph
+        position = [ 0 ] * len( graph )
+        for i, node in enumerate( self.order ):
+            position[ node ] = i
+        # First child -> roots to be placed directly in front of it.
+        moved = {}
+        for node in self.order:
+            if graph.num_parents( node ) or not graph.num_children( node ):
+                continue
+            children = graph.children( node )
+            first_child = children[0]
+            for child in children[1:]:
+                if position[ child ] < position[ first_child ]:
+                    first_child = child
+            moved.setdefault( first_child, [] ).append( node )
+        moved_roots = set()
+        for roots in moved.values():
+            moved_roots.update( roots )
+        order = []
+        for node in self.order:
+            if node in moved_roots:
+                continue
+            order.extend( moved.get( node, () ) )
+            order.append( node )
+        self.order = order
+
+    def assign_coordinates( self ):
+        """
+        Place roots left to right on the first row and every other job below
+        or to the right of its parents, moving right until a free cell is found.
+
+        A job that lands on an occupied cell steps right past the first job
+        placed there, then past any job placed after that one in the next
+        cell, and so on. Where such a walk ends only depends on the job it
+        steps past first, so the end of the walk after every placed job is
+        remembered. The ends are kept in a union-find structure: placing a
+        job on a cell where walks used to end makes all of them continue
+        behind the new job.
+        """
+        x_max = FIRST_COLUMN
+        positions = self.positions
+        # Cell -> placement number of the first job placed there.
+        first = {}
+        # Placement number -> end of the walk continuing behind that job.
+        after = []
+        # Walk ends: cell of each end, union-find parents and the end that
+        # is currently open at each cell.
+        end_cells = []
+        end_parents = []
+        open_ends = {}
+        def open_end( cell ):
+            if cell not in open_ends:
+                open_ends[ cell ] = len( end_cells )
+                end_cells.append( cell )
+                end_parents.append( len( end_parents ) )
+            return open_ends[ cell ]
+        def find( end ):
+            root = end
+            while end_parents[ root ] != root:
+                root = end_parents[ root ]
+            while end_parents[ end ] != root:
+                end_parents[ end ], end = root, end_parents[ end ]
+            return root
+        for count, node in enumerate( self.order ):
+            parents = self.graph.parents( node )
+            if not parents:
+                x_max += JOB_DISTANCE
+                x, y = x_max, FIRST_ROW
+            else:
+                x, y = positions[ parents[0] ]
+                if len( parents ) == 1:
+                    y += JOB_DISTANCE
+                for parent in parents[1:]:
+                    parent_x, parent_y = positions[ parent ]
+                    if x == parent_x:
+                        x += JOB_DISTANCE
+                    elif x < parent_x:
+                        x = parent_x
+                    if y == parent_y:
+                        y += JOB_DISTANCE
+                    elif y < parent_y:
+                        y = parent_y
+                if ( x, y ) in first:
+                    x, y = end_cells[ find( after[ first[ ( x, y ) ] ] ) ]
+                if x_max < x:
+                    x_max = x
+            positions[ node ] = ( x, y )
+            cell = ( x, y )
+            first.setdefault( cell, count )
+            # Walks behind this job end in the next cell for now.
+            after.append( open_end( ( x + JOB_DISTANCE, y ) ) )
+            # Walks that ended here now continue behind this job.
+            if cell in open_ends:
+                end_parents[ open_ends.pop( cell ) ] = after[ count ]
+
+    def assign_port_ids( self ):
+        """
+        Store job coordinates, parameters, version and port sequence numbers.
+        """
+        self.store_positions()
+        for step_num, step in self.steps.items():
+            if not is_job( step ):
+                continue
+            step['param'] = ''
+            step['tool_version'] = ( step['tool_version'] or '' ).rstrip( VERSION_SUFFIX )
+            for input in step['inputs']:
+                step['param'] += '-' + input['name'] + ' '
+            seq = 0
+            for input_name, input_connection in step['input_connections'].items():
+                input_connection['idinput'] = seq
+                seq += 1
+                self.port_holders.append( input_connection )
+            for output in step['outputs']:
+                output['id'] = seq
+                seq += 1
+                self.outputs[ ( step['id'], output['name'] ) ] = output
+                self.port_holders.append( output )
+
+    def store_positions( self ):
+        """
+        Store the job coordinates in the steps.
+        """
+        for node, step in enumerate( self.graph.steps ):
+            x, y = self.positions[ node ]
+            step['position'] = dict( left=x, top=y )
+
+    def assign_prejobs( self ):
+        """
+        Point every input port at the job and output port feeding it.
+        """
+        for step_num, step in self.steps.items():
+            if not is_job( step ):
+                continue
+            for input_name, input_connection in step['input_connections'].items():
+                if input_connection['id'] in self.input_nodes:
+                    input_connection['prejob'] = ""
+                    input_connection['preoutput'] = ""
+                else:
+                    parent_step = self.steps[ input_connection['id'] ]
+                    input_connection['prejob'] = parent_step['name'] + parent_step['tool_version']
+                    output = self.outputs.get( ( parent_step['id'], input_connection['output_name'] ) )
+                    if output is not None:
+                        input_connection['preoutput'] = output['id']
+                        self.connections.append( ( step, output, input_connection ) )
+
+    def _port( self, node, slot ):
+        position = self.steps[ node ]['position']
+        dx, dy = slot_offset( slot )
+        return ( position['left'] + dx, position['top'] + dy )
+
+    def _take_output_port( self, node, output, first, start ):
+        """
+        Give `output` of job `node` slot `first`, or the next free slot
+        walking down from `start`.
+        """
+        slot = self.ports[ node ].allocate( first, start, DOWN )
+        output['x'], output['y'] = self._port( node, slot )
+        self.visited.add( id( output ) )
+
+    def _take_input_port( self, node, input_connection, first, start ):
+        """
+        Give `input_connection` of job `node` slot `first`, or the next free
+        slot walking up from `start`.
+        """
+        slot = self.ports[ node ].allocate( first, start, UP )
+        input_connection['x'], input_connection['y'] = self._port( node, slot )
+
+    def assign_port_coordinates( self ):
+        """
+        Place ports around the jobs, children first. An output port is placed
+        by the first child that uses it, facing that child; the remaining
+        outputs of a job are placed at the bottom.
+        """
+        started = time.time()
+        self.visited = set()
+        for node in self.jobs:
+            self.ports[ node ] = PortAllocator()
+        for index in reversed( self.order ):
+            step = self.graph.steps[ index ]
+            node = step['id']
+            left, top = step['position']['left'], step['position']['top']
+            for output in step['outputs']:
+                if id( output ) not in self.visited:
+                    self._take_output_port( node, output, 15, 14 )
+            # Connections from other jobs ordered by the parent's column, then
+            # bottom up; parents on the same row as this job come first.
+            tool_connections = []
+            for input_name, input_connection in step['input_connections'].items():
+                if input_connection['id'] in self.input_nodes:
+                    self._take_input_port( node, input_connection, 0, 1 )
+                else:
+                    tool_connections.append( input_connection )
+            ports_order = []
+            for position, input_connection in enumerate( tool_connections ):
+                parent_position = self.steps[ input_connection['id'] ]['position']
+                ports_order.append( ( int( input_connection['id'] ), parent_position['left'], parent_position['top'], position ) )
+            ports_order = sorted( sorted( ports_order, key=itemgetter( 2 ), reverse=True ), key=itemgetter( 1 ) )
+            same_row = [ entry for entry in ports_order if entry[2] == top ]
+            same_row.reverse()
+            ports_order = same_row + [ entry for entry in ports_order if entry[2] != top ]
+            # Each entry takes the next unassigned connection from its parent,
+            # scanning the connections cyclically from the last one assigned.
+            pending = {}
+            for position, input_connection in enumerate( tool_connections ):
+                pending.setdefault( input_connection['id'], [] ).append( position )
+            cursor = 0
+            for entry in ports_order:
+                positions = pending[ entry[0] ]
+                k = bisect_left( positions, cursor )
+                if k == len( positions ):
+                    k = 0
+                position = positions.pop( k )
+                cursor = position + 1
+                input_connection = tool_connections[ position ]
+                parent = input_connection['id']
+                if left == self.steps[ parent ]['position']['left']:
+                    # Parent above: input on top, output at the bottom.
+                    first, start, out_first, out_start = 7, 5, 15, 14
+                else:
+                    # Parent to the left: input on the left, output on the right.
+                    first, start, out_first, out_start = 0, 1, 11, 10
+                output = self.outputs.get( ( parent, input_connection['output_name'] ) )
+                if output is not None and id( output ) not in self.visited:
+                    self._take_output_port( parent, output, out_first, out_start )
+                self._take_input_port( node, input_connection, first, start )
+        self.port_seconds = time.time() - started
+
+    def segments( self ):
+        """
+        The lines WS-PGRADE draws between jobs, from output port to input
+        port.
+        """
+        return [ ( ( output['x'], output['y'] ), ( input_connection['x'], input_connection['y'] ) )
+                 for step, output, input_connection in self.connections ]
+
+    def count_crossings( self, deadline=None ):
+        return count_crossings( self.segments(), deadline )
+
+    def _move_jobs( self, cells ):
+        """
+        Put the jobs on `cells` (node -> cell) and place the ports again.
+        """
+        for node, cell in cells.items():
+            self.positions[ node ] = cell
+        self.store_positions()
+        self.assign_port_coordinates()
+
+    def _save( self ):
+        return list( self.positions ), [ ( holder['x'], holder['y'] ) for holder in self.port_holders ]
+
+    def _restore( self, saved ):
+        positions, ports = saved
+        self.positions = list( positions )
+        self.store_positions()
+        for holder, ( x, y ) in zip( self.port_holders, ports ):
+            holder['x'], holder['y'] = x, y
+
+    def minimise_crossings( self ):
+        """
+        Reduce the crossings of the drawn connections by reordering the jobs
+        within the rows of the canvas and by untangling the input ports of
+        every job, keeping each change only if it lowers the count; see
+        `galaxy.workflow.wspgrade.crossings`. The outcome is left in
+        `crossings`.
+
+        Placing the ports can not be interrupted, so a step that places them
+        again is only started if that fits in the time left, judging by how
+        long the ports phase took; building the layers takes about as long.
+        """
+        started = time.time()
+        deadline = None
+        if self.time_limit is not None:
+            deadline = started + self.time_limit
+        def time_left( seconds ):
+            return deadline is None or time.time() + seconds < deadline
+        before = self.count_crossings( deadline )
+        if before is None:
+            self.crossings = CrossingStats( None, None, 0, True )
+            return
+        count_seconds = time.time() - started
+        stats = CrossingStats( before, before, 0, False )
+        if before and time_left( 2 * self.port_seconds + count_seconds ):
+            graph = self.graph
+            arcs = []
+            for node in xrange( len( graph ) ):
+                for parent in graph.parents( node ):
+                    arcs.append( ( parent, node ) )
+            cells = dict( ( node, self.positions[ node ] ) for node in self.order )
+            # Fewest crossings seen, the layout that has them and whether it
+            # is the current one.
+            best = [ before, self._save(), True ]
+            def evaluate( cells ):
+                if not time_left( self.port_seconds ):
+                    return None
+                self._move_jobs( cells )
+                crossings = self.count_crossings( deadline )
+                if crossings is not None and crossings < best[0]:
+                    best[:] = [ crossings, self._save(), True ]
+                else:
+                    best[2] = False
+                return crossings
+            stats = LayeredGraph( cells, arcs, deadline ).minimise( evaluate, before, max_sweeps=self.max_sweeps,
+                                                                    deadline=deadline, heuristic=self.heuristic )
+            if not best[2]:
+                self._restore( best[1] )
+        elif before:
+            # No time to reorder the rows; untangling may still fit.
+            stats.exhausted = True
+        if stats.after and time_left( count_seconds ):
+            ports = [ ( input_connection['x'], input_connection['y'] ) for step, output, input_connection in self.connections ]
+            self.untangle_ports( deadline )
+            crossings = self.count_crossings( deadline )
+            if crossings is not None and crossings < stats.after:
+                stats.after = crossings
+            else:
+                for ( step, output, input_connection ), ( x, y ) in zip( self.connections, ports ):
+                    input_connection['x'], input_connection['y'] = x, y
+                if crossings is None:
+                    stats.exhausted = True
+        self.crossings = stats
+
+    def untangle_ports( self, deadline=None ):
+        """
+        Swap the input ports of the connections converging on each job so
+        that they do not cross each other.
+
+        The connections of a job are first handed its input ports in the
+        order of their output ports across the direction they come from
+        (perpendicular to the line from the mean output port to the mean
+        input port), which leaves few crossings; then the ports of any two
+        connections that still cross are swapped, which shortens the pair,
+        until no two cross. Stops once `deadline` passes.
+        """
+        connections = {}
+        for step, output, input_connection in self.connections:
+            connections.setdefault( step['id'], [] ).append( ( output, input_connection ) )
+        for pairs in connections.values():
+            if len( pairs ) < 2:
+                continue
+            if deadline is not None and time.time() > deadline:
+                return
+            count = float( len( pairs ) )
+            dx = sum( [ input_connection['x'] - output['x'] for output, input_connection in pairs ] ) / count
+            dy = sum( [ input_connection['y'] - output['y'] for output, input_connection in pairs ] ) / count
+            across = lambda x, y: dx * y - dy * x
+            ports = sorted( [ ( input_connection['x'], input_connection['y'] ) for output, input_connection in pairs ],
+                            key=lambda port: across( *port ) )
+            pairs.sort( key=lambda pair: across( pair[0]['x'], pair[0]['y'] ) )
+            for ( output, input_connection ), port in zip( pairs, ports ):
+                input_connection['x'], input_connection['y'] = port
+            swapped = True
+            while swapped:
+                swapped = False
+                for i in range( len( pairs ) - 1 ):
+                    if deadline is not None and time.time() > deadline:
+                        return
+                    output, input_connection = pairs[i]
+                    for other_output, other_connection in pairs[ i + 1: ]:
+                        if segments_cross( ( output['x'], output['y'] ), ( input_connection['x'], input_connection['y'] ),
+                                           ( other_output['x'], other_output['y'] ), ( other_connection['x'], other_connection['y'] ) ):
+                            input_connection['x'], input_connection['y'], other_connection['x'], other_connection['y'] = \
+                                other_connection['x'], other_connection['y'], input_connection['x'], input_connection['y']
+                            swapped = True
+
+def layout_workflow( workflow_dict, timer=None, **kwargs ):
+    """
+    Lay out `workflow_dict` for WS-PGRADE in place and return the engine;
+    keyword arguments are passed on to `LayoutEngine`.
+    """
+    return LayoutEngine( workflow_dict, **kwargs ).layout( timer=timer )
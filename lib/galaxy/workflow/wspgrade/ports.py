@@ -0,0 +1,68 @@
+"""
+Port slots around a WS-PGRADE job.
+
+The first sixteen slots form a ring around the job: four on the left side,
+four on top, four on the right side and four at the bottom. Jobs with more
+ports than that get further rings, each one `RING_DISTANCE` pixels further
+out than the previous one, so no two ports of a job ever share a position.
+"""
+
+# Offsets of the first ring of slots from the job's upper left corner.
+PORT_X = [ -15, -15, -15, -15, 0, 15, 30, 45, 60, 60, 60, 60, 0, 15, 30, 45 ]
+PORT_Y = [ 45, 30, 15, 0, -15, -15, -15, -15, 0, 15, 30, 45, 60, 60, 60, 60 ]
+SLOTS_PER_RING = len( PORT_X )
+# Outward direction of the side each slot of a ring lies on.
+SIDE_DIRECTION = [ ( -1, 0 ) ] * 4 + [ ( 0, -1 ) ] * 4 + [ ( 1, 0 ) ] * 4 + [ ( 0, 1 ) ] * 4
+RING_DISTANCE = 15
+
+# Search directions for `PortAllocator.allocate`.
+UP = 1
+DOWN = -1
+
+def slot_offset( slot ):
+    """
+    Offset of `slot` from the job's upper left corner; slot n lies on ring
+    n / 16, in the position of slot n % 16 of the first ring.
+    """
+    ring, base = divmod( slot, SLOTS_PER_RING )
+    dx, dy = SIDE_DIRECTION[ base ]
+    return ( PORT_X[ base ] + dx * RING_DISTANCE * ring, PORT_Y[ base ] + dy * RING_DISTANCE * ring )
+
+def lowest_bit( mask ):
+    return ( mask & -mask ).bit_length() - 1
+
+class PortAllocator( object ):
+    """
+    Hands out the port slots of one job.
+
+    Free slots of the first ring are kept in a bitmask, so the next free slot
+    in either direction is found with a couple of integer operations. Slots
+    of the outer rings are only used once the first ring is full and are
+    handed out in order from a cursor.
+    """
+
+    def __init__( self ):
+        self.free = ( 1 << SLOTS_PER_RING ) - 1
+        self.next_outer = SLOTS_PER_RING
+
+    def allocate( self, first, start, direction ):
+        """
+        Take slot `first` if it is free, otherwise the first free slot met
+        walking the ring from slot `start` in `direction` (wrapping around),
+        otherwise the next slot on the outer rings.
+        """
+        free = self.free
+        if free & ( 1 << first ):
+            slot = first
+        elif not free:
+            slot = self.next_outer
+            self.next_outer += 1
+            return slot
+        elif direction == UP:
+            above = free >> start << start
+            slot = lowest_bit( above or free )
+        else:
+            below = free & ( ( 2 << start ) - 1 )
+            slot = ( below or free ).bit_length() - 1
+        self.free = free & ~( 1 << slot )
+        return slot
@@ -0,0 +1,162 @@
+"""
+Reading WS-PGRADE (gUSE) workflow archives back into Galaxy workflows.
+
+Only the <graf> section of workflow.xml is read. The <real> section repeats
+every job and only adds the <execute> parameters. The document is parsed
+incrementally and every <job> element is dropped as soon as it has been
+read, so memory does not grow with the size of the document, only with the
+number of jobs and ports kept.
+
+The result is a dictionary in the format written by "Download or Export"
+(format-version 0.1), ready for `WorkflowController._workflow_from_dict`.
+gUSE has no data input steps: every input port without a `prejob` becomes
+a Galaxy data input step of its own. Jobs are matched to tools by their
+name, which the export builds from the tool name and version.
+"""
+
+import zipfile
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from galaxy.workflow.wspgrade.layout import VERSION_SUFFIX
+
+# Horizontal distance between a data input step and the job it feeds.
+INPUT_OFFSET = 200
+
+class ArchiveError( Exception ):
+    """
+    The archive is not a WS-PGRADE workflow that can be imported.
+    """
+
+def tool_index( tools ):
+    """
+    Map the job names the export gives to `tools` back to tool ids. Of
+    several tools with the same name and version the one with the lowest
+    id wins.
+    """
+    index = {}
+    for tool in sorted( tools, key=lambda tool: tool.id, reverse=True ):
+        index[ tool.name + ( tool.version or '' ).rstrip( VERSION_SUFFIX ) ] = tool.id
+    return index
+
+def open_document( fileobj ):
+    """
+    Open the workflow.xml member of the archive `fileobj` for reading.
+    """
+    try:
+        archive = zipfile.ZipFile( fileobj )
+    except zipfile.BadZipfile, e:
+        raise ArchiveError( "not a zip archive: %s" % e )
+    for name in archive.namelist():
+        if name == 'workflow.xml' or name.endswith( '/workflow.xml' ):
+            return archive.open( name )
+    raise ArchiveError( "the archive contains no workflow.xml" )
+
+def read_jobs( document ):
+    """
+    Parse the <graf> section of `document`. Returns the workflow name, its
+    description and the jobs as dictionaries with name, text, x, y, inputs
+    (name, prejob, preoutput, x, y) and outputs (seq -> name).
+    """
+    name = description = graf = None
+    jobs = []
+    job = None
+    context = iterparse( document, events=( 'start', 'end' ) )
+    try:
+        for event, element in context:
+            tag = element.tag
+            if event == 'start':
+                if tag == 'workflow':
+                    name = element.get( 'name' )
+                elif tag == 'graf':
+                    graf = element
+                elif tag == 'real':
+                    # Everything needed has been read.
+                    description = element.get( 'text' )
+                    break
+                elif graf is not None and tag == 'job':
+                    job = dict( name=element.get( 'name', '' ), text=element.get( 'text', '' ),
+                                x=coordinate( element.get( 'x' ) ), y=coordinate( element.get( 'y' ) ),
+                                inputs=[], outputs={} )
+                elif job is not None and tag == 'input':
+                    job['inputs'].append( dict( name=element.get( 'name' ), prejob=element.get( 'prejob', '' ),
+                                                preoutput=element.get( 'preoutput', '' ),
+                                                x=coordinate( element.get( 'x' ) ), y=coordinate( element.get( 'y' ) ) ) )
+                elif job is not None and tag == 'output':
+                    job['outputs'][ element.get( 'seq' ) ] = element.get( 'name' )
+            elif tag == 'job' and job is not None:
+                jobs.append( job )
+                job = None
+                # Drop the parsed job from the tree.
+                graf.clear()
+            elif tag == 'graf':
+                graf = None
+    except SyntaxError, e:
+        raise ArchiveError( "workflow.xml is not well formed: %s" % e )
+    if name is None:
+        raise ArchiveError( "workflow.xml has no <workflow> element" )
+    return name, description or '', jobs
+
+def coordinate( value ):
+    try:
+        return int( float( value ) )
+    except ( TypeError, ValueError ):
+        return 0
+
+def workflow_dict_from_archive( fileobj, tool_ids ):
+    """
+    Read the archive `fileobj` into a format-version 0.1 workflow
+    dictionary. `tool_ids` maps job names to tool ids (see `tool_index`).
+    Tool steps get no `tool_state`; the caller fills in the default state
+    of each tool. Raises `ArchiveError` naming every job without a tool,
+    or every job name used more than once, since the export names jobs
+    after their tool and a `prejob` can then not be resolved.
+    """
+    document = open_document( fileobj )
+    try:
+        name, description, jobs = read_jobs( document )
+    finally:
+        document.close()
+    missing = sorted( set( [ job['name'] for job in jobs if job['name'] not in tool_ids ] ) )
+    if missing:
+        raise ArchiveError( "no tool found for the jobs: %s" % ', '.join( missing ) )
+    # Tool steps first, in document order, then the data inputs.
+    job_ids = {}
+    duplicates = set()
+    for step_id, job in enumerate( jobs ):
+        if job['name'] in job_ids:
+            duplicates.add( job['name'] )
+        job_ids[ job['name'] ] = step_id
+    if duplicates:
+        # A prejob could refer to any of them.
+        raise ArchiveError( "job names are not unique, connections cannot be resolved: %s" % ', '.join( sorted( duplicates ) ) )
+    steps = {}
+    next_id = len( jobs )
+    for step_id, job in enumerate( jobs ):
+        input_connections = {}
+        for input in job['inputs']:
+            parent_id = job_ids.get( input['prejob'] )
+            output_name = None
+            if parent_id is not None:
+                output_name = jobs[ parent_id ]['outputs'].get( input['preoutput'] )
+            if output_name is None:
+                # A free input port: give it a data input step of its own.
+                steps[ next_id ] = dict( id=next_id, type='data_input', tool_id=None, tool_version=None,
+                                         name='Input dataset', tool_state=json.dumps( dict( name=input['name'] ) ),
+                                         tool_errors=None, annotation='', input_connections={},
+                                         position=dict( left=job['x'] - INPUT_OFFSET, top=input['y'] ) )
+                input_connections[ input['name'] ] = dict( id=next_id, output_name='output' )
+                next_id += 1
+            else:
+                input_connections[ input['name'] ] = dict( id=parent_id, output_name=output_name )
+        steps[ step_id ] = dict( id=step_id, type='tool', tool_id=tool_ids[ job['name'] ], tool_version=None,
+                                 name=job['name'], tool_state=None, tool_errors=None, annotation=job['text'],
+                                 input_connections=input_connections, position=dict( left=job['x'], top=job['y'] ) )
+    return { 'a_galaxy_workflow': 'true', 'format-version': '0.1', 'name': name,
+             'annotation': description, 'steps': steps }
@@ -0,0 +1,119 @@
+"""
+Phase timing of WS-PGRADE exports.
+
+A `PhaseTimer` records how long each named phase of one export took,
+together with counts such as the number of steps and connections. It can
+be formatted for the log or as a Server-Timing header. A `TimingRegistry`
+keeps the most recent samples of every phase across exports and reports
+percentiles over them; exports served from the cache are totalled apart
+from conversions.
+"""
+
+import time, threading
+from collections import deque
+from contextlib import contextmanager
+
+# Samples kept per phase by a `TimingRegistry`.
+WINDOW = 1000
+
+class PhaseTimer( object ):
+    """
+    Durations of the named phases of one export, in the order they ran;
+    a phase run several times accumulates.
+    """
+
+    def __init__( self ):
+        self.started = time.time()
+        self.names = []
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def phase( self, name ):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add( name, time.time() - start )
+
+    def add( self, name, seconds ):
+        if name not in self.seconds:
+            self.names.append( name )
+            self.seconds[ name ] = 0.0
+        self.seconds[ name ] += seconds
+
+    def count( self, **counts ):
+        self.counts.update( counts )
+
+    def total( self ):
+        return time.time() - self.started
+
+    def phases( self ):
+        return [ ( name, self.seconds[ name ] ) for name in self.names ]
+
+    def format( self ):
+        """
+        One line for the log: counts, then each phase and the total in ms.
+        """
+        parts = [ "%s=%s" % ( name, self.counts[ name ] ) for name in sorted( self.counts ) ]
+        parts.extend( [ "%s=%.1fms" % ( name, seconds * 1000 ) for name, seconds in self.phases() ] )
+        parts.append( "total=%.1fms" % ( self.total() * 1000 ) )
+        return ' '.join( parts )
+
+    def server_timing( self ):
+        """
+        Value of a Server-Timing response header.
+        """
+        return ', '.join( [ "%s;dur=%.1f" % ( name, seconds * 1000 ) for name, seconds in self.phases() ] )
+
+def percentile( ordered, fraction ):
+    """
+    Nearest rank percentile of the sorted, non-empty list `ordered`.
+    """
+    rank = int( fraction * len( ordered ) + 0.5 )
+    return ordered[ min( max( rank, 1 ), len( ordered ) ) - 1 ]
+
+class TimingRegistry( object ):
+    """
+    The last `window` durations of every phase, shared by all requests.
+    """
+
+    def __init__( self, window=WINDOW ):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record( self, timer ):
+        """
+        Add the phases of `timer` and its total, under 'cached_total' if
+        it counted a cache hit (`cached=1`) and 'total' otherwise, so that
+        hits do not mask the duration of conversions.
+        """
+        total = timer.counts.get( 'cached' ) and 'cached_total' or 'total'
+        phases = timer.phases() + [ ( total, timer.total() ) ]
+        self.lock.acquire()
+        try:
+            for name, seconds in phases:
+                if name not in self.samples:
+                    self.samples[ name ] = deque( maxlen=self.window )
+                self.samples[ name ].append( seconds )
+        finally:
+            self.lock.release()
+
+    def summary( self ):
+        """
+        Count, mean, p50, p95 and maximum in ms of every phase.
+        """
+        self.lock.acquire()
+        try:
+            samples = dict( ( name, sorted( values ) ) for name, values in self.samples.items() )
+        finally:
+            self.lock.release()
+        summary = {}
+        for name, values in samples.items():
+            summary[ name ] = dict( count=len( values ),
+                                    mean=sum( values ) * 1000 / len( values ),
+                                    p50=percentile( values, 0.5 ) * 1000,
+                                    p95=percentile( values, 0.95 ) * 1000,
+                                    max=values[-1] * 1000 )
+        return summary
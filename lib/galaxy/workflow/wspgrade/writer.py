@@ -0,0 +1,130 @@
+"""
+Incremental writer for the WS-PGRADE workflow.xml.
+
+The document lists every job twice, once in the <graf> section and once in
+the <real> section, and the two copies only differ by the <execute>
+element of the latter. Each job fragment is built once, written to the
+<graf> section as soon as it is built and, with its <execute> element, to
+a spooled temporary file holding the <real> section until <graf> is
+closed. The spool stays in memory up to `REAL_SPOOL_SIZE` bytes and moves
+to disk beyond, so nothing larger than that is assembled in memory.
+"""
+
+import re, shutil, tempfile
+from xml.sax.saxutils import escape
+
+from galaxy.workflow.wspgrade.layout import is_job
+
+INDENT = '    '
+# Entities needed to keep a value intact inside a double quoted attribute.
+ATTRIBUTE_ENTITIES = { '"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;' }
+# Characters that have to be escaped in an attribute value.
+SPECIAL = re.compile( u'[&<>"\n\r\t]' )
+# Bytes of the <real> section kept in memory before spooling to disk.
+REAL_SPOOL_SIZE = 1024 * 1024
+
+def quote( value ):
+    """
+    Escape `value` for use as an attribute value; byte strings are taken to
+    be UTF-8.
+    """
+    if value is None:
+        return u''
+    elif isinstance( value, ( int, long ) ):
+        return unicode( value )
+    elif isinstance( value, str ):
+        value = value.decode( 'utf-8' )
+    elif not isinstance( value, unicode ):
+        value = unicode( value )
+    if SPECIAL.search( value ) is None:
+        return value
+    return escape( value, ATTRIBUTE_ENTITIES )
+
+def element( name, attributes, level, empty=False ):
+    """
+    Render the start tag (or empty element) `name` at indentation `level`;
+    `attributes` is a list of (name, value) pairs, kept in order.
+    """
+    rendered = u' '.join( [ u'%s="%s"' % ( key, quote( value ) ) for key, value in attributes ] )
+    return u'%s<%s %s%s>\n' % ( INDENT * level, name, rendered, empty and '/' or '' )
+
+class WorkflowXMLWriter( object ):
+    """
+    Writes a workflow dictionary laid out by `LayoutEngine` to the file-like
+    object `out` as WS-PGRADE workflow.xml.
+    """
+
+    def __init__( self, out, encoding='utf-8', spool_size=REAL_SPOOL_SIZE ):
+        self.out = out
+        self.encoding = encoding
+        self.spool_size = spool_size
+
+    def _write( self, text ):
+        if isinstance( text, unicode ):
+            text = text.encode( self.encoding )
+        self.out.write( text )
+
+    def job_fragment( self, step ):
+        """
+        The <job> start tag and the port elements shared by both sections.
+        """
+        parts = [ element( 'job', [ ( 'name', step['name'] + step['tool_version'] ),
+                                    ( 'text', step['annotation'] ),
+                                    ( 'x', step['position']['left'] ),
+                                    ( 'y', step['position']['top'] ) ], 2 ) ]
+        for input_name, input_connection in step['input_connections'].items():
+            parts.append( element( 'input', [ ( 'name', input_name ),
+                                              ( 'prejob', input_connection['prejob'] ),
+                                              ( 'preoutput', input_connection.get( 'preoutput', '' ) ),
+                                              ( 'seq', input_connection['idinput'] ),
+                                              ( 'text', 'Description of Port' ),
+                                              ( 'x', input_connection['x'] ),
+                                              ( 'y', input_connection['y'] ) ], 3, empty=True ) )
+        for output in step['outputs']:
+            parts.append( element( 'output', [ ( 'name', output['name'] ),
+                                               ( 'seq', output['id'] ),
+                                               ( 'text', 'Description of Port' ),
+                                               ( 'x', output['x'] ),
+                                               ( 'y', output['y'] ) ], 3, empty=True ) )
+        return u''.join( parts ).encode( self.encoding )
+
+    def write( self, workflow_name, workflow_description, steps ):
+        """
+        Write the document for the laid out `steps` of a workflow.
+        """
+        self._write( '<?xml version="1.0" encoding="%s" standalone="no"?>\n' % self.encoding.upper() )
+        self._write( element( 'workflow', [ ( 'download', 'all' ),
+                                            ( 'export', 'proj' ),
+                                            ( 'mainabst', '' ),
+                                            ( 'maingraf', workflow_name ),
+                                            ( 'mainreal', workflow_name ),
+                                            ( 'name', workflow_name ) ], 0 ) )
+        self._write( element( 'graf', [ ( 'name', workflow_name ), ( 'text', 'Description of Graph' ) ], 1 ) )
+        end_job = '%s</job>\n' % ( INDENT * 2 )
+        real = tempfile.SpooledTemporaryFile( max_size=self.spool_size )
+        try:
+            for step_num, step in steps.items():
+                if not is_job( step ):
+                    continue
+                fragment = self.job_fragment( step )
+                self._write( fragment )
+                self._write( end_job )
+                real.write( fragment )
+                if step['inputs']:
+                    real.write( element( 'execute', [ ( 'desc', 'null' ),
+                                                      ( 'inh', 'null' ),
+                                                      ( 'key', 'params' ),
+                                                      ( 'label', 'null' ),
+                                                      ( 'value', step['param'] ) ], 3, empty=True ).encode( self.encoding ) )
+                real.write( end_job )
+            self._write( '%s</graf>\n' % INDENT )
+            self._write( element( 'real', [ ( 'abst', '' ),
+                                            ( 'graf', workflow_name ),
+                                            ( 'name', workflow_name ),
+                                            ( 'text', workflow_description ) ], 1 ) )
+            real.seek( 0 )
+            shutil.copyfileobj( real, self.out )
+        finally:
+            real.close()
+        self._write( '%s</real>\n' % INDENT )
+        self._write( '</workflow>\n' )
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Convert Galaxy workflow files (.ga, as written by "Download or Export") to
+WS-PGRADE (gUSE) workflow archives without a Galaxy server.
+
+Each FILE.ga is written to FILE.zip, next to it or in the output directory,
+with the same content as a download from Galaxy. Files are converted in
+parallel; failures are reported on stderr and make the exit status 1.
+
+usage: %prog [options] file.ga ...
+"""
+
+import os, sys, zipfile
+from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
+from collections import OrderedDict
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from galaxy.workflow import wspgrade
+from galaxy.workflow.wspgrade.bulk import convert
+
+class FormatError( Exception ):
+    pass
+
+def load_workflow_dict( path ):
+    """
+    Read a .ga file into the dictionary `_workflow_to_dict` would build.
+    JSON object keys are strings, so the steps are keyed by their integer
+    ids again, inserted in ascending order like Galaxy does. Objects keep
+    the order of the file, which is the order Galaxy iterated them in when
+    exporting, so the ports are numbered as in a download from Galaxy.
+    """
+    fh = open( path )
+    try:
+        data = json.load( fh, object_pairs_hook=OrderedDict )
+    finally:
+        fh.close()
+    if not isinstance( data, dict ) or data.get( 'a_galaxy_workflow' ) != 'true' or data.get( 'format-version' ) != '0.1':
+        raise FormatError( "not a format-version 0.1 Galaxy workflow" )
+    if not isinstance( data.get( 'steps' ), dict ):
+        raise FormatError( "'steps' is not an object" )
+    steps = {}
+    for key in sorted( data['steps'], key=int ):
+        step = data['steps'][ key ]
+        if not isinstance( step, dict ) or not isinstance( step.get( 'input_connections', {} ), dict ):
+            raise FormatError( "step %s is not a workflow step" % key )
+        step.setdefault( 'annotation', '' )
+        step.setdefault( 'tool_version', None )
+        step.setdefault( 'inputs', [] )
+        step.setdefault( 'outputs', [] )
+        step.setdefault( 'input_connections', {} )
+        for input_connection in step['input_connections'].values():
+            input_connection['id'] = int( input_connection['id'] )
+        step['id'] = int( step['id'] )
+        steps[ int( key ) ] = step
+    data['steps'] = steps
+    data.setdefault( 'annotation', '' )
+    return data
+
+def convert_file( job ):
+    """
+    Convert one file; returns (path, None) or (path, error message). Any
+    error is returned as the message, so one bad file cannot stop the
+    batch.
+    """
+    path = job[0]
+    try:
+        return path, write_converted( *job )
+    except Exception, e:
+        return path, "%s: %s" % ( e.__class__.__name__, e )
+
+def write_converted( path, output_path, compression, layout_options ):
+    """
+    Convert `path` to `output_path`; returns None or an error message.
+    """
+    try:
+        workflow_dict = load_workflow_dict( path )
+    except ( IOError, ValueError, KeyError, TypeError, FormatError ), e:
+        return "cannot read workflow: %s" % e
+    name = wspgrade.archive_name( workflow_dict.get( 'name' ) or 'workflow' )
+    label, data, message, details = convert( ( path, name, workflow_dict, compression, layout_options ) )
+    if message is not None:
+        return message
+    try:
+        out = open( output_path, 'wb' )
+        try:
+            out.write( data )
+        finally:
+            out.close()
+    except IOError, e:
+        return "cannot write %s: %s" % ( output_path, e )
+    return None
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-o', '--output-dir', help='directory for the archives, default: next to each input file' )
+    parser.add_option( '-j', '--workers', type='int', default=cpu_count(), help='number of worker processes [%default]' )
+    parser.add_option( '--fast', action='store_true', default=False, help='store workflow.xml without compression' )
+    parser.add_option( '--sweeps', type='int', default=wspgrade.MAX_SWEEPS, help='crossing minimisation sweeps per workflow [%default]' )
+    parser.add_option( '--time-limit', type='float', default=wspgrade.TIME_LIMIT, help='crossing minimisation seconds per workflow [%default]' )
+    options, args = parser.parse_args()
+    if not args:
+        parser.error( "no workflow files given" )
+    if options.output_dir and not os.path.isdir( options.output_dir ):
+        os.makedirs( options.output_dir )
+    compression = options.fast and zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    layout_options = dict( max_sweeps=options.sweeps, time_limit=options.time_limit )
+    jobs = []
+    for path in args:
+        output_path = os.path.splitext( path )[0] + '.zip'
+        if options.output_dir:
+            output_path = os.path.join( options.output_dir, os.path.basename( output_path ) )
+        jobs.append( ( path, output_path, compression, layout_options ) )
+    workers = min( options.workers, len( jobs ) )
+    if workers > 1:
+        pool = Pool( workers )
+        results = pool.imap_unordered( convert_file, jobs, chunksize=8 )
+    else:
+        pool = None
+        results = ( convert_file( job ) for job in jobs )
+    failed = 0
+    try:
+        for path, message in results:
+            if message is not None:
+                failed += 1
+                print >> sys.stderr, "%s: %s" % ( path, message )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print >> sys.stderr, "Converted %d of %d workflows" % ( len( jobs ) - failed, len( jobs ) )
+    if failed:
+        sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""
+Import the workflow modules of this tree from the scripts without a Galaxy
+server. The `galaxy` packages are registered as bare namespace modules, so
+their __init__ modules, which check eggs through pkg_resources and pull in
+most of Galaxy, are not run; the modules the scripts use only need the
+standard library.
+"""
+
+import os, sys, imp
+
+LIB = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'lib' )
+
+def bootstrap():
+    for name in ( 'galaxy', 'galaxy.util', 'galaxy.workflow' ):
+        if name in sys.modules:
+            continue
+        module = imp.new_module( name )
+        module.__path__ = [ os.path.join( LIB, *name.split( '.' ) ) ]
+        sys.modules[ name ] = module
+        if '.' in name:
+            setattr( sys.modules[ 'galaxy' ], name.split( '.' )[-1], module )
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Concurrency stress check of the workflow image renderer.
+
+Generates synthetic workflows, each with a style of its own, and renders
+every one serially. Then --threads threads render all of them again, in
+a different order per thread, --rounds times over. Every concurrent render
+must be byte for byte the serial one; the script exits non-zero and names
+the workflow if not.
+
+usage: %prog [options]
+"""
+
+import os, sys, time, random, threading
+from optparse import OptionParser
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from galaxy.workflow.render import StepImage, WorkflowImage, DEFAULT_STYLE
+
+def make_workflow( num_steps, rnd ):
+    """
+    Steps and connections of a random workflow, and a style derived from
+    the default one.
+    """
+    style = DEFAULT_STYLE._replace( font_size="%dpx" % rnd.randint( 8, 14 ), margin=rnd.randint( 2, 8 ),
+                                    line_px=rnd.randint( 12, 20 ), title_fill="#%06x" % rnd.randint( 0, 0xffffff ) )
+    specs = []
+    for i in range( num_steps ):
+        inputs = [ ( 'input%d' % k, 'Input %d of step %d' % ( k, i ) ) for k in range( rnd.randint( 0, 3 ) ) ]
+        outputs = [ 'out_file%d' % k for k in range( rnd.randint( 1, 3 ) ) ]
+        specs.append( ( 'Tool %d' % i, 10 + 220 * ( i % 20 ), 10 + 180 * ( i // 20 ), inputs, outputs ) )
+    connections = []
+    for target, ( name, left, top, inputs, outputs ) in enumerate( specs ):
+        for input_name, label in inputs:
+            if target:
+                source = rnd.randint( 0, target - 1 )
+                connections.append( ( source, rnd.choice( specs[ source ][4] ), target, input_name ) )
+    return specs, connections, style
+
+def render( workflow ):
+    specs, connections, style = workflow
+    steps = [ StepImage( name, left, top, inputs, outputs, style=style ) for name, left, top, inputs, outputs in specs ]
+    return ''.join( WorkflowImage( steps, connections, style=style ).svg() )
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-t', '--threads', type='int', default=16, help='concurrent renderers [%default]' )
+    parser.add_option( '-w', '--workflows', type='int', default=32, help='number of workflows [%default]' )
+    parser.add_option( '-n', '--steps', type='int', default=200, help='steps per workflow [%default]' )
+    parser.add_option( '-r', '--rounds', type='int', default=3, help='renders of every workflow per thread [%default]' )
+    parser.add_option( '-s', '--seed', type='int', default=0, help='random seed [%default]' )
+    options, args = parser.parse_args()
+    rnd = random.Random( options.seed )
+    workflows = [ make_workflow( options.steps, rnd ) for i in range( options.workflows ) ]
+    start = time.time()
+    expected = [ render( workflow ) for workflow in workflows ]
+    serial = time.time() - start
+    if len( set( expected ) ) != len( expected ):
+        print >> sys.stderr, "workflows do not render differently, the check would prove nothing"
+        sys.exit( 2 )
+    mismatches = []
+    def worker( number ):
+        order = range( len( workflows ) )
+        random.Random( number ).shuffle( order )
+        for i in range( options.rounds ):
+            for index in order:
+                if render( workflows[ index ] ) != expected[ index ]:
+                    mismatches.append( ( number, index ) )
+    threads = [ threading.Thread( target=worker, args=( number, ) ) for number in range( options.threads ) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    concurrent = time.time() - start
+    renders = options.threads * options.rounds * len( workflows )
+    print >> sys.stderr, "serial: %d renders in %.2fs; concurrent: %d renders on %d threads in %.2fs" % \
+                         ( len( workflows ), serial, renders, options.threads, concurrent )
+    if mismatches:
+        for number, index in mismatches[:10]:
+            print >> sys.stderr, "thread %d rendered workflow %d differently" % ( number, index )
+        sys.exit( 1 )
+    print >> sys.stderr, "all concurrent renders match the serial ones"
+
+if __name__ == "__main__":
+    main()
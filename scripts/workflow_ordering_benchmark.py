@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Benchmark of the step ordering done when a workflow is saved or imported.
+
+Generates synthetic workflows of plain step objects (a position and input
+connections, like `WorkflowStep`) and times the ordering of
+`attach_ordered_steps` both ways: the previous `cmp` sort on the distance
+from the canvas origin followed by `topsort` of the self-edge list, and the
+key sort followed by `WorkflowGraph.topological_order`. Both orders are
+checked to be identical. Runs without a Galaxy server; the baseline uses a
+copy of Galaxy's `topsort`. Each phase reports the best of --repeat runs.
+
+usage: %prog [options] [size ...]
+"""
+
+import os, sys, time, math, random, platform
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from galaxy.workflow.graph import WorkflowGraph, sort_by_position
+
+DEFAULT_SIZES = [ 10000, 100000 ]
+
+class Step( object ):
+    def __init__( self, left, top ):
+        self.position = dict( left=left, top=top )
+        self.input_connections = []
+
+class Connection( object ):
+    def __init__( self, input_step, input_name, output_step, output_name ):
+        self.input_step = input_step
+        self.input_name = input_name
+        self.output_step = output_step
+        self.output_name = output_name
+
+def make_steps( num_steps, rnd, window=20 ):
+    """
+    Steps laid out on a grid in creation order, each reading one to three
+    of the `window` most recent steps, in shuffled order.
+    """
+    width = max( 1, int( num_steps ** 0.5 ) )
+    steps = []
+    for i in range( num_steps ):
+        row, column = divmod( i, width )
+        step = Step( 10 + 220 * column, 10 + 120 * row )
+        if i:
+            for k in range( rnd.randint( 1, 3 ) ):
+                parent = steps[ rnd.randint( max( 0, i - window ), i - 1 ) ]
+                step.input_connections.append( Connection( step, 'input%d' % k, parent, 'out_file1' ) )
+        steps.append( step )
+    rnd.shuffle( steps )
+    return steps
+
+def topsort( pairlist ):
+    """
+    The `galaxy.util.topsort.topsort` the previous ordering used, kept here
+    so that the baseline runs without Galaxy: the sources in key order of a
+    dict of the step indices, then every step as its last parent is done.
+    """
+    numpreds = {}
+    successors = {}
+    for first, second in pairlist:
+        if first not in numpreds:
+            numpreds[ first ] = 0
+        if second not in numpreds:
+            numpreds[ second ] = 0
+        if first == second:
+            continue
+        numpreds[ second ] += 1
+        successors.setdefault( first, [] ).append( second )
+    answer = [ x for x in numpreds.keys() if numpreds[ x ] == 0 ]
+    for x in answer:
+        del numpreds[ x ]
+        for y in successors.get( x, () ):
+            numpreds[ y ] -= 1
+            if numpreds[ y ] == 0:
+                answer.append( y )
+    if numpreds:
+        raise AssertionError( "the workflow contains cycles" )
+    return answer
+
+def legacy_order( steps ):
+    steps.sort(cmp=lambda s1,s2: cmp( math.sqrt(s1.position['left']**2 + s1.position['top']**2), math.sqrt(s2.position['left']**2 + s2.position['top']**2)))
+    edges = []
+    steps_to_index = dict( ( step, i ) for i, step in enumerate( steps ) )
+    for step in steps:
+        edges.append( ( steps_to_index[step], steps_to_index[step] ) )
+        for conn in step.input_connections:
+            edges.append( ( steps_to_index[conn.output_step], steps_to_index[conn.input_step] ) )
+    return [ steps[i] for i in topsort( edges ) ]
+
+def graph_order( steps, timings ):
+    start = time.time()
+    sort_by_position( steps )
+    timings.append( ( 'sort', time.time() - start ) )
+    start = time.time()
+    graph = WorkflowGraph.from_steps( steps )
+    timings.append( ( 'graph', time.time() - start ) )
+    start = time.time()
+    order = [ steps[i] for i in graph.topological_order() ]
+    timings.append( ( 'topological_order', time.time() - start ) )
+    return order
+
+def benchmark( size, repeat, seed ):
+    steps = make_steps( size, random.Random( seed ) )
+    best = {}
+    for i in range( repeat ):
+        timings = []
+        start = time.time()
+        expected = legacy_order( list( steps ) )
+        timings.append( ( 'legacy', time.time() - start ) )
+        start = time.time()
+        order = graph_order( list( steps ), timings )
+        timings.append( ( 'total', time.time() - start ) )
+        if order != expected:
+            raise AssertionError( "orders differ for %d steps" % size )
+        for name, seconds in timings:
+            best[ name ] = min( best.get( name, seconds ), seconds )
+    edges = sum( [ len( step.input_connections ) for step in steps ] )
+    return dict( steps=size, edges=edges, phases=best, speedup=best[ 'legacy' ] / best[ 'total' ] )
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-r', '--repeat', type='int', default=3, help='runs per workflow, the best time of each phase is reported [%default]' )
+    parser.add_option( '-s', '--seed', type='int', default=0, help='random seed for the synthetic workflows [%default]' )
+    parser.add_option( '-o', '--output', help='write the JSON results to this file instead of stdout' )
+    options, args = parser.parse_args()
+    sizes = [ int( arg ) for arg in args ] or DEFAULT_SIZES
+    results = []
+    for size in sizes:
+        result = benchmark( size, options.repeat, options.seed )
+        print >> sys.stderr, "%7d steps  legacy %8.3fs  graph %8.3fs  %5.1fx" % ( size, result['phases']['legacy'], result['phases']['total'], result['speedup'] )
+        results.append( result )
+    report = dict( python=platform.python_version(), platform=platform.platform(),
+                   repeat=options.repeat, seed=options.seed, time=time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                   results=results )
+    if options.output:
+        out = open( options.output, 'w' )
+    else:
+        out = sys.stdout
+    json.dump( report, out, indent=1, sort_keys=True )
+    out.write( '\n' )
+    if options.output:
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Check that loading a workflow revision takes a fixed number of queries.
+
+Maps the workflow tables like `galaxy.model.mapping` does (workflow, steps,
+connections, post job actions and workflow outputs) on an in-memory SQLite
+database, stores chains of each size given and counts the SELECTs of
+`load_full_workflow` followed by a walk of everything the controllers use:
+the steps, their input connections and the output step of each, their post
+job actions and workflow outputs. Every size is loaded both into an empty
+session and into one that has loaded the workflow and its steps before.
+The walk must not query and the count must be the same for every size;
+the script exits non-zero if not.
+
+Needs SQLAlchemy (0.5, as Galaxy uses).
+
+usage: %prog [options] [size ...]
+"""
+
+import os, sys
+from optparse import OptionParser
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from sqlalchemy import MetaData, Table, Column, Integer, TEXT, ForeignKey, create_engine, asc
+from sqlalchemy.orm import mapper, relation, scoped_session, sessionmaker
+from sqlalchemy.interfaces import ConnectionProxy
+
+from galaxy.workflow.loader import load_full_workflow
+
+DEFAULT_SIZES = [ 1, 10, 100, 1000 ]
+
+class SelectCounter( ConnectionProxy ):
+    def __init__( self ):
+        self.count = 0
+
+    def cursor_execute( self, execute, cursor, statement, parameters, context, executemany ):
+        if statement.lstrip().upper().startswith( 'SELECT' ):
+            self.count += 1
+        return execute( cursor, statement, parameters, context )
+
+class Model( object ):
+    """
+    The workflow classes and tables, mapped as in `galaxy.model.mapping`.
+    """
+
+    class Workflow( object ):
+        pass
+
+    class WorkflowStep( object ):
+        pass
+
+    class WorkflowStepConnection( object ):
+        pass
+
+    class PostJobAction( object ):
+        pass
+
+    class WorkflowOutput( object ):
+        pass
+
+    def __init__( self, engine ):
+        metadata = MetaData()
+        workflow = Table( "workflow", metadata,
+            Column( "id", Integer, primary_key=True ),
+            Column( "name", TEXT ) )
+        step = Table( "workflow_step", metadata,
+            Column( "id", Integer, primary_key=True ),
+            Column( "workflow_id", Integer, ForeignKey( "workflow.id" ), index=True, nullable=False ),
+            Column( "type", TEXT ),
+            Column( "tool_id", TEXT ),
+            Column( "order_index", Integer ) )
+        connection = Table( "workflow_step_connection", metadata,
+            Column( "id", Integer, primary_key=True ),
+            Column( "output_step_id", Integer, ForeignKey( "workflow_step.id" ), index=True ),
+            Column( "input_step_id", Integer, ForeignKey( "workflow_step.id" ), index=True ),
+            Column( "output_name", TEXT ),
+            Column( "input_name", TEXT ) )
+        post_job_action = Table( "post_job_action", metadata,
+            Column( "id", Integer, primary_key=True ),
+            Column( "workflow_step_id", Integer, ForeignKey( "workflow_step.id" ), index=True, nullable=False ),
+            Column( "action_type", TEXT ) )
+        workflow_output = Table( "workflow_output", metadata,
+            Column( "id", Integer, primary_key=True ),
+            Column( "workflow_step_id", Integer, ForeignKey( "workflow_step.id" ), index=True, nullable=False ),
+            Column( "output_name", TEXT ) )
+        mapper( self.Workflow, workflow, properties=dict(
+            steps=relation( self.WorkflowStep, backref='workflow', order_by=asc( step.c.order_index ), cascade="all, delete-orphan" ) ) )
+        mapper( self.WorkflowStep, step, properties=dict(
+            post_job_actions=relation( self.PostJobAction, backref='workflow_step' ),
+            workflow_outputs=relation( self.WorkflowOutput, backref='workflow_step' ) ) )
+        mapper( self.WorkflowStepConnection, connection, properties=dict(
+            input_step=relation( self.WorkflowStep, backref="input_connections", cascade="all",
+                                 primaryjoin=( connection.c.input_step_id == step.c.id ) ),
+            output_step=relation( self.WorkflowStep, backref="output_connections", cascade="all",
+                                  primaryjoin=( connection.c.output_step_id == step.c.id ) ) ) )
+        mapper( self.PostJobAction, post_job_action )
+        mapper( self.WorkflowOutput, workflow_output )
+        metadata.create_all( engine )
+
+def store_chain( model, sa_session, num_steps ):
+    """
+    Store a workflow of `num_steps` steps, each reading the previous one,
+    with a post job action and a workflow output each. Returns its id.
+    """
+    workflow = model.Workflow()
+    workflow.name = "chain of %d" % num_steps
+    previous = None
+    for order_index in range( num_steps ):
+        step = model.WorkflowStep()
+        step.type = 'tool'
+        step.tool_id = 'tool%d' % ( order_index % 7 )
+        step.order_index = order_index
+        workflow.steps.append( step )
+        if previous is not None:
+            connection = model.WorkflowStepConnection()
+            connection.output_step = previous
+            connection.output_name = 'out_file1'
+            connection.input_name = 'input1'
+            step.input_connections.append( connection )
+        action = model.PostJobAction()
+        action.action_type = 'RenameDatasetAction'
+        step.post_job_actions.append( action )
+        output = model.WorkflowOutput()
+        output.output_name = 'out_file1'
+        step.workflow_outputs.append( output )
+        previous = step
+    sa_session.add( workflow )
+    sa_session.flush()
+    return workflow.id
+
+def walk( workflow ):
+    """
+    Touch everything the controllers use of a loaded workflow.
+    """
+    for step in workflow.steps:
+        for connection in step.input_connections:
+            connection.output_step.order_index
+        len( step.post_job_actions )
+        len( step.workflow_outputs )
+
+def count_queries( model, Session, counter, workflow_id, preload ):
+    """
+    (queries to load, queries to walk) the workflow `workflow_id`.
+    """
+    sa_session = Session()
+    try:
+        if preload:
+            [ step.id for step in sa_session.query( model.Workflow ).get( workflow_id ).steps ]
+        counter.count = 0
+        workflow = load_full_workflow( sa_session, model, workflow_id )
+        loading = counter.count
+        walk( workflow )
+        return loading, counter.count - loading
+    finally:
+        Session.remove()
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    options, args = parser.parse_args()
+    sizes = [ int( arg ) for arg in args ] or DEFAULT_SIZES
+    counter = SelectCounter()
+    engine = create_engine( 'sqlite://', proxy=counter )
+    model = Model( engine )
+    Session = scoped_session( sessionmaker( bind=engine, autoflush=False, autocommit=True ) )
+    workflow_ids = {}
+    for size in sizes:
+        workflow_ids[ size ] = store_chain( model, Session(), size )
+        Session.remove()
+    failed = False
+    for preload in ( False, True ):
+        counts = set()
+        for size in sizes:
+            loading, walking = count_queries( model, Session, counter, workflow_ids[ size ], preload )
+            print >> sys.stderr, "%6d steps%s: %d queries to load, %d to walk" % \
+                                 ( size, preload and ' (steps loaded before)' or '', loading, walking )
+            counts.add( loading )
+            if walking:
+                failed = True
+        if len( counts ) > 1:
+            failed = True
+    if failed:
+        print >> sys.stderr, "the number of queries depends on the number of steps"
+        sys.exit( 1 )
+    print >> sys.stderr, "the number of queries is the same for every size"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Check of the workflow invocation scheduler on a local SQLite database.
+
+Executes synthetic invocations (every step only counts itself; every
+seventh invocation fails) through `InvocationScheduler` and checks that
+
+- every invocation ends ok or error with all its steps counted, and a
+  scheduler on another engine, like another process, reports the same;
+- invocations submitted to a scheduler without workers, as before a
+  restart, are executed by the next scheduler started on the database;
+- invocations picked up by several schedulers at once are executed once.
+
+Exits non-zero naming the first check that fails. Needs SQLAlchemy.
+
+usage: %prog [options]
+"""
+
+import os, sys, time, shutil, tempfile, threading, logging
+from optparse import OptionParser
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from sqlalchemy import create_engine
+
+from galaxy.workflow.scheduler import InvocationRequest, InvocationStore, InvocationScheduler, QUEUED, OK, ERROR
+
+class Executor( object ):
+    """
+    Synthetic step execution counting the executions of every invocation.
+    """
+
+    def __init__( self, delay ):
+        self.delay = delay
+        self.executions = {}
+        self.lock = threading.Lock()
+
+    def __call__( self, request, progress ):
+        self.lock.acquire()
+        try:
+            self.executions[ request.invocation_id ] = self.executions.get( request.invocation_id, 0 ) + 1
+        finally:
+            self.lock.release()
+        for step_id in sorted( request.states ):
+            time.sleep( self.delay )
+            progress( step_id )
+        if request.invocation_id % 7 == 0:
+            raise ValueError( "step %d failed" % step_id )
+
+def make_request( invocation_id, num_steps ):
+    states = dict( [ ( step_id, '{"step": %d}' % step_id ) for step_id in range( num_steps ) ] )
+    return InvocationRequest( invocation_id, 1, 1, None, states, { 'name': 'run %d' % invocation_id },
+                              dict( base='http://localhost:8080', host='localhost:8080', remote_addr='127.0.0.1' ) )
+
+def wait( store, invocation_ids, timeout=60 ):
+    end = time.time() + timeout
+    while time.time() < end:
+        if all( [ store.get( invocation_id )[ 'state' ] in ( OK, ERROR ) for invocation_id in invocation_ids ] ):
+            return True
+        time.sleep( 0.05 )
+    return False
+
+def check( condition, message ):
+    if not condition:
+        print >> sys.stderr, "FAILED: %s" % message
+        sys.exit( 1 )
+    print >> sys.stderr, "ok: %s" % message
+
+def check_finished( store, invocation_ids, num_steps ):
+    for invocation_id in invocation_ids:
+        status = store.get( invocation_id )
+        expected = invocation_id % 7 == 0 and ERROR or OK
+        if status[ 'state' ] != expected or status[ 'steps_done' ] != num_steps or status[ 'steps_total' ] != num_steps:
+            return False
+    return True
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-n', '--invocations', type='int', default=50, help='invocations per check [%default]' )
+    parser.add_option( '-s', '--steps', type='int', default=5, help='steps per invocation [%default]' )
+    parser.add_option( '-w', '--workers', type='int', default=3, help='workers per scheduler [%default]' )
+    options, args = parser.parse_args()
+    # The failing invocations are expected, not their tracebacks.
+    logging.basicConfig( level=logging.CRITICAL )
+    directory = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///%s' % os.path.join( directory, 'scheduler.sqlite' )
+        store = InvocationStore( create_engine( url ) )
+        # Another process reading the same database.
+        other_store = InvocationStore( create_engine( url ) )
+
+        executor = Executor( 0.001 )
+        scheduler = InvocationScheduler( executor, store, workers=options.workers )
+        first = range( 1, options.invocations + 1 )
+        for invocation_id in first:
+            scheduler.submit( make_request( invocation_id, options.steps ) )
+        check( wait( store, first ), "submitted invocations finish" )
+        check( check_finished( other_store, first, options.steps ), "another process sees every state and step count" )
+        check( max( executor.executions.values() ) == 1, "every invocation is executed once" )
+        scheduler.shutdown()
+
+        # Queued, then the process stops before a worker gets to them.
+        stopped = InvocationScheduler( executor, store, workers=0 )
+        restarted = range( 1001, 1001 + options.invocations )
+        for invocation_id in restarted:
+            stopped.submit( make_request( invocation_id, options.steps ) )
+        check( all( [ store.get( invocation_id )[ 'state' ] == QUEUED for invocation_id in restarted ] ), "invocations stay queued without workers" )
+        # Several processes start on the database at once.
+        executor = Executor( 0.001 )
+        schedulers = [ InvocationScheduler( executor, InvocationStore( create_engine( url ) ), workers=options.workers ) for i in range( 3 ) ]
+        check( wait( store, restarted ), "queued invocations are executed after a restart" )
+        check( check_finished( store, restarted, options.steps ), "restarted invocations have every step counted" )
+        check( sorted( executor.executions ) == restarted and max( executor.executions.values() ) == 1,
+               "invocations queued in several processes are executed once" )
+        for scheduler in schedulers:
+            scheduler.shutdown()
+    finally:
+        shutil.rmtree( directory )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the WS-PGRADE export.
+
+Generates synthetic workflow dictionaries shaped like `_workflow_to_dict`
+output (chains, wide fan-out, fan-in, diamond lattices and random DAGs) and
+times every phase of the export separately: the layout phases of
+`LayoutEngine`, XML emission and zipping. Each phase reports the best of
+--repeat runs. Results are written as JSON; --compare prints the ratio of
+every phase to a previous results file.
+
+usage: %prog [options] [size ...]
+"""
+
+import os, sys, time, random, copy, platform, zipfile
+from cStringIO import StringIO
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from galaxy.workflow.wspgrade.layout import LayoutEngine
+from galaxy.workflow.wspgrade.writer import WorkflowXMLWriter
+from galaxy.workflow.wspgrade.archive import ZipEntryWriter
+
+DEFAULT_SIZES = [ 10, 100, 1000, 10000, 50000 ]
+CHUNK_SIZE = 64 * 1024
+
+def data_input_step( step_id ):
+    return dict( id=step_id, type='data_input', tool_id=None, tool_version=None, name='Input dataset',
+                 tool_state='{"name": "Input Dataset"}', tool_errors=None, annotation='',
+                 inputs=[ dict( name='Input Dataset', description='' ) ], user_outputs=[], outputs=[],
+                 input_connections={}, position=dict( left=10, top=10 + 100 * step_id ) )
+
+def tool_step( step_id, parents, runtime_input=False ):
+    """
+    A tool step reading one output of each step id in `parents`.
+    """
+    input_connections = {}
+    for i, parent in enumerate( parents ):
+        input_connections[ 'input%d' % i ] = dict( id=parent, output_name='out_file%d' % ( 1 + i % 2 ) )
+    inputs = []
+    if runtime_input:
+        inputs.append( dict( name='param', description='runtime parameter for tool Tool %d' % step_id ) )
+    return dict( id=step_id, type='tool', tool_id='tool%d' % ( step_id % 50 ), tool_version='1.0.0',
+                 name='Tool %d' % step_id, tool_state='{}', tool_errors=None, annotation='', inputs=inputs,
+                 user_outputs=[], outputs=[ dict( name='out_file1', type='tabular' ), dict( name='out_file2', type='txt' ) ],
+                 input_connections=input_connections, position=dict( left=0, top=0 ) )
+
+def workflow( steps ):
+    return { 'a_galaxy_workflow': 'true', 'format-version': '0.1', 'name': 'benchmark', 'annotation': '',
+             'steps': dict( ( step['id'], step ) for step in steps ) }
+
+def chain( num_steps, rnd ):
+    """
+    Input -> tool -> tool -> ... -> tool.
+    """
+    steps = [ data_input_step( 0 ), tool_step( 1, [ 0 ] ) ]
+    for step_id in range( 2, num_steps ):
+        steps.append( tool_step( step_id, [ step_id - 1 ], runtime_input=rnd.random() < 0.2 ) )
+    return workflow( steps )
+
+def fan_out( num_steps, rnd ):
+    """
+    One tool feeding every other tool.
+    """
+    steps = [ data_input_step( 0 ), tool_step( 1, [ 0 ] ) ]
+    for step_id in range( 2, num_steps ):
+        steps.append( tool_step( step_id, [ 1 ] ) )
+    return workflow( steps )
+
+def fan_in( num_steps, rnd ):
+    """
+    Independent tools, each reading the input, all feeding one last tool.
+    """
+    steps = [ data_input_step( 0 ) ]
+    for step_id in range( 1, num_steps - 1 ):
+        steps.append( tool_step( step_id, [ 0 ] ) )
+    steps.append( tool_step( num_steps - 1, range( 1, num_steps - 1 ) ) )
+    return workflow( steps )
+
+def diamond( num_steps, rnd ):
+    """
+    Square lattice of tools; each tool reads two neighbouring tools of
+    the previous row.
+    """
+    width = max( 1, int( ( num_steps - 1 ) ** 0.5 ) )
+    steps = [ data_input_step( 0 ) ]
+    for step_id in range( 1, num_steps ):
+        row, column = divmod( step_id - 1, width )
+        if row == 0:
+            parents = [ 0 ]
+        else:
+            above = 1 + ( row - 1 ) * width
+            parents = [ above + column, above + ( column + 1 ) % width ]
+        steps.append( tool_step( step_id, parents ) )
+    return workflow( steps )
+
+def random_dag( num_steps, rnd, window=20 ):
+    """
+    Tools with one to three parents picked among the `window` most recent.
+    """
+    steps = [ data_input_step( 0 ), tool_step( 1, [ 0 ] ) ]
+    for step_id in range( 2, num_steps ):
+        first = max( 1, step_id - window )
+        parents = [ rnd.randint( first, step_id - 1 ) for i in range( rnd.randint( 1, 3 ) ) ]
+        steps.append( tool_step( step_id, parents, runtime_input=rnd.random() < 0.2 ) )
+    return workflow( steps )
+
+SHAPES = [ ( 'chain', chain ), ( 'fan_out', fan_out ), ( 'fan_in', fan_in ), ( 'diamond', diamond ), ( 'random', random_dag ) ]
+
+def run_once( workflow_dict ):
+    """
+    Export a copy of `workflow_dict` once and return the seconds spent in
+    each phase, the crossing statistics and the document sizes.
+    """
+    workflow_dict = copy.deepcopy( workflow_dict )
+    timings = []
+    engine = LayoutEngine( workflow_dict )
+    for name, phase in engine.phases():
+        start = time.time()
+        phase()
+        timings.append( ( name, time.time() - start ) )
+    xml = StringIO()
+    start = time.time()
+    WorkflowXMLWriter( xml ).write( 'benchmark', workflow_dict['annotation'], workflow_dict['steps'] )
+    timings.append( ( 'xml', time.time() - start ) )
+    document = xml.getvalue()
+    out = StringIO()
+    start = time.time()
+    archive = zipfile.ZipFile( out, 'w', zipfile.ZIP_DEFLATED )
+    info = zipfile.ZipInfo( 'workflow.xml' )
+    info.compress_type = zipfile.ZIP_DEFLATED
+    entry = ZipEntryWriter( archive, info )
+    for offset in range( 0, len( document ), CHUNK_SIZE ):
+        entry.write( document[ offset:offset + CHUNK_SIZE ] )
+    entry.close()
+    archive.close()
+    timings.append( ( 'zip', time.time() - start ) )
+    return timings, engine.crossings, len( document ), len( out.getvalue() )
+
+def benchmark( shape, generator, size, repeat, seed ):
+    workflow_dict = generator( size, random.Random( seed ) )
+    best = {}
+    phase_names = []
+    for i in range( repeat ):
+        timings, crossings, xml_bytes, zip_bytes = run_once( workflow_dict )
+        for name, seconds in timings:
+            if name not in best:
+                phase_names.append( name )
+                best[ name ] = seconds
+            else:
+                best[ name ] = min( best[ name ], seconds )
+    edges = sum( [ len( step['input_connections'] ) for step in workflow_dict['steps'].values() ] )
+    return dict( shape=shape, steps=size, edges=edges,
+                 phases=dict( ( name, best[ name ] ) for name in phase_names ),
+                 phase_order=phase_names,
+                 total=sum( best.values() ),
+                 crossings=dict( before=crossings.before, after=crossings.after,
+                                 sweeps=crossings.sweeps, exhausted=crossings.exhausted ),
+                 xml_bytes=xml_bytes, zip_bytes=zip_bytes )
+
+def compare( results, baseline_path ):
+    """
+    Print the time of every phase relative to a previous run.
+    """
+    baseline = {}
+    for result in json.load( open( baseline_path ) )['results']:
+        baseline[ ( result['shape'], result['steps'] ) ] = result
+    print >> sys.stderr, "%-8s %7s %-12s %10s %10s %7s" % ( 'shape', 'steps', 'phase', 'before', 'after', 'ratio' )
+    for result in results:
+        old = baseline.get( ( result['shape'], result['steps'] ) )
+        if old is None:
+            continue
+        for name in result['phase_order'] + [ 'total' ]:
+            if name == 'total':
+                before, after = old['total'], result['total']
+            elif name in old['phases']:
+                before, after = old['phases'][ name ], result['phases'][ name ]
+            else:
+                continue
+            ratio = before and after / before or 0.0
+            print >> sys.stderr, "%-8s %7d %-12s %10.4f %10.4f %7.2f" % ( result['shape'], result['steps'], name, before, after, ratio )
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-r', '--repeat', type='int', default=3, help='runs per workflow, the best time of each phase is reported [%default]' )
+    parser.add_option( '-s', '--seed', type='int', default=0, help='random seed for the synthetic workflows [%default]' )
+    parser.add_option( '--shape', action='append', dest='shapes', help='shape to run, repeatable: %s' % ', '.join( [ name for name, generator in SHAPES ] ) )
+    parser.add_option( '-o', '--output', help='write the JSON results to this file instead of stdout' )
+    parser.add_option( '-c', '--compare', help='JSON results of an earlier run to compare with' )
+    options, args = parser.parse_args()
+    sizes = [ int( arg ) for arg in args ] or DEFAULT_SIZES
+    shapes = [ ( name, generator ) for name, generator in SHAPES if not options.shapes or name in options.shapes ]
+    if not shapes:
+        parser.error( "unknown shape, choose from: %s" % ', '.join( [ name for name, generator in SHAPES ] ) )
+    results = []
+    for name, generator in shapes:
+        for size in sizes:
+            result = benchmark( name, generator, size, options.repeat, options.seed )
+            print >> sys.stderr, "%-8s %7d steps %8.3fs" % ( name, size, result['total'] )
+            results.append( result )
+    report = dict( python=platform.python_version(), platform=platform.platform(),
+                   repeat=options.repeat, seed=options.seed, time=time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                   results=results )
+    if options.output:
+        out = open( options.output, 'w' )
+    else:
+        out = sys.stdout
+    json.dump( report, out, indent=1, sort_keys=True )
+    out.write( '\n' )
+    if options.output:
+        out.close()
+    if options.compare:
+        compare( results, options.compare )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Check the WS-PGRADE crossing minimisation against the connections drawn.
+
+Lays out random small workflows of the shapes of `wspgrade_benchmark.py`
+and, on the lines WS-PGRADE draws from output port to input port, checks
+that
+
+- every parent is left of its child or directly above it;
+- the crossings reported after minimisation are the crossings drawn,
+  counted pair by pair;
+- minimisation never adds crossings.
+
+Prints the drawn crossings in total with and without minimisation and
+exits non-zero naming the first workflow that fails a check.
+
+usage: %prog [options]
+"""
+
+import os, sys, random
+from optparse import OptionParser
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from standalone import bootstrap
+
+bootstrap()
+
+from galaxy.workflow.wspgrade.layout import LayoutEngine, is_job
+from galaxy.workflow.wspgrade.crossings import segments_cross
+from wspgrade_benchmark import SHAPES
+
+def drawn_crossings( engine ):
+    segments = engine.segments()
+    crossings = 0
+    for i in range( len( segments ) ):
+        for j in range( i + 1, len( segments ) ):
+            if segments_cross( segments[i][0], segments[i][1], segments[j][0], segments[j][1] ):
+                crossings += 1
+    return crossings
+
+def parents_right( steps ):
+    """
+    Connections whose parent job is right of the child job.
+    """
+    wrong = []
+    for step in steps.values():
+        if not is_job( step ):
+            continue
+        for input_connection in step['input_connections'].values():
+            parent = steps[ input_connection['id'] ]
+            if is_job( parent ) and parent['position']['left'] > step['position']['left']:
+                wrong.append( ( parent['id'], step['id'] ) )
+    return wrong
+
+def main():
+    parser = OptionParser( usage=__doc__.strip().split( '\n' )[-1] )
+    parser.add_option( '-n', '--workflows', type='int', default=500, help='workflows to lay out [%default]' )
+    parser.add_option( '-m', '--max-steps', type='int', default=25, help='most steps per workflow [%default]' )
+    parser.add_option( '-s', '--seed', type='int', default=0, help='random seed [%default]' )
+    options, args = parser.parse_args()
+    rnd = random.Random( options.seed )
+    total_before = total_after = 0
+    for number in range( options.workflows ):
+        name, generator = rnd.choice( SHAPES )
+        size = rnd.randint( 3, options.max_steps )
+        engine = LayoutEngine( generator( size, random.Random( number ) ), time_limit=None )
+        for phase_name, phase in engine.phases():
+            if phase_name == 'crossings':
+                before = drawn_crossings( engine )
+            phase()
+        label = "workflow %d (%s, %d steps)" % ( number, name, size )
+        wrong = parents_right( engine.steps )
+        if wrong:
+            print >> sys.stderr, "FAILED: %s has parents right of their children: %s" % ( label, wrong )
+            sys.exit( 1 )
+        after = drawn_crossings( engine )
+        if engine.crossings.before != before or engine.crossings.after != after:
+            print >> sys.stderr, "FAILED: %s reports %s, drawn before=%d, after=%d" % ( label, engine.crossings, before, after )
+            sys.exit( 1 )
+        if after > before:
+            print >> sys.stderr, "FAILED: %s went from %d to %d crossings" % ( label, before, after )
+            sys.exit( 1 )
+        total_before += before
+        total_after += after
+    print >> sys.stderr, "%d workflows: %d crossings drawn without minimisation, %d with" % ( options.workflows, total_before, total_after )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+<%inherit file="/base.mako"/>
+<%namespace file="/message.mako" import="render_msg" />
+
+<%def name="title()">Import WS-PGRADE workflow</%def>
+
+%if message:
+    ${render_msg( message, status )}
+%endif
+
+<div class="toolForm">
+    <div class="toolFormTitle">Import WS-PGRADE workflow</div>
+    <div class="toolFormBody">
+        <form name="import_from_wspgrade" action="${h.url_for( action='import_from_wspgrade' )}" enctype="multipart/form-data" method="POST">
+            <div class="form-row">
+                <label>WS-PGRADE workflow archive:</label>
+                <input type="file" name="archive"/>
+                <div class="toolParamHelp" style="clear: both;">
+                    A workflow.zip exported from WS-PGRADE (gUSE). Jobs are matched to Galaxy tools by name and
+                    version and start with the default parameters of their tool; input ports that are not fed by
+                    another job become input datasets.
+                </div>
+                <div style="clear: both"></div>
+            </div>
+            <div class="form-row">
+                <input type="submit" class="primary-button" name="import_button" value="Import"/>
+            </div>
+        </form>
+    </div>
+</div>
@@ -0,0 +1,18 @@
+<%inherit file="/base.mako"/>
+
+<div class="donemessagelarge">
+%if len(invocations) > 1:
+    <p>Workflow "${workflow.name}" has been queued to run ${len(invocations)} times.</p>
+%else:
+    <p>Workflow "${workflow.name}" has been queued to run.</p>
+%endif
+    <p>The jobs of each run are created in the background and will appear in its history shortly.</p>
+    <ul>
+    %for invocation in invocations:
+        <li>
+            History "${invocation['history'].name}":
+            <a href="${h.url_for( action='invocation_status', id=trans.security.encode_id( invocation['id'] ) )}">status of the run</a>
+        </li>
+    %endfor
+    </ul>
+</div>